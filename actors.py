@@ -0,0 +1,251 @@
+import numpy as np
+
+# What kind of AI an actor slot has
+NO_AI		= 0
+BATCHED_AI	= 1		# Advanced in bulk by step_basic_monsters
+OTHER_AI	= 2		# Has its own take_turn
+
+class ActorStore:
+	# Structure-of-arrays storage for every object with a Fighter - positions
+	# and combat stats live in parallel arrays, one slot per actor, so all the
+	# basic monsters can be moved in a single vectorised step. GameObject and
+	# Fighter read and write their x/y/hp/... through their slot while they
+	# are in a store.
+	def __init__(self, objects=(), capacity=64):
+		self.x = np.zeros(capacity, dtype=np.int32)
+		self.y = np.zeros(capacity, dtype=np.int32)
+		self.hp = np.zeros(capacity, dtype=np.int32)
+		self.max_hp = np.zeros(capacity, dtype=np.int32)
+		self.defense = np.zeros(capacity, dtype=np.int32)
+		self.power = np.zeros(capacity, dtype=np.int32)
+		self.speed = np.zeros(capacity, dtype=np.int32)
+		self.blocks = np.zeros(capacity, dtype=bool)
+		self.ai_kind = np.zeros(capacity, dtype=np.int8)
+		self.alive = np.zeros(capacity, dtype=bool)		# Slot in use
+		self.objects = [None] * capacity
+		self.free = []
+		self.size = 0		# Slots ever handed out
+
+		for obj in objects:
+			if obj.fighter: self.add(obj)
+
+	def __len__(self):
+		return self.size - len(self.free)
+
+	def grow(self):
+		capacity = len(self.objects) * 2
+		for name in ('x', 'y', 'hp', 'max_hp', 'defense', 'power', 'speed', 'blocks',
+				'ai_kind', 'alive'):
+			old = getattr(self, name)
+			new = np.zeros(capacity, dtype=old.dtype)
+			new[:len(old)] = old
+			setattr(self, name, new)
+		self.objects += [None] * (capacity - len(self.objects))
+
+	def add(self, obj):
+		# Move obj (which must have a fighter) into a slot
+		if obj.store is not None: obj.store.remove(obj)
+
+		if self.free: slot = self.free.pop()
+		else:
+			if self.size == len(self.objects): self.grow()
+			slot = self.size
+			self.size += 1
+
+		fighter = obj.fighter
+		self.x[slot] = obj._x
+		self.y[slot] = obj._y
+		self.hp[slot] = fighter._hp
+		self.max_hp[slot] = fighter._max_hp
+		self.defense[slot] = fighter._defense
+		self.power[slot] = fighter._power
+		self.speed[slot] = fighter._speed
+		self.blocks[slot] = obj.blocks
+		self.alive[slot] = True
+		self.objects[slot] = obj
+
+		obj.store = fighter.store = self
+		obj.slot = fighter.slot = slot
+		self.set_ai(slot, obj.ai)
+		return slot
+
+	def remove(self, obj):
+		# Give obj its values back and free its slot
+		slot = obj.slot
+		fighter = obj.fighter
+		obj._x = int(self.x[slot])
+		obj._y = int(self.y[slot])
+		if fighter is not None:
+			fighter._hp = int(self.hp[slot])
+			fighter._max_hp = int(self.max_hp[slot])
+			fighter._defense = int(self.defense[slot])
+			fighter._power = int(self.power[slot])
+			fighter._speed = int(self.speed[slot])
+			fighter.store = fighter.slot = None
+		obj.store = obj.slot = None
+
+		self.alive[slot] = False
+		self.ai_kind[slot] = NO_AI
+		self.objects[slot] = None
+		self.free.append(slot)
+
+	def set_ai(self, slot, ai):
+		if ai is None: self.ai_kind[slot] = NO_AI
+		elif getattr(ai, 'batched', False): self.ai_kind[slot] = BATCHED_AI
+		else: self.ai_kind[slot] = OTHER_AI
+
+	def with_ai(self, kind):
+		# Objects whose AI is of the given kind, in slot order
+		return [self.objects[slot] for slot in
+			np.flatnonzero(self.alive[:self.size] & (self.ai_kind[:self.size] == kind))]
+
+	def step_basic_monsters(self, target, visible, game_map, flow=None, slots=None):
+		# One turn for every batched monster target can see (visible is an
+		# fov.Visibility), or only those of them in slots if it's given:
+		# those 2 or more tiles from target step one tile towards it, the rest
+		# are returned as attackers. With a FlowField a monster takes the best
+		# free downhill step; without one (or off the field) it takes the
+		# rounded unit vector towards the target, as GameObject.move_towards
+		# does. Steps fail if the map or a blocking actor is in the way.
+		# Monsters are resolved in passes, so one can step into a cell another
+		# has just left; when two want the same cell the lower slot gets it.
+		# Only the map around the visible area is looked at.
+		# Returns (objects that moved, objects next to the target).
+		n = self.size
+		x = self.x[:n]
+		y = self.y[:n]
+		active = self.alive[:n] & (self.ai_kind[:n] == BATCHED_AI)
+		if slots is not None:
+			chosen = np.zeros(n, dtype=bool)
+			chosen[slots] = True
+			active &= chosen
+		active[active] = visible.lookup(x[active], y[active])
+		slots = np.flatnonzero(active)
+
+		dx = (target.x - x[slots]).astype(np.float64)
+		dy = (target.y - y[slots]).astype(np.float64)
+		distance = np.sqrt(dx ** 2 + dy ** 2)
+		near = distance < 2
+		attackers = slots[near]
+
+		movers = slots[~near]
+		distance = distance[~near]
+		step_x = np.rint(dx[~near] / distance).astype(np.int32)
+		step_y = np.rint(dy[~near] / distance).astype(np.int32)
+
+		# Cells each mover may step to, most wanted first
+		cell_x = (x[movers] + step_x)[:, None]
+		cell_y = (y[movers] + step_y)[:, None]
+		valid = ((step_x != 0) | (step_y != 0))[:, None]
+		if flow is not None and len(movers):
+			(flow_x, flow_y, flow_valid) = flow.candidates(x[movers], y[movers])
+			# The straight step is only a fallback for monsters with no path
+			valid = valid & ~flow_valid.any(axis=1, keepdims=True)
+			cell_x = np.concatenate([flow_x, cell_x], axis=1)
+			cell_y = np.concatenate([flow_y, cell_y], axis=1)
+			valid = np.concatenate([flow_valid, valid], axis=1)
+		# Work in a window one tile bigger than the visible area, which holds
+		# every cell a visible monster could step to
+		(x1, y1, x2, y2) = visible.bounds()
+		(x1, y1) = (max(0, x1 - 1), max(0, y1 - 1))
+		(x2, y2) = (min(game_map.width, x2 + 1), min(game_map.height, y2 + 1))
+		blocked = game_map.blocked[x1:x2, y1:y2]
+		(width, height) = blocked.shape
+		cell_x = cell_x - x1
+		cell_y = cell_y - y1
+		valid &= (cell_x >= 0) & (cell_x < width) & (cell_y >= 0) & (cell_y < height)
+		cell_x = np.where(valid, cell_x, 0)
+		cell_y = np.where(valid, cell_y, 0)
+
+		# Cells taken by blocking actors
+		occupied = np.zeros(blocked.shape, dtype=bool)
+		blockers = self.alive[:n] & self.blocks[:n]
+		blockers &= (x >= x1) & (x < x2) & (y >= y1) & (y < y2)
+		occupied[x[blockers] - x1, y[blockers] - y1] = True
+
+		moved = []
+		rows = np.arange(len(movers))
+		while len(movers):
+			free = valid & ~(blocked[cell_x, cell_y] | occupied[cell_x, cell_y])
+			choice = free.argmax(axis=1)
+			new_x = cell_x[rows, choice]
+			new_y = cell_y[rows, choice]
+
+			# First claim on each free cell wins this pass
+			candidates = np.flatnonzero(free.any(axis=1))
+			cells = new_x[candidates] * height + new_y[candidates]
+			(cells, first) = np.unique(cells, return_index=True)
+			winners = candidates[first]
+			if not len(winners): break
+
+			won = movers[winners]
+			mover_blocks = self.blocks[won]
+			occupied[x[won][mover_blocks] - x1, y[won][mover_blocks] - y1] = False
+			x[won] = new_x[winners] + x1
+			y[won] = new_y[winners] + y1
+			occupied[x[won][mover_blocks] - x1, y[won][mover_blocks] - y1] = True
+			moved.append(won)
+
+			keep = np.ones(len(movers), dtype=bool)
+			keep[winners] = False
+			movers = movers[keep]
+			cell_x = cell_x[keep]
+			cell_y = cell_y[keep]
+			valid = valid[keep]
+			rows = rows[:len(movers)]
+
+		if moved: moved = np.sort(np.concatenate(moved))
+		return ([self.objects[slot] for slot in moved],
+			[self.objects[slot] for slot in attackers])
+
+class StoreField:
+	# An attribute that lives in an ActorStore array while its object is in a
+	# store, and in a plain '_name' attribute (a slot) otherwise
+	def __init__(self, name):
+		self.name = name
+		self.private = '_' + name
+
+	def __get__(self, obj, cls=None):
+		if obj is None: return self
+		if obj.store is None: return getattr(obj, self.private)
+		return int(getattr(obj.store, self.name)[obj.slot])
+
+	def __set__(self, obj, value):
+		if obj.store is None: setattr(obj, self.private, value)
+		else: getattr(obj.store, self.name)[obj.slot] = value
+
+def slot_names(cls):
+	# Every attribute a __slots__ class and its bases can hold
+	return [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ())]
+
+class Slotted:
+	# Base for the game's __slots__ classes, which have no __dict__. They
+	# pickle as a dict of the attributes that are set, so states pickled
+	# from a __dict__ by older versions load the same way - anything in one
+	# that is no longer an attribute is dropped.
+	__slots__ = ()
+
+	def __getstate__(self):
+		return dict((name, getattr(self, name)) for name in slot_names(type(self))
+			if hasattr(self, name))
+
+	def __setstate__(self, state):
+		names = slot_names(type(self))
+		for (name, value) in state.items():
+			if name in names: setattr(self, name, value)
+
+def detached_state(obj, fields):
+	# obj's state as it would be outside any store, for pickling
+	state = Slotted.__getstate__(obj)
+	if obj.store is not None:
+		for name in fields: state['_' + name] = getattr(obj, name)
+	state['store'] = state['slot'] = None
+	return state
+
+def restore_state(obj, state, fields):
+	# Saves from before the store kept fields under their plain names
+	for name in fields:
+		if name in state: state['_' + name] = state.pop(name)
+	state.setdefault('store', None)
+	state.setdefault('slot', None)
+	Slotted.__setstate__(obj, state)
@@ -0,0 +1,52 @@
+# Images decoded once and cached on disk. A PNG is decoded the first time
+# it's asked for and its pixels kept in cache_dir as a .npy file, which
+# loads with a single read. (Fonts aren't cached - libtcod only loads them
+# from PNG.) Cached files are named after the source's size and
+# modification time, so editing an image replaces its cache.
+import functools
+import os
+import tempfile
+
+import numpy as np
+
+def cache_path(path, cache_dir, suffix):
+	stat = os.stat(path)
+	return os.path.join(cache_dir, '%s-%d-%d%s' % (os.path.basename(path), stat.st_size,
+		stat.st_mtime_ns, suffix))
+
+def store(cached, write):
+	# Write a cache file through write(file) into a temporary file renamed
+	# into place, and drop the files cached from older versions of the image
+	directory = os.path.dirname(cached)
+	os.makedirs(directory, exist_ok=True)
+	(handle, temp_path) = tempfile.mkstemp(suffix='.tmp', dir=directory)
+	try:
+		with os.fdopen(handle, 'wb') as cache_file: write(cache_file)
+		os.replace(temp_path, cached)
+	except BaseException:
+		if os.path.exists(temp_path): os.remove(temp_path)
+		raise
+
+	(source, suffix) = (os.path.basename(cached).rsplit('-', 2)[0], os.path.splitext(cached)[1])
+	for name in os.listdir(directory):
+		if (name != os.path.basename(cached) and name.startswith(source + '-') and
+				name.endswith(suffix)):
+			os.remove(os.path.join(directory, name))
+
+def pixels(path, cache_dir):
+	# The image at path as a (height, width, 3) array of RGB
+	cached = cache_path(path, cache_dir, '.npy')
+	try: return np.load(cached)
+	except (OSError, ValueError): pass
+
+	import tcod.image
+	array = np.ascontiguousarray(np.asarray(tcod.image.Image.from_file(path))[:, :, :3])
+	try: store(cached, lambda cache_file: np.save(cache_file, array))
+	except OSError: pass		# Only slower next time
+	return array
+
+@functools.lru_cache(maxsize=None)
+def image(path, cache_dir):
+	# A tcod Image of the file at path, made once per run
+	import tcod.image
+	return tcod.image.Image.from_array(pixels(path, cache_dir))
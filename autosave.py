@@ -0,0 +1,71 @@
+import threading
+import time
+
+class Autosaver:
+	# Saves the game every interval turns without holding up the game loop.
+	# At a turn boundary take_snapshot() runs on the game's thread and must
+	# return something that shares no mutable state with the game; write()
+	# then serialises it on a worker thread. If a save is still being written
+	# when the next is due, the newer snapshot replaces any waiting one rather
+	# than queueing up behind it. An interval of 0 turns autosave off.
+	def __init__(self, take_snapshot, write, interval=50):
+		self.take_snapshot = take_snapshot
+		self.write = write
+		self.interval = interval
+		self.turns = 0			# Turns since the last autosave
+
+		self.lock = threading.Condition()
+		self.pending = None		# Snapshot waiting for the worker
+		self.busy = False		# The worker is writing one
+		self.thread = None
+
+		self.saves = 0
+		self.snapshot_time = 0.0	# What the last snapshot cost the game loop
+		self.write_time = 0.0		# How long the worker took to write it
+		self.error = None			# The last failed write, if any
+
+	def turn(self):
+		# Count a turn, autosaving if one is due; returns whether it did
+		if not self.interval: return False
+		self.turns += 1
+		if self.turns < self.interval: return False
+		self.turns = 0
+		self.save()
+		return True
+
+	def save(self):
+		start = time.perf_counter()
+		snapshot = self.take_snapshot()
+		self.snapshot_time = time.perf_counter() - start
+
+		with self.lock:
+			self.pending = snapshot
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+				self.thread.start()
+			self.lock.notify_all()
+
+	def run(self):
+		while True:
+			with self.lock:
+				while self.pending is None: self.lock.wait()
+				(snapshot, self.pending) = (self.pending, None)
+				self.busy = True
+
+			start = time.perf_counter()
+			try: self.write(snapshot)
+			except Exception as error: self.error = error
+			else: self.saves += 1
+			self.write_time = time.perf_counter() - start
+
+			with self.lock:
+				self.busy = False
+				self.lock.notify_all()
+
+	def in_flight(self):
+		with self.lock: return self.pending is not None or self.busy
+
+	def wait(self):
+		# Block until every snapshot taken so far has been written
+		with self.lock:
+			while self.pending is not None or self.busy: self.lock.wait()
@@ -0,0 +1,358 @@
+# Balance simulator - plays out fights, or whole floors, a great many times
+# with a scripted player, through the game's own combat, monster turns and
+# item use functions, and reports how the player fares: how often they win,
+# how many turns they last and how much damage they take. Runs are spread
+# over a pool of worker processes, one per core unless told otherwise.
+#
+#	python balance.py fights --runs 1000000
+#	python balance.py floors --runs 2000 --set TROLL_STATS=16,1,5 --set HEAL_AMOUNT=6
+#
+# --set changes any of prl's constants for the run. Each run is seeded from
+# --seed and its number, so the same command always gives the same results.
+import argparse
+import ast
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import headless
+import prl
+from gamemap import GameMap
+from pathfinding import FlowField
+from profiler import PERCENTILES
+
+ARENA_SIZE		= 9			# Fights are in an open square this wide, the player in the middle
+FIGHT_RADIUS	= 3			# ...with the monsters starting this close to them
+FIGHT_TURNS		= 200		# Runs not over after this many turns count as stalled
+FLOOR_TURNS		= 3000
+HEAL_BELOW		= 0.5		# The player drinks a potion below this share of their hp
+INVENTORY_SIZE	= 26		# Items the player can carry, as Item.pick_up allows
+FIGHT_CHUNK		= 2000		# Runs handed to a worker at a time
+FLOOR_CHUNK		= 5
+
+class Tally:
+	# What happened over a number of runs. The distributions are Counters
+	# of value -> runs, so the tallies from each worker simply add up.
+	def __init__(self):
+		self.runs = 0
+		self.outcomes = Counter()	# 'won', 'died' or 'stalled' -> runs
+		self.turns = Counter()		# Turns the run lasted
+		self.damage = Counter()		# Damage the player took
+		self.hp_left = Counter()	# The player's hp at the end of the runs they won
+		self.kills = 0
+		self.items_used = Counter()	# Item name -> uses
+		self.groups = {}			# The monsters fought, as '2 orc, 1 troll' -> outcomes
+
+	def add(self, outcome, turns, damage, hp, kills, group=None):
+		self.runs += 1
+		self.outcomes[outcome] += 1
+		self.turns[turns] += 1
+		self.damage[damage] += 1
+		if outcome == 'won': self.hp_left[hp] += 1
+		self.kills += kills
+		if group is not None: self.groups.setdefault(group, Counter())[outcome] += 1
+
+	def merge(self, other):
+		self.runs += other.runs
+		for name in ('outcomes', 'turns', 'damage', 'hp_left', 'items_used'):
+			getattr(self, name).update(getattr(other, name))
+		self.kills += other.kills
+		for (group, outcomes) in other.groups.items():
+			self.groups.setdefault(group, Counter()).update(outcomes)
+
+	def report(self):
+		def rate(count, runs):
+			# With the half-width of its 95% confidence interval
+			share = count / runs if runs else 0.0
+			return [share, 1.96 * math.sqrt(share * (1 - share) / runs) if runs else 0.0]
+
+		return {
+			'runs': self.runs,
+			'outcomes': dict((outcome, rate(self.outcomes[outcome], self.runs)) for outcome in
+				('won', 'died', 'stalled')),
+			'turns': distribution(self.turns),
+			'damage': distribution(self.damage),
+			'hp_left': distribution(self.hp_left),
+			'kills_per_run': self.kills / self.runs if self.runs else 0.0,
+			'items_per_run': dict((name, uses / self.runs) for (name, uses) in
+				sorted(self.items_used.items())),
+			'groups': dict((group, dict(runs=sum(outcomes.values()),
+				won=rate(outcomes['won'], sum(outcomes.values()))))
+				for (group, outcomes) in sorted(self.groups.items())),
+			'histograms': dict((name, sorted(getattr(self, name).items())) for name in
+				('turns', 'damage', 'hp_left')),
+		}
+
+def distribution(counter, points=PERCENTILES):
+	# Mean and percentiles of a value -> count Counter
+	total = sum(counter.values())
+	if not total: return dict(mean=0.0, **dict(('p%d' % point, 0) for point in points))
+	result = {'mean': sum(value * count for (value, count) in counter.items()) / total}
+	values = sorted(counter.items())
+	for point in points:
+		(wanted, seen) = (point / 100 * total, 0)
+		for (value, count) in values:
+			seen += count
+			if seen >= wanted: break
+		result['p%d' % point] = value
+	return result
+
+# ----------------------------------------------------------------------
+# The scripted player
+# ----------------------------------------------------------------------
+
+target = None					# Where the rune being used is aimed
+heading = None					# What the player is exploring towards
+paths = FlowField(1)			# ...and the way there
+
+def aim(max_range=None):
+	# Stands in for target_tile: the player has already picked their spot
+	return target
+
+def monsters():
+	return [obj for obj in prl.objects if obj.fighter and obj is not prl.player]
+
+def has(name):
+	return any(obj.name == name for obj in prl.inventory)
+
+def use(name, items_used, at=None):
+	# Use the first item called name, aimed at the tile at; returns whether
+	# it did anything
+	global target
+	for obj in prl.inventory:
+		if obj.name == name:
+			target = at
+			obj.item.use()
+			if obj in prl.inventory: return False		# Cancelled
+			items_used[name] += 1
+			return True
+	return False
+
+def walk(goal):
+	# A step along the shortest path to goal
+	paths.max_distance = prl.my_map.width * prl.my_map.height		# However winding
+	paths.update(prl.my_map, goal.x, goal.y)
+	prl.player.move_downhill(paths, goal)
+	prl.fov_recompute = True
+
+def player_turn(items_used, explore):
+	# Heal when badly hurt, use runes where they'll do the most good, and
+	# otherwise fight the weakest monster within reach, or make for the
+	# nearest one in sight. Exploring, the player also goes after monsters
+	# and items out of sight (they know where everything is), one at a time.
+	global heading
+	player = prl.player
+	fighter = player.fighter
+	seen = [obj for obj in monsters() if prl.in_fov(obj.x, obj.y)]
+	adjacent = [obj for obj in seen if player.distance_to(obj) < 2]
+
+	if fighter.hp < fighter.max_hp * HEAL_BELOW and use('healing potion', items_used): return
+
+	if len(adjacent) > 1 and has('confusion rune'):
+		strongest = max(adjacent, key=lambda obj: (obj.fighter.power, obj.fighter.hp))
+		if (not isinstance(strongest.ai, prl.ConfusedMonster) and
+				use('confusion rune', items_used, (strongest.x, strongest.y))): return
+
+	if len(seen) > 1 and has('fireball rune'):
+		# Where it catches the most monsters, the player too if they can take it
+		best = None
+		for obj in seen:
+			caught = prl.object_index.in_radius(obj.x, obj.y, prl.FIREBALL_RADIUS)
+			hits = sum(1 for other in caught if other.fighter and other is not player)
+			if player in caught and fighter.hp <= 2 * prl.FIREBALL_DAMAGE: continue
+			if hits > 1 and (best is None or hits > best[0]): best = (hits, (obj.x, obj.y))
+		if best is not None and use('fireball rune', items_used, best[1]): return
+
+	if has('lightning rune'):
+		closest = prl.closest_monster(prl.LIGHTNING_RANGE)
+		if (closest is not None and closest.fighter.hp > fighter.power - closest.fighter.defense and
+				use('lightning rune', items_used)): return
+
+	if adjacent:
+		weakest = min(adjacent, key=lambda obj: obj.fighter.hp)
+		prl.player_move_or_attack(weakest.x - player.x, weakest.y - player.y)
+		return
+
+	room = len(prl.inventory) < INVENTORY_SIZE
+	for obj in prl.object_index.at(player.x, player.y):
+		if obj.item and room:
+			obj.item.pick_up()
+			return
+
+	if seen:
+		walk(min(seen, key=player.distance_to))
+	elif explore:
+		if heading is None or not (heading.fighter or (heading.item and room and
+				heading in prl.object_index)):
+			goals = (room and [obj for obj in prl.objects if obj.item]) or monsters()
+			heading = min(goals, key=player.distance_to) if goals else None
+		if heading is not None: walk(heading)
+
+def play(turn_limit, tally, group=None, explore=False):
+	# Alternate the player's turns and the monsters' until one side is dead
+	fighter = prl.player.fighter
+	(damage, at_start) = (0, len(monsters()))
+	outcome = 'stalled'
+	for turn in range(1, turn_limit + 1):
+		prl.update_fov()
+		hp = fighter.hp
+		player_turn(tally.items_used, explore)
+		damage += max(0, hp - fighter.hp)
+		if prl.game_state == 'dead':
+			outcome = 'died'
+			break
+		if not monsters():
+			outcome = 'won'
+			break
+
+		hp = fighter.hp
+		prl.monster_turns()
+		damage += max(0, hp - fighter.hp)
+		if prl.game_state == 'dead':
+			outcome = 'died'
+			break
+	tally.add(outcome, turn, damage, max(0, fighter.hp), at_start - len(monsters()), group)
+
+arena = None
+
+def fight(rng, tally):
+	# A room's worth of monsters around the player in an open arena, and a
+	# room's worth of items for the player to fight them with
+	global arena
+	if arena is None:
+		arena = GameMap(ARENA_SIZE + 2, ARENA_SIZE + 2)		# Walled round
+		arena.carve(1, 1, ARENA_SIZE, ARENA_SIZE)
+	prl.my_map = arena
+
+	centre = ARENA_SIZE // 2 + 1
+	fighter_component = prl.Fighter(*prl.PLAYER_STATS, death_function=prl.player_death)
+	prl.player = prl.GameObject(centre, centre, '@', 'player', prl.colours.white, blocks=True,
+		fighter=fighter_component)
+	prl.objects = prl.ObjectStore([prl.player])
+	prl.index_objects()
+	prl.inventory = [prl.make_item(0, 0, rng) for i in range(rng.randint(0, prl.MAX_ROOM_ITEMS))]
+	prl.game_state = 'playing'
+	prl.fov_recompute = True
+
+	cells = [(x, y) for x in range(centre - FIGHT_RADIUS, centre + FIGHT_RADIUS + 1)
+		for y in range(centre - FIGHT_RADIUS, centre + FIGHT_RADIUS + 1) if (x, y) != (centre, centre)]
+	for (x, y) in rng.sample(cells, rng.randint(1, prl.MAX_ROOM_MONSTERS)):
+		prl.add_object(prl.make_monster(x, y, rng))
+	names = Counter(obj.name for obj in monsters())
+	group = ', '.join('%d %s' % (count, name) for (name, count) in sorted(names.items()))
+
+	play(FIGHT_TURNS, tally, group)
+
+def floor(seed, tally):
+	# A whole first floor, generated as a new game's is
+	global heading
+	heading = None
+	prl.new_game(seed)
+	prl.fov_recompute = True
+	play(FLOOR_TURNS, tally, explore=True)
+
+def start_worker(settings):
+	# In each worker: the game without a window, changed by settings
+	sys.stdout = open(os.devnull, 'w')		# Every blow is printed
+	headless.setup(headless.ScriptedInput([]))
+	for (name, value) in settings.items(): setattr(prl, name, value)
+	prl.make_engines()		# FOV and flow settings are built into them
+	prl.game_msgs = prl.MessageLog(prl.MESSAGE_LOG_SIZE)
+	prl.target_tile = aim
+
+	# A handful of monsters take their turns quicker one at a time than
+	# through the batched arrays, and move just the same
+	prl.BATCH_AI = False
+
+def run_chunk(mode, seed, first, count):
+	# Runs first to first + count - 1 in this worker
+	tally = Tally()
+	for number in range(first, first + count):
+		run_seed = random.Random('%d:%d' % (seed, number)).randint(0, 2 ** 31)
+		if mode == 'fights':
+			random.seed(run_seed)
+			fight(random.Random(run_seed), tally)
+		else: floor(run_seed, tally)
+	return tally
+
+def simulate(mode, runs, seed=0, settings=None, workers=None, chunk=None, progress=None):
+	# Play runs fights or floors across workers processes and return their
+	# Tally. progress(done, runs) is called as chunks finish.
+	workers = workers or os.cpu_count() or 1
+	chunk = chunk or (FIGHT_CHUNK if mode == 'fights' else FLOOR_CHUNK)
+	chunk = max(1, min(chunk, math.ceil(runs / (workers * 4))))		# Keep every worker busy
+
+	total = Tally()
+	with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+			initializer=start_worker, initargs=(settings or {},)) as pool:
+		futures = [pool.submit(run_chunk, mode, seed, first, min(chunk, runs - first))
+			for first in range(0, runs, chunk)]
+		for future in as_completed(futures):
+			total.merge(future.result())
+			if progress is not None: progress(total.runs, runs)
+	return total
+
+def parse_setting(text):
+	# 'NAME=value', the value as a Python literal if it is one - '16,1,5' is
+	# a tuple - or else a string
+	(name, value) = text.split('=', 1)
+	try: value = ast.literal_eval(value)
+	except (ValueError, SyntaxError): pass
+	return (name, value)
+
+def print_report(report):
+	outcomes = report['outcomes']
+	print('won %.2f%% (+/-%.2f), died %.2f%%, stalled %.2f%%' % (outcomes['won'][0] * 100,
+		outcomes['won'][1] * 100, outcomes['died'][0] * 100, outcomes['stalled'][0] * 100))
+	for name in ('turns', 'damage', 'hp_left'):
+		values = report[name]
+		print('%-8s mean %6.1f  %s' % (name, values['mean'], '  '.join('p%d %d' % (point,
+			values['p%d' % point]) for point in PERCENTILES)))
+	print('kills per run %.2f' % report['kills_per_run'])
+	if report['items_per_run']:
+		print('items used per run: %s' % ', '.join('%s %.3f' % item for item in
+			report['items_per_run'].items()))
+	for (group, values) in report['groups'].items():
+		print('  %-24s won %6.2f%% of %d' % (group, values['won'][0] * 100, values['runs']))
+
+def main():
+	parser = argparse.ArgumentParser(description='Play out fights or floors with a scripted '
+		'player, across all cores, and report how the player fares.')
+	parser.add_argument('mode', choices=['fights', 'floors'])
+	parser.add_argument('--runs', type=int, default=100000)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--workers', type=int, default=None, help='processes, default one per core')
+	parser.add_argument('--chunk', type=int, default=None, help='runs handed to a worker at a time')
+	parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+		help='change one of the constants in prl.py, e.g. ORC_STATS=10,0,4')
+	parser.add_argument('--output', help='write the report, with full histograms, as JSON')
+	args = parser.parse_args()
+
+	settings = dict(parse_setting(text) for text in args.set)
+	for name in settings:
+		if not hasattr(prl, name): parser.error('prl.py has no setting %s' % name)
+
+	def progress(done, runs):
+		print('\r%d/%d runs' % (done, runs), end='', file=sys.stderr, flush=True)
+
+	start = time.perf_counter()
+	tally = simulate(args.mode, args.runs, args.seed, settings, args.workers, args.chunk, progress)
+	elapsed = time.perf_counter() - start
+	print(file=sys.stderr)
+
+	report = tally.report()
+	report.update(mode=args.mode, seed=args.seed, settings=settings, seconds=elapsed)
+	print('%d %s in %.1fs - %.0f runs/second' % (tally.runs, args.mode, elapsed,
+		tally.runs / elapsed if elapsed else 0.0))
+	print_report(report)
+	if args.output:
+		with open(args.output, 'w') as output_file: json.dump(report, output_file, indent=2)
+
+if __name__ == '__main__':
+	main()
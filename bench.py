@@ -0,0 +1,324 @@
+# Benchmark suite - times map generation, FOV, rendering, movement, monster
+# turns, saving/loading, changing level and entity memory over a range of map
+# sizes and monster counts, headless.
+#
+#	python bench.py --output bench.json
+#	python bench.py --baseline bench.json --threshold 0.15
+#
+# Results are JSON. Comparing against a baseline exits non-zero if any
+# benchmark got slower by more than the threshold.
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shelve
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generation
+import headless
+import prl
+
+DEFAULT_SIZES		= ['80x43', '200x100', '500x500', '1000x1000']
+DEFAULT_MONSTERS	= [10, 100, 1000, 10000]
+
+# entity_memory's bytes per orc before GameObject, Fighter and BasicMonster
+# had __slots__, measured as it is now (10000 orcs, Python 3.11) - 447 after
+UNSLOTTED_ORC_BYTES	= 711
+
+class ArrayConsole(headless.NullConsole):
+	# A null console backed by a real libtcod buffer, so the batch renderer
+	# takes its array path exactly as it would with a tdl console
+	def __init__(self, width, height):
+		headless.NullConsole.__init__(self, width, height)
+		import tcod.console
+		self.buffer = tcod.console.Console(width, height, order='F')
+		self.console_c = self.buffer.console_c
+
+def timed(function, repeat):
+	# Run function repeat times, returning the time of each run
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	return times
+
+def result(name, width, height, monsters, times, operations=1):
+	return {
+		'name': name,
+		'width': width,
+		'height': height,
+		'monsters': monsters,
+		'operations': operations,
+		'repeat': len(times),
+		'best': min(times),
+		'median': statistics.median(times),
+	}
+
+def setup_level(width, height, seed):
+	# A fresh headless game on a width x height map. The number of room
+	# attempts scales with the map's area.
+	headless.setup(headless.ScriptedInput([]))
+	prl.MAP_WIDTH = width
+	prl.MAP_HEIGHT = height
+	prl.MAX_ROOMS = max(30, 30 * width * height // (80 * 43))
+	prl.con = ArrayConsole(width, height)
+
+	random.seed(seed)
+	prl.fov_engine.clear()
+	prl.map_renderer.invalidate()
+	prl.new_game(seed)
+	prl.player.fighter.hp = prl.player.fighter.max_hp = 10 ** 9
+	prl.mouse_coord = (0, 0)
+	prl.fov_recompute = True
+	prl.update_fov()
+
+def floor_cells(rng, count):
+	# Up to count distinct unoccupied floor tiles
+	free = [(x, y) for (x, y) in zip(*(~prl.my_map.blocked).nonzero())
+		if not prl.is_blocked(x, y)]
+	rng.shuffle(free)
+	return [(int(x), int(y)) for (x, y) in free[:count]]
+
+def make_orc(x, y):
+	fighter_component = prl.Fighter(hp=10, defense=0, power=3,
+		death_function=prl.monster_death)
+	return prl.GameObject(x, y, 'o', 'orc', prl.colours.desaturated_green,
+		blocks=True, fighter=fighter_component, ai=prl.BasicMonster())
+
+def add_monsters(count, rng):
+	# Fill the level up with orcs, returning how many fitted
+	cells = floor_cells(rng, count)
+	for (x, y) in cells: prl.add_object(make_orc(x, y))
+	return len(cells)
+
+def bench_generate(width, height, repeat, seed):
+	# Every generator pipeline - the default one is plain 'generate'
+	results = []
+	default = prl.MAP_GENERATOR
+	try:
+		for name in generation.PIPELINES:
+			prl.MAP_GENERATOR = name
+			times = timed(lambda: setup_level(width, height, seed), repeat)
+			label = 'generate' if name == default else 'generate_' + name
+			results.append(result(label, width, height, 0, times))
+	finally: prl.MAP_GENERATOR = default
+	return results
+
+def bench_fov(width, height, repeat, seed, samples=200):
+	setup_level(width, height, seed)
+	cells = floor_cells(random.Random(seed), samples)
+
+	def run():
+		prl.fov_engine.cache.clear()
+		for (x, y) in cells:
+			prl.fov_engine.compute(prl.my_map, x, y, prl.TORCH_RADIUS)
+	return [result('fov', width, height, 0, timed(run, repeat), len(cells))]
+
+def bench_render(width, height, repeat, seed, frames=50):
+	setup_level(width, height, seed)
+	rng = random.Random(seed)
+	cells = floor_cells(rng, frames)
+
+	def run():
+		# One frame per position, so FOV and the dirty region change each time
+		prl.map_renderer.invalidate()
+		for (x, y) in cells:
+			prl.player.x, prl.player.y = x, y
+			prl.fov_recompute = True
+			prl.render_all()
+	return [result('render', width, height, 0, timed(run, repeat), len(cells))]
+
+def bench_movement(width, height, monsters, repeat, seed, moves=10000):
+	setup_level(width, height, seed)
+	rng = random.Random(seed)
+	count = add_monsters(monsters, rng)
+	movers = [obj for obj in prl.objects if obj.ai]
+	steps = [(rng.choice(movers), rng.randint(-1, 1), rng.randint(-1, 1))
+		for i in range(moves)] if movers else []
+
+	def run():
+		for (obj, dx, dy) in steps: obj.move(dx, dy)
+	return [result('movement', width, height, count, timed(run, repeat), len(steps))]
+
+def bench_monster_turn(width, height, monsters, repeat, seed):
+	# 'monster_turn' is a turn as played, where the monsters far from the
+	# player are dormant and only the awake ones near it act;
+	# 'monster_turn_awake' wakes every monster first and keeps them awake,
+	# for what the AI costs when all of them act
+	setup_level(width, height, seed)
+	count = add_monsters(monsters, random.Random(seed))
+	results = [result('monster_turn', width, height, count, timed(prl.monster_turns, repeat))]
+
+	setup_level(width, height, seed)
+	count = add_monsters(monsters, random.Random(seed))
+	radii = (prl.ACTIVATION_RADIUS, prl.DORMANT_RADIUS)
+	(prl.ACTIVATION_RADIUS, prl.DORMANT_RADIUS) = (0, width + height)
+	try:
+		for obj in sorted((obj for obj in prl.objects if obj.ai), key=lambda obj: obj.slot):
+			prl.scheduler.wake(obj)
+		results.append(result('monster_turn_awake', width, height, count,
+			timed(prl.monster_turns, repeat)))
+	finally: (prl.ACTIVATION_RADIUS, prl.DORMANT_RADIUS) = radii
+	return results
+
+def shelve_save(path):
+	# How games were saved before the binary format, for comparison
+	with shelve.open(path, 'n') as legacy_file:
+		legacy_file['my_map'] = prl.my_map
+		legacy_file['objects'] = list(prl.objects)
+		legacy_file['player_index'] = list(prl.objects).index(prl.player)
+		legacy_file['inventory'] = prl.inventory
+		legacy_file['game_msgs'] = prl.game_msgs
+		legacy_file['game_state'] = prl.game_state
+
+def file_size(path):
+	# shelve may spread a database over several files next to path
+	directory = os.path.dirname(path)
+	return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+		if name.startswith(os.path.basename(path)))
+
+def bench_save(width, height, monsters, repeat, seed):
+	# The binary save format against the shelve one it replaced
+	setup_level(width, height, seed)
+	count = add_monsters(monsters, random.Random(seed))
+	directory = tempfile.mkdtemp(prefix='prl-bench-')
+	try:
+		results = []
+		for (name, save, load, path) in [
+				('save_shelve', shelve_save, prl.load_legacy_game, os.path.join(directory, 'shelve')),
+				('save_binary', prl.save_game, prl.load_game, os.path.join(directory, 'binary.sav'))]:
+			saved = result(name, width, height, count, timed(lambda: save(path), repeat))
+			saved['bytes'] = file_size(path)
+			loaded = result(name.replace('save', 'load'), width, height, count,
+				timed(lambda: load(path), repeat))
+			loaded['bytes'] = saved['bytes']
+			results += [saved, loaded]
+		return results
+	finally: shutil.rmtree(directory)
+
+def bench_levels(width, height, repeat, seed, depth=6):
+	# Down depth levels and back up again, with the level manager keeping
+	# what it's set to in memory - also reports its hit rate and how long
+	# loading an evicted level took
+	setup_level(width, height, seed)
+	prl.dungeon_levels.clear()
+
+	def stairs(char):
+		for obj in prl.objects:
+			if obj.char == char and not (obj.fighter or obj.item):
+				(prl.player.x, prl.player.y) = (obj.x, obj.y)
+				prl.object_index.update(prl.player)
+				prl.take_stairs(char)
+				return
+
+	def run():
+		for i in range(depth - 1): stairs(prl.DOWN_STAIRS)
+		for i in range(depth - 1): stairs(prl.UP_STAIRS)
+	entry = result('levels', width, height, 0, timed(run, repeat), 2 * (depth - 1))
+	stats = prl.dungeon_levels.stats()
+	entry['hit_rate'] = stats['hit_rate']
+	entry['load_median'] = stats['load_median']
+	prl.dungeon_levels.close()
+	return [entry]
+
+def bench_entity_memory(count, repeat):
+	# Time to make count orcs (object, fighter and AI), and the memory each
+	# one takes - 'bytes' is per orc here, with 'unslotted_bytes' the same
+	# before the entity classes had slots
+	def run():
+		orcs = [make_orc(i, i) for i in range(count)]
+	times = timed(run, repeat)
+
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		orcs = [make_orc(i, i) for i in range(count)]
+		used = tracemalloc.get_traced_memory()[0] - before
+	finally: tracemalloc.stop()
+	entry = result('entity_memory', 0, 0, count, times, count)
+	entry['bytes'] = used // count
+	entry['unslotted_bytes'] = UNSLOTTED_ORC_BYTES
+	return [entry]
+
+def run_all(sizes, monster_counts, repeat, seed):
+	results = bench_entity_memory(max(monster_counts), repeat)
+	for (width, height) in sizes:
+		results += bench_generate(width, height, repeat, seed)
+		results += bench_fov(width, height, repeat, seed)
+		results += bench_render(width, height, repeat, seed)
+		results += bench_levels(width, height, repeat, seed)
+		for monsters in monster_counts:
+			results += bench_movement(width, height, monsters, repeat, seed)
+			results += bench_monster_turn(width, height, monsters, repeat, seed)
+			results += bench_save(width, height, monsters, repeat, seed)
+	return results
+
+def key(entry):
+	return (entry['name'], entry['width'], entry['height'], entry['monsters'])
+
+def compare(results, baseline, threshold):
+	# Report each benchmark against the baseline, returning the regressions
+	old = dict((key(entry), entry) for entry in baseline['results'])
+	regressions = []
+	for entry in results:
+		previous = old.get(key(entry))
+		if previous is None: continue
+		change = entry['best'] / previous['best'] - 1.0
+		line = '%-13s %5dx%-5d %6d monsters  %10.6fs -> %10.6fs  %+6.1f%%' % (
+			entry['name'], entry['width'], entry['height'], entry['monsters'],
+			previous['best'], entry['best'], change * 100)
+		if 'bytes' in entry: line += '  %d bytes' % entry['bytes']
+		if 'unslotted_bytes' in entry: line += ' (%d without slots)' % entry['unslotted_bytes']
+		if change > threshold:
+			regressions.append(entry)
+			line += '  REGRESSION'
+		print(line, file=sys.stderr)
+	return regressions
+
+def parse_size(text):
+	(width, height) = text.lower().split('x')
+	return (int(width), int(height))
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the game logic and renderer.')
+	parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='map sizes, e.g. 80x43')
+	parser.add_argument('--monsters', nargs='+', type=int, default=DEFAULT_MONSTERS)
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', help='write the results to this file (default: stdout)')
+	parser.add_argument('--baseline', help='compare against results saved earlier')
+	parser.add_argument('--threshold', type=float, default=0.10,
+		help='slowdown that counts as a regression (0.10 = 10%%)')
+	args = parser.parse_args()
+
+	# The game prints combat to stdout - keep it out of the results
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		results = run_all([parse_size(size) for size in args.sizes], args.monsters,
+			args.repeat, args.seed)
+
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'seed': args.seed,
+		'results': results,
+	}
+
+	text = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, 'w') as output: output.write(text + '\n')
+	else: print(text)
+
+	if args.baseline:
+		with open(args.baseline) as baseline_file: baseline = json.load(baseline_file)
+		if compare(report['results'], baseline, args.threshold): sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+
+class LevelManager:
+	# The levels of the dungeon the player has left, for when they come back.
+	# The live most recently left are kept in memory just as they were; older
+	# ones are evicted to disk - pack(level) turns one into compressed bytes,
+	# and unpack(data) turns it back when the player returns. Files go in
+	# directory, or a temporary directory made when the first is written.
+	def __init__(self, pack, unpack, live=2, directory=None):
+		self.pack = pack
+		self.unpack = unpack
+		self.live = live
+		self.directory = directory
+		self.temporary = directory is None
+		self.levels = OrderedDict()		# depth -> level, least recently left first
+		self.files = {}					# depth -> file an evicted level is in
+
+		self.hits = 0			# Returns to a level still in memory
+		self.loads = 0			# ...and to one that had to be read back
+		self.evictions = 0
+		self.load_times = deque(maxlen=100)		# Seconds the recent loads took
+
+	def __len__(self):
+		return len(self.levels) + len(self.files)
+
+	def __contains__(self, depth):
+		return depth in self.levels or depth in self.files
+
+	def put(self, depth, level):
+		# The player has left the level at depth
+		self.levels[depth] = level
+		self.levels.move_to_end(depth)
+		while len(self.levels) > self.live:
+			(old_depth, old_level) = self.levels.popitem(last=False)
+			self.write(old_depth, self.pack(old_level))
+			self.evictions += 1
+
+	def take(self, depth):
+		# The level at depth, which the player is going back to and so is no
+		# longer kept here, or None if they've never been there
+		level = self.levels.pop(depth, None)
+		if level is not None:
+			self.hits += 1
+			return level
+
+		path = self.files.pop(depth, None)
+		if path is None: return None
+		start = time.perf_counter()
+		with open(path, 'rb') as level_file: data = level_file.read()
+		os.remove(path)
+		level = self.unpack(data)
+		self.load_times.append(time.perf_counter() - start)
+		self.loads += 1
+		return level
+
+	def write(self, depth, data):
+		if self.directory is None: self.directory = tempfile.mkdtemp(prefix='prl-levels-')
+		path = os.path.join(self.directory, 'level-%d.lvl' % depth)
+		with open(path, 'wb') as level_file: level_file.write(data)
+		self.files[depth] = path
+
+	def live_levels(self):
+		return list(self.levels.items())
+
+	def evicted_levels(self):
+		# (depth, packed level) for each level on disk
+		evicted = []
+		for (depth, path) in sorted(self.files.items()):
+			with open(path, 'rb') as level_file: evicted.append((depth, level_file.read()))
+		return evicted
+
+	def restore(self, depth, data):
+		# A packed level from a saved game - kept on disk until it's wanted
+		self.levels.pop(depth, None)
+		self.write(depth, data)
+
+	def clear(self):
+		for path in self.files.values():
+			if os.path.exists(path): os.remove(path)
+		self.levels.clear()
+		self.files.clear()
+
+	def close(self):
+		self.clear()
+		if self.temporary and self.directory is not None:
+			shutil.rmtree(self.directory, ignore_errors=True)
+			self.directory = None
+
+	def hit_rate(self):
+		# Of the returns to a level, how many found it still in memory
+		returns = self.hits + self.loads
+		return self.hits / returns if returns else 0.0
+
+	def stats(self):
+		times = sorted(self.load_times)
+		return {
+			'live': len(self.levels),
+			'on_disk': len(self.files),
+			'hits': self.hits,
+			'loads': self.loads,
+			'evictions': self.evictions,
+			'hit_rate': self.hit_rate(),
+			'load_median': times[len(times) // 2] if times else 0.0,
+			'load_max': times[-1] if times else 0.0,
+		}
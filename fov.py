@@ -0,0 +1,113 @@
+from collections import OrderedDict
+
+import numpy as np
+
+def fov_algorithm(name):
+	# Convert one of tdl's FOV names ('BASIC', 'SHADOW', 'PERMISSIVE4'...) to
+	# the matching libtcod constant, from tcod.constants rather than the
+	# deprecated aliases on tcod itself
+	import tcod.constants
+	name = name.upper()
+	if name.startswith('PERMISSIVE'):
+		name = 'PERMISSIVE_' + (name[len('PERMISSIVE'):].strip('_') or '8')
+	return getattr(tcod.constants, 'FOV_' + name)
+
+class Visibility:
+	# A field of view result - a bool [x, y] mask covering the part of the map
+	# that starts at (x, y). Everything outside the mask is not visible.
+	def __init__(self, mask, x=0, y=0):
+		self.mask = mask
+		self.x = x
+		self.y = y
+		(self.width, self.height) = mask.shape
+
+	def at(self, x, y):
+		x -= self.x
+		y -= self.y
+		return 0 <= x < self.width and 0 <= y < self.height and bool(self.mask[x, y])
+
+	def lookup(self, xs, ys):
+		# at() for arrays of positions
+		xs = np.asarray(xs) - self.x
+		ys = np.asarray(ys) - self.y
+		inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+		result = np.zeros(xs.shape, dtype=bool)
+		result[inside] = self.mask[xs[inside], ys[inside]]
+		return result
+
+	def region(self, x, y, width, height):
+		# The mask for a width x height rectangle of the map at (x, y)
+		result = np.zeros((width, height), dtype=bool, order='F')
+		x1 = max(x, self.x)
+		y1 = max(y, self.y)
+		x2 = min(x + width, self.x + self.width)
+		y2 = min(y + height, self.y + self.height)
+		if x1 < x2 and y1 < y2:
+			result[x1 - x:x2 - x, y1 - y:y2 - y] = self.mask[x1 - self.x:x2 - self.x,
+				y1 - self.y:y2 - self.y]
+		return result
+
+	def bounds(self):
+		# (x1, y1, x2, y2) of the area the mask covers, x2/y2 exclusive
+		return (self.x, self.y, self.x + self.width, self.y + self.height)
+
+class FovEngine:
+	# Field of view on a transparency array built once per map version, rather
+	# than a Python callback for every probed cell. With a radius, only the
+	# window of the map the torch can reach is looked at, so the cost doesn't
+	# grow with the map. Results are cached by position, radius and map
+	# version - redrawing without moving, or stepping back onto a recent tile,
+	# costs a dict lookup.
+	def __init__(self, algorithm='BASIC', light_walls=True, cache_size=64):
+		self.algorithm = algorithm
+		self.light_walls = light_walls
+		self.cache_size = cache_size
+
+		self.game_map = None
+		self.map_version = None
+		self.transparent = None
+		self.cache = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def clear(self):
+		self.game_map = None
+		self.transparent = None
+		self.cache.clear()
+
+	def transparency(self, game_map):
+		# Rebuild the transparency array only for a new map or a changed one
+		if game_map is not self.game_map or game_map.version != self.map_version:
+			if game_map is not self.game_map: self.cache.clear()
+			self.game_map = game_map
+			self.map_version = game_map.version
+			self.transparent = game_map.transparency()
+		return self.transparent
+
+	def compute(self, game_map, x, y, radius):
+		import tcod.map
+
+		transparent = self.transparency(game_map)
+		key = (x, y, radius, self.algorithm, self.light_walls, game_map.version)
+		visible = self.cache.get(key)
+		if visible is not None:
+			self.hits += 1
+			self.cache.move_to_end(key)
+			return visible
+
+		self.misses += 1
+		if radius:
+			x1 = max(0, x - radius)
+			y1 = max(0, y - radius)
+			x2 = min(game_map.width, x + radius + 1)
+			y2 = min(game_map.height, y + radius + 1)
+		else: (x1, y1, x2, y2) = (0, 0, game_map.width, game_map.height)
+
+		mask = tcod.map.compute_fov(transparent[x1:x2, y1:y2], (x - x1, y - y1), radius,
+			self.light_walls, fov_algorithm(self.algorithm))
+		mask.flags.writeable = False		# Shared with the cache
+		visible = Visibility(mask, x1, y1)
+
+		self.cache[key] = visible
+		if len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+		return visible
@@ -0,0 +1,47 @@
+import time
+
+class FrameLimiter:
+	# Decides when the game loop draws. A frame is drawn only when something
+	# has marked the screen as changed, or while an animation is running, and
+	# never more than fps times a second (0 for no cap). Between frames the
+	# loop blocks on input for timeout() seconds - None, when there's nothing
+	# to draw, means until an event comes - so an idle game uses no CPU.
+	def __init__(self, fps=30, clock=time.perf_counter):
+		self.fps = fps
+		self.clock = clock
+		self.dirty = True
+		self.animations = 0		# Animations running - each needs every frame
+		self.last = None		# When the last frame was drawn
+
+		self.frames = 0
+
+	def invalidate(self):
+		# Something on screen changed
+		self.dirty = True
+
+	def start_animation(self):
+		self.animations += 1
+
+	def stop_animation(self):
+		self.animations = max(0, self.animations - 1)
+
+	def wanted(self):
+		return self.dirty or self.animations > 0
+
+	def wait(self):
+		# Seconds until the next frame can be drawn
+		if not self.fps or self.last is None: return 0.0
+		return max(0.0, self.last + 1.0 / self.fps - self.clock())
+
+	def due(self):
+		return self.wanted() and self.wait() == 0.0
+
+	def drawn(self):
+		self.dirty = False
+		self.last = self.clock()
+		self.frames += 1
+
+	def timeout(self):
+		# How long to block on input before a frame is due
+		if not self.wanted(): return None
+		return self.wait()
@@ -0,0 +1,66 @@
+import numpy as np
+
+class GameMap:
+	# Map storage - one contiguous bool array per tile property instead of a
+	# Tile object per cell. Arrays are indexed [x, y], the same way the old
+	# my_map[x][y] lists were.
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+
+		# Default: every tile is blocked, and blocked tiles also block sight
+		self.blocked = np.ones((width, height), dtype=bool, order='F')
+		self.block_sight = np.ones((width, height), dtype=bool, order='F')
+		self.explored = np.zeros((width, height), dtype=bool, order='F')
+
+		# Bumped whenever blocked/block_sight change, so anything derived from
+		# them (FOV, pathing) knows when to rebuild
+		self.version = 0
+
+	def in_bounds(self, x, y):
+		return 0 <= x < self.width and 0 <= y < self.height
+
+	def is_blocked(self, x, y):
+		# Tile only - blocking objects are checked by the caller
+		return bool(self.blocked[x, y])
+
+	def is_transparent(self, x, y):
+		# Out of bounds, blocked and sight-blocking tiles can't be seen through
+		if not self.in_bounds(x, y): return False
+		return not (self.blocked[x, y] or self.block_sight[x, y])
+
+	def set_tile(self, x, y, blocked, block_sight=None):
+		if block_sight is None: block_sight = blocked
+		self.blocked[x, y] = blocked
+		self.block_sight[x, y] = block_sight
+		self.version += 1
+
+	def carve(self, x1, y1, x2, y2):
+		# Clear the inclusive rectangle (x1, y1)-(x2, y2) in one slice
+		self.blocked[x1:x2 + 1, y1:y2 + 1] = False
+		self.block_sight[x1:x2 + 1, y1:y2 + 1] = False
+		self.version += 1
+
+	def transparency(self):
+		# True wherever sight passes through - not blocked and not block_sight
+		return ~(self.blocked | self.block_sight)
+
+	def carve_room(self, room):
+		# The room's outer edge is left as wall
+		self.carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
+
+	def carve_h_tunnel(self, x1, x2, y):
+		self.carve(min(x1, x2), y, max(x1, x2), y)
+
+	def carve_v_tunnel(self, y1, y2, x):
+		self.carve(x, min(y1, y2), x, max(y1, y2))
+
+	@classmethod
+	def from_tiles(cls, tiles):
+		# Build a map from an old-style my_map[x][y] grid of Tile objects
+		game_map = cls(len(tiles), len(tiles[0]))
+		for x, column in enumerate(tiles):
+			game_map.blocked[x] = [tile.blocked for tile in column]
+			game_map.block_sight[x] = [tile.block_sight for tile in column]
+			game_map.explored[x] = [tile.explored for tile in column]
+		return game_map
@@ -0,0 +1,313 @@
+import numpy as np
+
+from gamemap import GameMap
+from world import Room
+
+# Map generation as a pipeline of stages. Each stage is a callable that
+# works on a Layout - the whole map as one bool array - with array
+# operations, adding rooms for the game to populate and possibly choosing
+# where the player starts. A Generator runs the stages in order, starting
+# again from scratch if one of them rejects the result.
+
+class GenerationError(Exception):
+	pass
+
+class Layout:
+	def __init__(self, width, height, rng):
+		self.width = width
+		self.height = height
+		self.rng = rng
+		self.floor = np.zeros((width, height), dtype=bool, order='F')
+		self.rooms = []			# Where monsters and items go, as Rooms
+		self.start = None		# The player's position
+
+	def carve(self, x1, y1, x2, y2):
+		# Open the inclusive rectangle (x1, y1)-(x2, y2), in either order
+		self.floor[min(x1, x2):max(x1, x2) + 1, min(y1, y2):max(y1, y2) + 1] = True
+
+	def carve_room(self, room):
+		# The room's outer edge is left as wall
+		self.carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
+
+	def carve_tunnel(self, x1, y1, x2, y2):
+		# An L-shaped tunnel, turning at a random end
+		if self.rng.randint(0, 1):
+			self.carve(x1, y1, x2, y1)
+			self.carve(x2, y1, x2, y2)
+		else:
+			self.carve(x1, y1, x1, y2)
+			self.carve(x1, y2, x2, y2)
+
+	def random_floor(self, mask=None):
+		cells = np.flatnonzero((self.floor if mask is None else mask).ravel(order='F'))
+		if not len(cells): raise GenerationError('no floor')
+		cell = int(cells[self.rng.randrange(len(cells))])
+		return (cell % self.width, cell // self.width)
+
+	def nearest_floor(self, room, x, y):
+		# The floor tile inside room (not on its edge) nearest (x, y), or None
+		# if it has none. Only the room stages carve their rooms out - see
+		# CellularCaves - so this, not centre(), is where to put things.
+		(x1, y1) = (room.x1 + 1, room.y1 + 1)
+		(xs, ys) = np.nonzero(self.floor[x1:room.x2, y1:room.y2])
+		if not len(xs): return None
+		nearest = np.argmin((xs + x1 - x) ** 2 + (ys + y1 - y) ** 2)
+		return (int(xs[nearest]) + x1, int(ys[nearest]) + y1)
+
+	def game_map(self):
+		game_map = GameMap(self.width, self.height)
+		game_map.blocked[...] = ~self.floor
+		game_map.block_sight[...] = ~self.floor
+		return game_map
+
+class Generator:
+	def __init__(self, stages, attempts=10):
+		self.stages = stages
+		self.attempts = attempts
+
+	def generate(self, width, height, rng):
+		for attempt in range(self.attempts):
+			layout = Layout(width, height, rng)
+			try:
+				for stage in self.stages: stage(layout)
+			except GenerationError: continue
+			return layout
+		raise GenerationError('no acceptable map in %d attempts' % self.attempts)
+
+def centre(room):
+	return ((room.x1 + room.x2) // 2, (room.y1 + room.y2) // 2)
+
+def label(passable):
+	# The 8-way connected regions of passable, as (labels, sizes): labels is
+	# 0 off passable and the region's number (from 1) on it, sizes[n] is the
+	# number of tiles in region n. Works on runs of tiles down each column,
+	# joining runs that touch in neighbouring columns.
+	(width, height) = passable.shape
+	padded = np.zeros((width, height + 2), dtype=np.int8)
+	padded[:, 1:-1] = passable
+	edges = np.diff(padded, axis=1)
+	(run_x, run_start) = np.nonzero(edges == 1)
+	run_end = np.nonzero(edges == -1)[1]
+	column = np.searchsorted(run_x, np.arange(width + 1))
+	(run_start, run_end) = (run_start.tolist(), run_end.tolist())
+
+	parent = list(range(len(run_start)))
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+
+	for x in range(1, width):
+		(i, i_end) = (int(column[x - 1]), int(column[x]))
+		(j, j_end) = (i_end, int(column[x + 1]))
+		while i < i_end and j < j_end:
+			# Runs [start, end) touch, diagonals included, unless one ends
+			# before the other starts
+			if run_start[i] <= run_end[j] and run_start[j] <= run_end[i]:
+				(a, b) = (find(i), find(j))
+				if a != b: parent[max(a, b)] = min(a, b)
+			if run_end[i] < run_end[j]: i += 1
+			else: j += 1
+
+	labels = np.zeros((width, height), dtype=np.int32, order='F')
+	numbers = {}
+	for (run, x) in enumerate(run_x.tolist()):
+		root = find(run)
+		number = numbers.get(root)
+		if number is None: number = numbers[root] = len(numbers) + 1
+		labels[x, run_start[run]:run_end[run]] = number
+	return (labels, np.bincount(labels.ravel(), minlength=len(numbers) + 1))
+
+# ----------------------------------------------------------------------
+# Stages
+# ----------------------------------------------------------------------
+
+class RandomRooms:
+	# Rooms dropped at random, skipping any that overlap one already placed,
+	# each joined to the one before by a tunnel
+	def __init__(self, max_rooms=30, min_size=6, max_size=10):
+		self.max_rooms = max_rooms
+		self.min_size = min_size
+		self.max_size = max_size
+
+	def __call__(self, layout):
+		rng = layout.rng
+		bounds = np.zeros((self.max_rooms, 4), dtype=np.int32)	# x1, y1, x2, y2
+		placed = 0
+		for r in range(self.max_rooms):
+			w = rng.randint(self.min_size, self.max_size)
+			h = rng.randint(self.min_size, self.max_size)
+			x = rng.randint(0, layout.width - w - 1)
+			y = rng.randint(0, layout.height - h - 1)
+			room = Room(x, y, x + w, y + h)
+
+			others = bounds[:placed]
+			if np.any((others[:, 0] <= room.x2) & (others[:, 2] >= room.x1) &
+					(others[:, 1] <= room.y2) & (others[:, 3] >= room.y1)):
+				continue
+
+			layout.carve_room(room)
+			if placed: layout.carve_tunnel(*(centre(layout.rooms[-1]) + centre(room)))
+			else: layout.start = layout.start or centre(room)
+			bounds[placed] = room
+			placed += 1
+			layout.rooms.append(room)
+
+class BspRooms:
+	# Binary space partition: the map is split in two, and the halves split
+	# again, until the pieces are too small; each piece gets a room, and the
+	# two halves of every split are joined by a tunnel
+	def __init__(self, min_size=6, max_size=10):
+		self.min_size = min_size
+		self.max_size = max_size
+
+	def __call__(self, layout):
+		rooms = self.split(layout, Room(0, 0, layout.width - 1, layout.height - 1))
+		if not layout.start: layout.start = centre(rooms[0])
+
+	def split(self, layout, area):
+		# Carve the rooms for area, returning them
+		rng = layout.rng
+		(w, h) = (area.x2 - area.x1, area.y2 - area.y1)
+		leaf = self.max_size + 2		# Big enough for the largest room
+		can_split_x = w >= 2 * leaf
+		can_split_y = h >= 2 * leaf
+		if can_split_x or can_split_y:
+			if can_split_x and (not can_split_y or w > h or (w == h and rng.randint(0, 1))):
+				at = rng.randint(area.x1 + leaf, area.x2 - leaf)
+				halves = (Room(area.x1, area.y1, at, area.y2), Room(at, area.y1, area.x2, area.y2))
+			else:
+				at = rng.randint(area.y1 + leaf, area.y2 - leaf)
+				halves = (Room(area.x1, area.y1, area.x2, at), Room(area.x1, at, area.x2, area.y2))
+			first = self.split(layout, halves[0])
+			second = self.split(layout, halves[1])
+			layout.carve_tunnel(*(centre(rng.choice(first)) + centre(rng.choice(second))))
+			return first + second
+
+		rw = rng.randint(min(self.min_size, w), min(self.max_size, w))
+		rh = rng.randint(min(self.min_size, h), min(self.max_size, h))
+		x = rng.randint(area.x1, area.x2 - rw)
+		y = rng.randint(area.y1, area.y2 - rh)
+		room = Room(x, y, x + rw, y + rh)
+		layout.carve_room(room)
+		layout.rooms.append(room)
+		return [room]
+
+def wall_neighbours(wall):
+	# How many of each tile's 8 neighbours are wall, counting off the map as
+	# wall - a 3x3 convolution done as a sum of shifted slices
+	padded = np.pad(wall, 1, constant_values=True).astype(np.uint8)
+	(width, height) = wall.shape
+	count = np.zeros((width, height), dtype=np.uint8)
+	for dx in (0, 1, 2):
+		for dy in (0, 1, 2):
+			if dx != 1 or dy != 1: count += padded[dx:dx + width, dy:dy + height]
+	return count
+
+class CellularCaves:
+	# Caves grown from noise: each round, a wall stays a wall with at least
+	# survive wall neighbours, and floor becomes wall with at least birth.
+	# The caves are added to whatever is already open. With populate, the
+	# caves are divided into room_size squares for monsters and items. Those
+	# rooms aren't carved: they're whatever the caves left inside each
+	# square, so their centre and corners can be wall.
+	def __init__(self, fill=0.45, iterations=4, birth=5, survive=4, populate=True, room_size=10):
+		self.fill = fill
+		self.iterations = iterations
+		self.birth = birth
+		self.survive = survive
+		self.populate = populate
+		self.room_size = room_size
+
+	def __call__(self, layout):
+		noise = np.random.default_rng(layout.rng.getrandbits(64))
+		wall = noise.random((layout.width, layout.height)) < self.fill
+		for i in range(self.iterations):
+			count = wall_neighbours(wall)
+			wall = np.where(wall, count >= self.survive, count >= self.birth)
+		# Keep the edge of the map solid
+		wall[0, :] = wall[-1, :] = True
+		wall[:, 0] = wall[:, -1] = True
+		layout.floor |= ~wall
+
+		if self.populate:
+			size = self.room_size
+			for x in range(0, layout.width - 1, size):
+				for y in range(0, layout.height - 1, size):
+					if (~wall[x:x + size, y:y + size]).any():
+						layout.rooms.append(Room(x - 1, y - 1,
+							min(x + size, layout.width - 1), min(y + size, layout.height - 1)))
+
+class Corridors:
+	# Join every open region of at least min_size tiles to the main one (the
+	# one holding the start, or else the largest) with a tunnel between
+	# nearby tiles of the two. Smaller pockets are left for Validate.
+	def __init__(self, min_size=8):
+		self.min_size = min_size
+
+	def __call__(self, layout):
+		(labels, sizes) = label(layout.floor)
+		if len(sizes) < 3: return
+		if layout.start: main = labels[layout.start]
+		else: main = int(np.argmax(sizes[1:])) + 1
+
+		# The tiles of every region at once: tile numbers sorted by region
+		flat = labels.ravel(order='F')
+		tiles = np.argsort(flat, kind='stable')
+		first = np.concatenate([[0], np.cumsum(sizes)])
+		def region_tiles(region):
+			cells = tiles[first[region]:first[region + 1]]
+			return (cells % layout.width, cells // layout.width)
+
+		(joined_x, joined_y) = region_tiles(main)
+		for region in np.argsort(-sizes[1:]) + 1:
+			if region == main or sizes[region] < self.min_size: continue
+			(xs, ys) = region_tiles(region)
+			start = layout.rng.randrange(len(xs))
+			nearest = np.argmin((joined_x - xs[start]) ** 2 + (joined_y - ys[start]) ** 2)
+			(bx, by) = (int(joined_x[nearest]), int(joined_y[nearest]))
+			nearest = np.argmin((xs - bx) ** 2 + (ys - by) ** 2)
+			layout.carve_tunnel(int(xs[nearest]), int(ys[nearest]), bx, by)
+			joined_x = np.concatenate([joined_x, xs])
+			joined_y = np.concatenate([joined_y, ys])
+
+class Validate:
+	# Check the map can be played: everything open must be reachable from
+	# the start (picked at random if no stage chose one) and at least
+	# min_floor of the map open. Unreachable pockets are filled in if
+	# fill_unreachable, otherwise they reject the map; rooms left with no
+	# floor are dropped.
+	def __init__(self, min_floor=0.05, fill_unreachable=True):
+		self.min_floor = min_floor
+		self.fill_unreachable = fill_unreachable
+
+	def __call__(self, layout):
+		(labels, sizes) = label(layout.floor)
+		if len(sizes) < 2: raise GenerationError('no floor')
+		if layout.start is None:
+			region = int(np.argmax(sizes[1:])) + 1
+			layout.start = layout.random_floor(labels == region)
+		reachable = labels == labels[layout.start]
+
+		if (layout.floor & ~reachable).any():
+			if not self.fill_unreachable: raise GenerationError('unreachable floor')
+			layout.floor &= reachable
+		if reachable.sum() < self.min_floor * layout.width * layout.height:
+			raise GenerationError('too little floor')
+
+		layout.rooms = [room for room in layout.rooms if
+			layout.floor[room.x1 + 1:room.x2, room.y1 + 1:room.y2].any()]
+
+PIPELINES = ('rooms', 'bsp', 'caves', 'mixed')
+
+def pipeline(name, max_rooms=30, min_size=6, max_size=10):
+	# One of the standard generators, by name
+	if name == 'rooms': stages = [RandomRooms(max_rooms, min_size, max_size), Validate()]
+	elif name == 'bsp': stages = [BspRooms(min_size, max_size), Validate()]
+	elif name == 'caves': stages = [CellularCaves(), Corridors(), Validate(min_floor=0.2)]
+	elif name == 'mixed':
+		stages = [BspRooms(min_size, max_size), CellularCaves(fill=0.55, populate=False),
+			Corridors(), Validate()]
+	else: raise ValueError('unknown map generator %r' % name)
+	return Generator(stages)
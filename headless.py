@@ -0,0 +1,173 @@
+# Headless simulation - runs the game logic with no tdl window, against null
+# consoles and a pluggable input source, and reports turns per second.
+#
+#	python headless.py --turns 10000 --seed 1 --input random
+import argparse
+import random
+import time
+
+import prl
+
+MOVE_KEYS = ['UP', 'DOWN', 'LEFT', 'RIGHT']
+
+class KeyEvent:
+	# Stand-in for a tdl KEYDOWN event
+	type = 'KEYDOWN'
+
+	def __init__(self, key='TEXT', text='', alt=False):
+		self.key = key
+		self.text = text
+		self.char = text
+		self.alt = alt
+
+def key_event(name):
+	# 'UP', 'ESCAPE'... are special keys, anything else is typed text
+	if name.isupper(): return KeyEvent(name)
+	return KeyEvent('TEXT', name)
+
+class NullConsole:
+	# Accepts every tdl console call and draws nothing
+	def __init__(self, width=0, height=0):
+		self.width = width
+		self.height = height
+
+	def draw_char(self, *args, **kwargs): pass
+	def draw_str(self, *args, **kwargs): pass
+	def draw_rect(self, *args, **kwargs): pass
+	def clear(self, *args, **kwargs): pass
+	def blit(self, *args, **kwargs): pass
+
+class ScriptedInput:
+	# Plays back a fixed list of key names, one per turn, then closes
+	def __init__(self, keys):
+		self.keys = list(keys)
+		self.position = 0
+
+	def next_key(self):
+		key = self.keys[self.position]
+		self.position += 1
+		return key_event(key)
+
+	def get(self):
+		if self.is_window_closed(): return []
+		return [self.next_key()]
+
+	def wait(self, timeout=None):
+		# There's always a key ready, so this never blocks
+		return self.get()
+
+	def wait_key(self):
+		if self.is_window_closed(): return KeyEvent('ESCAPE')
+		return self.next_key()
+
+	def is_window_closed(self):
+		return self.position >= len(self.keys)
+
+class RandomWalkInput:
+	# Random movement, picking up whatever is underfoot now and then. Menus
+	# are always dismissed.
+	def __init__(self, turns, rng=None, pick_up_chance=0.05):
+		self.turns = turns
+		self.rng = rng or random.Random()
+		self.pick_up_chance = pick_up_chance
+		self.count = 0
+
+	def get(self):
+		if self.is_window_closed(): return []
+		self.count += 1
+		if self.rng.random() < self.pick_up_chance: return [key_event('g')]
+		return [key_event(self.rng.choice(MOVE_KEYS))]
+
+	def wait(self, timeout=None):
+		return self.get()
+
+	def wait_key(self):
+		return KeyEvent('ESCAPE')
+
+	def is_window_closed(self):
+		return self.count >= self.turns
+
+def setup(input_source):
+	# Point the game at null consoles and the given input instead of tdl
+	prl.headless = True
+	prl.PREGENERATE_LEVELS = 0		# Keep runs to the one process
+	prl.make_console = NullConsole
+	prl.input_source = input_source
+	prl.root = NullConsole(prl.SCREEN_WIDTH, prl.SCREEN_HEIGHT)
+	prl.con = NullConsole(prl.SCREEN_WIDTH, prl.SCREEN_HEIGHT)
+	prl.panel = NullConsole(prl.SCREEN_WIDTH, prl.PANEL_HEIGHT)
+
+def run(input_source, seed=None, render=False, god=False, journal_path=None):
+	# Play one game to the end of the input (or the player's death) and
+	# return some statistics about it. god keeps the player alive, for
+	# measuring throughput over long runs. With a journal_path the game is
+	# recorded there, to be replayed by replay.py.
+	setup(input_source)
+	random.seed(seed)
+
+	prl.new_game(seed)
+	if god: prl.player.fighter.hp = prl.player.fighter.max_hp = 10 ** 9
+	if journal_path: prl.start_journal(journal_path, god=god)
+	prl.mouse_coord = (0, 0)
+	prl.fov_recompute = True
+
+	turns = 0
+	start = time.perf_counter()
+	while not input_source.is_window_closed() and prl.game_state == 'playing':
+		# Each turn counts as a frame for the profiler, when it's on
+		if prl.profiler.enabled: prl.profiler.end_frame()
+		if render: prl.render_all()
+		else: prl.update_fov()
+
+		events = prl.input_source.get()
+		player_action = prl.handle_keys(events)
+		if player_action == 'exit': break
+
+		if prl.game_state == 'playing' and player_action != 'didnt-take-turn':
+			prl.monster_turns()
+		prl.record_turn(events)
+		turns += 1
+	elapsed = time.perf_counter() - start
+	prl.stop_journal()
+
+	return {
+		'turns': turns,
+		'seconds': elapsed,
+		'turns_per_second': turns / elapsed if elapsed else 0.0,
+		'game_state': prl.game_state,
+		'objects': len(prl.objects),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='Run the game without a window.')
+	parser.add_argument('--turns', type=int, default=1000)
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--input', choices=['random', 'script'], default='random')
+	parser.add_argument('--script', default='', help='comma separated keys, e.g. UP,UP,g,LEFT')
+	parser.add_argument('--render', action='store_true', help='also run render_all each turn')
+	parser.add_argument('--god', action='store_true', help='the player cannot die')
+	parser.add_argument('--record', metavar='JOURNAL',
+		help='record the game to JOURNAL, to be replayed by replay.py')
+	parser.add_argument('--profile', action='store_true',
+		help='time the phases of each turn and write %s and %s' % (prl.PROFILE_CSV,
+		prl.PROFILE_STACKS))
+	args = parser.parse_args()
+
+	if args.input == 'script': input_source = ScriptedInput(args.script.split(','))
+	else: input_source = RandomWalkInput(args.turns, random.Random(args.seed))
+
+	if args.profile: prl.start_profiling()
+	stats = run(input_source, args.seed, args.render, args.god, args.record)
+	print('%d turns in %.3fs - %.1f turns/second (%s)' % (stats['turns'],
+		stats['seconds'], stats['turns_per_second'], stats['game_state']))
+
+	if args.profile:
+		prl.stop_profiling()
+		print('turn time p50 %.3fms, p95 %.3fms, p99 %.3fms' %
+			tuple(value * 1000 for value in prl.profiler.frame_percentiles()))
+		for (name, calls, total, self_time, p50, p95, p99) in prl.profiler.summary():
+			print('%-34s %8d calls %9.1fms total %9.1fms self  p95 %.3fms' % (name, calls,
+				total * 1000, self_time * 1000, p95 * 1000))
+
+if __name__ == '__main__':
+	main()
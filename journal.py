@@ -0,0 +1,128 @@
+# Input journals - a game's seed and settings, then every input event the
+# game was handed and a checksum of its state after each batch of them, so
+# that a session can be played again exactly, without a window (replay.py).
+#
+# A journal is JSON lines: a header object, then one array per entry:
+#	["events", [event, ...]]	what get() or wait() returned
+#	["key", event]				what wait_key() returned
+#	["check", checksum]			the game's state after handling some events
+# Events are objects holding the attributes tdl events have that are set.
+import json
+
+FORMAT = 1
+
+EVENT_FIELDS = ('type', 'key', 'char', 'text', 'keychar', 'alt', 'ctrl', 'shift', 'button',
+	'cell', 'pos')
+
+class JournalError(Exception):
+	pass
+
+class Event:
+	# An event read back from a journal
+	def __init__(self, fields):
+		for (name, value) in fields.items():
+			setattr(self, name, tuple(value) if isinstance(value, list) else value)
+
+	def __getattr__(self, name):
+		# Anything the recorded event didn't have
+		if name in EVENT_FIELDS: return None
+		raise AttributeError(name)
+
+def event_fields(event):
+	fields = {}
+	for name in EVENT_FIELDS:
+		value = getattr(event, name, None)
+		if value is not None: fields[name] = list(value) if isinstance(value, tuple) else value
+	return fields
+
+class Journal:
+	# Writes a journal to path. header is anything else replaying needs.
+	def __init__(self, path, seed, settings, **header):
+		self.path = path
+		self.file = open(path, 'w')
+		self.write(dict(header, journal=FORMAT, seed=seed, settings=settings))
+		self.checks = 0
+
+	def write(self, entry):
+		self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+	def events(self, events):
+		events = list(events)
+		if events: self.write(['events', [event_fields(event) for event in events]])
+		return events
+
+	def key(self, event):
+		self.write(['key', event_fields(event)])
+
+	def check(self, checksum):
+		# Written through, so a journal survives the game crashing
+		self.write(['check', checksum])
+		self.file.flush()
+		self.checks += 1
+
+	def close(self):
+		self.file.close()
+
+class RecordingInput:
+	# Input from source, with everything it hands out written to journal
+	def __init__(self, source, journal):
+		self.source = source
+		self.journal = journal
+
+	def get(self):
+		return self.journal.events(self.source.get())
+
+	def wait(self, timeout=None):
+		return self.journal.events(self.source.wait(timeout))
+
+	def wait_key(self):
+		event = self.source.wait_key()
+		self.journal.key(event)
+		return event
+
+	def is_window_closed(self):
+		return self.source.is_window_closed()
+
+def read(path):
+	# (header, entries) from the journal at path
+	with open(path) as journal_file:
+		header = json.loads(journal_file.readline())
+		if header.get('journal') != FORMAT:
+			raise JournalError('%s is not a journal this version can replay' % path)
+		return (header, [json.loads(line) for line in journal_file if line.strip()])
+
+class ReplayInput:
+	# Hands out a journal's events in the order they were recorded. Asking
+	# for input of a different kind than was recorded next means the game
+	# has gone its own way, and raises JournalError.
+	def __init__(self, entries):
+		self.entries = entries
+		self.position = 0
+
+	def next(self, kind):
+		if self.position >= len(self.entries):
+			raise JournalError('the journal ended while the game wanted %s' % kind)
+		(entry_kind, value) = self.entries[self.position]
+		if entry_kind != kind:
+			raise JournalError('entry %d: the game wanted %s, the journal has %s' % (
+				self.position, kind, entry_kind))
+		self.position += 1
+		return value
+
+	def get(self):
+		# Past the end raises JournalError too - a recording that stops mid
+		# turn (the game crashed, or its window closed while targeting) would
+		# otherwise leave the game waiting for input forever
+		return [Event(fields) for fields in self.next('events')]
+
+	def wait(self, timeout=None):
+		return self.get()
+
+	def wait_key(self):
+		return Event(self.next('key'))
+
+	def check(self):
+		return self.next('check')
+
+	def is_window_closed(self):
+		return self.position >= len(self.entries)
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+class LevelCache:
+	# Levels generated ahead of time in a pool of worker processes, so that
+	# they're ready by the time they're wanted. generate(*args) runs in a
+	# worker, so it must be a module-level function and return something
+	# picklable; args is also the cache key. At most size levels are kept -
+	# asking for more pushes out the oldest, cancelling it if it hasn't
+	# started yet.
+	def __init__(self, generate, workers=2, size=4):
+		self.generate = generate
+		self.workers = workers
+		self.size = size
+		self.pool = None
+		self.levels = OrderedDict()		# args -> Future
+
+		self.hits = 0
+		self.misses = 0
+
+	def prefetch(self, *args):
+		if args in self.levels:
+			self.levels.move_to_end(args)
+			return
+		if self.pool is None:
+			# Imported here, as a game that never looks ahead doesn't need them
+			import multiprocessing
+			from concurrent.futures import ProcessPoolExecutor
+
+			# Workers are spawned rather than forked, so they don't inherit
+			# the window
+			self.pool = ProcessPoolExecutor(self.workers,
+				mp_context=multiprocessing.get_context('spawn'))
+		self.levels[args] = self.pool.submit(self.generate, *args)
+
+		while len(self.levels) > self.size:
+			(old_args, future) = self.levels.popitem(last=False)
+			future.cancel()
+
+	def get(self, *args):
+		# The level for args, or None if it wasn't asked for in time (or
+		# generating it failed) and the caller has to make it itself. A level
+		# still being generated is waited for - it's further along than
+		# starting again would be.
+		future = self.levels.pop(args, None)
+		if future is None or future.cancelled():
+			self.misses += 1
+			return None
+		try: level = future.result()
+		except Exception:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return level
+
+	def clear(self):
+		for future in self.levels.values(): future.cancel()
+		self.levels.clear()
+
+	def shutdown(self):
+		self.clear()
+		if self.pool is not None:
+			self.pool.shutdown(wait=False, cancel_futures=True)
+			self.pool = None
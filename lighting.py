@@ -0,0 +1,96 @@
+# Light falling on the map, as an [x, y] array of RGB levels from 0 (no
+# light) to 1 (fully lit). Each light shines on the tiles it can see, fading
+# with distance to nothing just past its radius. Static lights - the ones
+# that never move - are baked into one array for the whole map, once per
+# map version; each dynamic light's contribution is kept until it moves or
+# changes, so a frame only pays for the lights that did.
+import numpy as np
+
+class Light:
+	__slots__ = ('x', 'y', 'radius', 'colour', 'intensity')
+
+	def __init__(self, x, y, radius, colour, intensity=1.0):
+		self.x = x
+		self.y = y
+		self.radius = radius
+		self.colour = colour
+		self.intensity = intensity
+
+	def key(self, game_map):
+		# Everything its contribution depends on
+		return (self.x, self.y, self.radius, tuple(self.colour), self.intensity, game_map.version)
+
+class LightMap:
+	# fov_engine finds what each light can see. ambient is the light level
+	# everywhere, lit or not.
+	def __init__(self, fov_engine, ambient=(0, 0, 0)):
+		self.fov_engine = fov_engine
+		self.ambient = np.array(ambient, dtype=np.float32) / 255
+		self.game_map = None
+		self.map_version = None
+		self.static = None				# The baked static lights, [x, y, rgb]
+		self.dynamic = {}				# Light key -> (x1, y1, contribution)
+		self.current = []				# Keys of this frame's dynamic lights
+
+		self.bakes = 0
+		self.recomputes = 0
+
+	def contribution(self, game_map, light):
+		# (x1, y1, levels) for a light - levels covers the part of the map
+		# from (x1, y1) that the light reaches
+		visible = self.fov_engine.compute(game_map, light.x, light.y, light.radius)
+		(x1, y1, x2, y2) = visible.bounds()
+		(xs, ys) = np.ogrid[x1 - light.x:x2 - light.x, y1 - light.y:y2 - light.y]
+		falloff = np.clip(1 - np.sqrt(xs ** 2 + ys ** 2) / (light.radius + 1), 0, 1)
+		strength = np.where(visible.mask, falloff * light.intensity, 0).astype(np.float32)
+		colour = np.array(light.colour, dtype=np.float32) / 255
+		return (x1, y1, strength[:, :, None] * colour)
+
+	def baked(self, game_map):
+		return game_map is self.game_map and game_map.version == self.map_version
+
+	def bake(self, game_map, lights):
+		# Sum the static lights for a map. The dynamic lights are forgotten,
+		# as they were for another map.
+		self.static = np.zeros((game_map.width, game_map.height, 3), dtype=np.float32, order='F')
+		for light in lights:
+			(x1, y1, levels) = self.contribution(game_map, light)
+			(width, height) = levels.shape[:2]
+			self.static[x1:x1 + width, y1:y1 + height] += levels
+		self.game_map = game_map
+		self.map_version = game_map.version
+		self.dynamic.clear()
+		self.bakes += 1
+
+	def move(self, lights):
+		# This frame's dynamic lights. Those that haven't changed since the
+		# last frame keep their contribution; the rest are recomputed, and
+		# any that are gone are dropped.
+		game_map = self.game_map
+		dynamic = {}
+		self.current = []
+		for light in lights:
+			key = light.key(game_map)
+			found = self.dynamic.get(key) or dynamic.get(key)
+			if found is None:
+				found = self.contribution(game_map, light)
+				self.recomputes += 1
+			dynamic[key] = found
+			self.current.append(key)
+		self.dynamic = dynamic
+
+	def region(self, x, y, width, height):
+		# The light levels for a width x height rectangle of the map at
+		# (x, y), all the lights added together
+		levels = self.static[x:x + width, y:y + height] + self.ambient
+		for key in self.current:
+			(x1, y1, contribution) = self.dynamic[key]
+			(light_width, light_height) = contribution.shape[:2]
+			ax = max(x, x1)
+			ay = max(y, y1)
+			bx = min(x + width, x1 + light_width)
+			by = min(y + height, y1 + light_height)
+			if ax < bx and ay < by:
+				levels[ax - x:bx - x, ay - y:by - y] += contribution[ax - x1:bx - x1,
+					ay - y1:by - y1]
+		return np.minimum(levels, 1, out=levels)
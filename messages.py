@@ -0,0 +1,71 @@
+import textwrap
+
+class Message:
+	__slots__ = ('text', 'colour', 'count', 'wrapped')
+
+	def __init__(self, text, colour, count=1):
+		self.text = text
+		self.colour = colour
+		self.count = count		# Times in a row it was said
+		self.wrapped = {}		# width -> its lines at that width
+
+	def lines(self, width):
+		lines = self.wrapped.get(width)
+		if lines is None:
+			text = self.text if self.count == 1 else '%s x%d' % (self.text, self.count)
+			lines = self.wrapped[width] = textwrap.wrap(text, width) or ['']
+		return lines
+
+class MessageLog:
+	# The last capacity messages, in a ring buffer so that memory stays fixed
+	# and adding one never shifts the rest. A message said again straight
+	# after itself bumps a count ("x3") instead of taking another entry.
+	# Messages are only wrapped when they're shown, once for each width.
+	def __init__(self, capacity=2000):
+		self.capacity = capacity
+		self.entries = [None] * capacity
+		self.next = 0			# Where the next message goes
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def newest(self):
+		# From the latest message back
+		for i in range(self.size):
+			yield self.entries[(self.next - 1 - i) % self.capacity]
+
+	def __iter__(self):
+		# Oldest first
+		for i in range(self.size - 1, -1, -1):
+			yield self.entries[(self.next - 1 - i) % self.capacity]
+
+	def add(self, text, colour, count=1):
+		if self.size:
+			last = self.entries[(self.next - 1) % self.capacity]
+			if last.text == text and last.colour == colour:
+				last.count += count
+				last.wrapped.clear()
+				return
+		self.entries[self.next] = Message(text, colour, count)
+		self.next = (self.next + 1) % self.capacity
+		self.size = min(self.size + 1, self.capacity)
+
+	def clear(self):
+		self.entries = [None] * self.capacity
+		self.next = self.size = 0
+
+	def lines(self, width, height, offset=0):
+		# The (line, colour) pairs filling height rows at width, ending offset
+		# lines up from the bottom - only the messages in view are wrapped
+		wanted = height + offset
+		shown = []
+		for message in self.newest():
+			lines = message.lines(width)
+			shown.extend((line, message.colour) for line in reversed(lines))
+			if len(shown) >= wanted: break
+		shown.reverse()
+		return shown[max(0, len(shown) - wanted):max(0, len(shown) - offset)]
+
+	def line_count(self, width):
+		return sum(len(message.lines(width)) for message in self)
@@ -0,0 +1,48 @@
+# Render layers, drawn bottom to top
+CORPSES	= 0
+ITEMS	= 1
+ACTORS	= 2
+LAYERS	= (CORPSES, ITEMS, ACTORS)
+
+def layer_of(obj):
+	# Where an object belongs by what it is now
+	if obj.fighter: return ACTORS
+	if obj.item: return ITEMS
+	return CORPSES
+
+class ObjectStore:
+	# The objects on a level, kept in render layers rather than by position in
+	# a list. Each layer is a dict used as an ordered set, so adding, removing
+	# and moving an object to another layer are all O(1), and iterating goes
+	# through the layers bottom to top, each in the order objects were added.
+	def __init__(self, objects=()):
+		self.layers = [{} for layer in LAYERS]
+		self.layer = {}		# object -> its layer
+		for obj in objects: self.add(obj)
+
+	def __len__(self):
+		return len(self.layer)
+
+	def __contains__(self, obj):
+		return obj in self.layer
+
+	def __iter__(self):
+		for layer in self.layers: yield from layer
+
+	def add(self, obj, layer=None):
+		if layer is None: layer = layer_of(obj)
+		self.layers[layer][obj] = None
+		self.layer[obj] = layer
+
+	def remove(self, obj):
+		del self.layers[self.layer.pop(obj)][obj]
+
+	def move(self, obj, layer=None):
+		# Put obj on top of layer - by default, the one it now belongs in
+		if layer is None: layer = layer_of(obj)
+		del self.layers[self.layer[obj]][obj]
+		self.layers[layer][obj] = None
+		self.layer[obj] = layer
+
+	def in_layer(self, layer):
+		return list(self.layers[layer])
@@ -0,0 +1,116 @@
+import numpy as np
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+# Offsets of the 8 neighbours of a tile
+NEIGHBOURS = np.array([(-1, -1), (0, -1), (1, -1), (-1, 0),
+	(1, 0), (-1, 1), (0, 1), (1, 1)], dtype=np.int32)
+
+class FlowField:
+	# Dijkstra/distance map from a single goal (the player), shared by every
+	# monster: each one just steps to a neighbour with a smaller distance.
+	# Moves are 8-way and all cost 1, so the map is a breadth-first wavefront,
+	# grown with array shifts over a window of max_distance around the goal.
+	# It is only rebuilt when the goal moves or the map's walls change -
+	# monsters are not part of it, they are stepped around when moving.
+	def __init__(self, max_distance=20):
+		self.max_distance = max_distance
+		self.game_map = None
+		self.key = None
+		self.origin = (0, 0)		# Map position of distance[0, 0]
+		self.distance = np.zeros((0, 0), dtype=np.int32)
+		self.goal = (0, 0)
+		self.recomputes = 0
+
+	def update(self, game_map, x, y):
+		# Rebuild for a new goal position or map version; returns whether it did
+		key = (x, y, game_map.version)
+		if game_map is self.game_map and key == self.key: return False
+		self.game_map = game_map
+		self.key = key
+		self.compute(game_map, x, y)
+		return True
+
+	def compute(self, game_map, x, y):
+		r = self.max_distance
+		x1 = max(0, x - r)
+		y1 = max(0, y - r)
+		x2 = min(game_map.width, x + r + 1)
+		y2 = min(game_map.height, y + r + 1)
+		passable = ~game_map.blocked[x1:x2, y1:y2]
+
+		distance = np.full(passable.shape, UNREACHABLE, dtype=np.int32)
+		frontier = np.zeros(passable.shape, dtype=bool)
+		frontier[x - x1, y - y1] = True
+		distance[frontier] = 0
+		reached = frontier.copy()
+
+		for step in range(1, r + 1):
+			# Everything one move away from the current frontier
+			grown = frontier.copy()
+			grown[1:, :] |= frontier[:-1, :]
+			grown[:-1, :] |= frontier[1:, :]
+			grown[:, 1:] |= grown[:, :-1].copy()
+			grown[:, :-1] |= grown[:, 1:].copy()
+
+			frontier = grown & passable & ~reached
+			if not frontier.any(): break
+			distance[frontier] = step
+			reached |= frontier
+
+		self.origin = (x1, y1)
+		self.goal = (x, y)
+		self.distance = distance
+		self.recomputes += 1
+
+	def distance_at(self, xs, ys):
+		# Distances for arrays of map positions; UNREACHABLE outside the window
+		xs = np.asarray(xs) - self.origin[0]
+		ys = np.asarray(ys) - self.origin[1]
+		(width, height) = self.distance.shape
+		inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+		result = np.full(xs.shape, UNREACHABLE, dtype=np.int32)
+		result[inside] = self.distance[xs[inside], ys[inside]]
+		return result
+
+	def candidates(self, xs, ys):
+		# For each position, its downhill neighbours best first - lowest
+		# distance, then nearest the goal in a straight line. Returns
+		# (cell_x, cell_y, valid), each shaped (positions, 8).
+		xs = np.asarray(xs, dtype=np.int32)
+		ys = np.asarray(ys, dtype=np.int32)
+		cell_x = xs[:, None] + NEIGHBOURS[:, 0]
+		cell_y = ys[:, None] + NEIGHBOURS[:, 1]
+
+		near = self.distance_at(cell_x, cell_y).astype(np.int64)
+		valid = near < self.distance_at(xs, ys)[:, None]
+		straight = (cell_x - self.goal[0]) ** 2 + (cell_y - self.goal[1]) ** 2
+		preference = np.where(valid, near * 1000000 + straight, np.iinfo(np.int64).max)
+
+		order = np.argsort(preference, axis=1, kind='stable')
+		return (np.take_along_axis(cell_x, order, axis=1),
+			np.take_along_axis(cell_y, order, axis=1),
+			np.take_along_axis(valid, order, axis=1))
+
+	def steps(self, x, y):
+		# Downhill cells from a single position, best first. Plain Python -
+		# for one monster that's quicker than going through candidates()
+		distance = self.distance
+		(width, height) = distance.shape
+		(ox, oy) = self.origin
+		(gx, gy) = self.goal
+
+		def at(cx, cy):
+			cx -= ox
+			cy -= oy
+			if 0 <= cx < width and 0 <= cy < height: return int(distance[cx, cy])
+			return UNREACHABLE
+
+		here = at(x, y)
+		found = []
+		for (dx, dy) in NEIGHBOURS.tolist():
+			near = at(x + dx, y + dy)
+			if near < here:
+				found.append((near, (x + dx - gx) ** 2 + (y + dy - gy) ** 2, x + dx, y + dy))
+		found.sort()
+		return [(cx, cy) for (near, straight, cx, cy) in found]
@@ -1,9 +1,38 @@
-import tdl
+import time
+startup_times = [('start', time.perf_counter())]	# Startup steps, until the first frame
+
+import argparse
+import hashlib
+import random
 from random import randint
 import tcod.color as colours
 import math
+import os
+import sys
 import textwrap
-from tcod import image_load
+import numpy as np
+import assets
+from gamemap import GameMap
+from world import ChunkedWorld
+from spatial import SpatialIndex
+from render import MapRenderer, Palette
+from fov import FovEngine
+from lighting import Light, LightMap
+from pathfinding import FlowField
+from actors import ActorStore, StoreField, Slotted, BATCHED_AI, detached_state, restore_state
+from objectstore import ObjectStore, CORPSES
+from scheduler import Scheduler, NORMAL_SPEED
+import savefile
+from autosave import Autosaver
+from frames import FrameLimiter
+from messages import MessageLog
+from profiler import Profiler
+from journal import Journal, RecordingInput
+from levels import LevelCache
+from dungeon import LevelManager
+import generation
+
+startup_times.append(('imports', time.perf_counter()))
 
 # Actual size of window
 SCREEN_WIDTH		= 80
@@ -13,6 +42,19 @@ SCREEN_HEIGHT		= 50
 MAP_WIDTH			= 80
 MAP_HEIGHT			= 43
 
+# Size of the part of the map shown on screen
+CAMERA_WIDTH		= SCREEN_WIDTH
+CAMERA_HEIGHT		= 43
+
+# Chunked worlds - a map far bigger than the screen, generated as the player
+# explores it, with the chunks furthest away kept on disk instead of in memory
+LARGE_WORLD			= False
+WORLD_WIDTH			= 4096
+WORLD_HEIGHT		= 4096
+CHUNK_SIZE			= 32
+MAX_CHUNKS			= 64		# Chunks kept in memory
+WORLD_CACHE_DIR		= None		# Where evicted chunks go - a temp dir, removed after, if None
+
 # GUI sizes and co-ordinates
 BAR_WIDTH			= 20
 PANEL_HEIGHT		= 7
@@ -21,17 +63,77 @@ MSG_X				= BAR_WIDTH + 2
 MSG_WIDTH			= SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT			= PANEL_HEIGHT - 1
 INVENTORY_WIDTH		= 50
+MESSAGE_LOG_SIZE	= 2000		# Messages kept for the history view
+
+# Save files
+SAVE_FILE			= 'savegame.sav'
+LEGACY_SAVE_FILE	= 'savegame'	# shelve saves from older versions
+AUTOSAVE_TURNS		= 50			# Turns between autosaves, 0 for none
+
+# Images - the menu background is decoded the first time into
+# ASSET_CACHE_DIR, and read back from there after that
+FONT_FILE			= 'arial10x10.png'
+MENU_BACKGROUND		= 'menu_background.png'
+ASSET_CACHE_DIR		= '.asset_cache'
 
 # Parameters for dungeon Generation
+MAP_GENERATOR		= 'rooms'	# 'rooms', 'bsp', 'caves' or 'mixed' - see generation.py
 ROOM_MAX_SIZE		= 10
 ROOM_MIN_SIZE		= 6
 MAX_ROOMS			= 30
 MAX_ROOM_MONSTERS	= 3
 MAX_ROOM_ITEMS		= 2
 
+# Fighters' stats, as (hp, defense, power) - balance.py plays out fights with
+# different ones
+PLAYER_STATS		= (30, 2, 5)
+ORC_STATS			= (10, 0, 3)
+TROLL_STATS			= (16, 1, 4)
+TROLL_CHANCE		= 20		# Percentage of monsters that are trolls
+
+# Levels are generated from the game's seed, so the same seed always gives
+# the same dungeon. The next few are built ahead of time in other processes.
+PREGENERATE_LEVELS	= 1			# Levels generated ahead, 0 for none
+LEVEL_WORKERS		= 2			# Processes generating them
+LEVEL_CACHE_SIZE	= 4			# Levels kept ready
+
+# Levels the player has left are kept for going back to: the most recently
+# visited in memory, older ones compressed on disk in LEVEL_DIR (a temp dir
+# if None)
+LIVE_LEVELS			= 3			# Levels in memory, counting the current one
+LEVEL_DIR			= None
+DOWN_STAIRS			= '>'
+UP_STAIRS			= '<'
+
 FOV_ALGO			= 'BASIC'	# default FOV algorithm
 FOV_LIGHT_WALLS		= True
 TORCH_RADIUS		= 10
+FOV_CACHE_SIZE		= 64		# FOV results kept for recently visited tiles
+
+# Light from the player's torch, braziers and glowing items, fading with
+# distance and mixed into the map's colours by the batch renderer. With it
+# off, or in a large world, everything in view is simply lit.
+LIGHTING			= True
+TORCH_COLOUR		= (255, 240, 210)
+AMBIENT_LIGHT		= (0, 0, 0)		# Light everywhere in view, lit or not
+BRAZIER_CHANCE		= 25			# Percentage of rooms with a brazier
+
+# (colour, radius, intensity) of the light things with these names give off
+GLOWS				= {
+	'brazier':			((255, 140, 40), 6, 1.0),
+	'fireball rune':	((255, 90, 20), 2, 0.5),
+	'lightning rune':	((110, 150, 255), 2, 0.5),
+	'confusion rune':	((190, 80, 255), 2, 0.5),
+}
+GLOW_RADIUS			= max(radius for (colour, radius, intensity) in GLOWS.values())
+
+PATHFINDING			= True		# Monsters follow a shared flow field to the player
+
+# Monsters further than this from the player are dormant and take no turns,
+# until the player comes within ACTIVATION_RADIUS or they get hurt
+ACTIVATION_RADIUS	= TORCH_RADIUS + 5
+DORMANT_RADIUS		= ACTIVATION_RADIUS + 5
+FLOW_RADIUS			= 2 * TORCH_RADIUS	# How far from the player paths are mapped
 
 # Spell Values
 HEAL_AMOUNT			= 4
@@ -39,17 +141,64 @@ LIGHTNING_RANGE		= 5
 LIGHTNING_DAMAGE	= 20
 CONFUSE_RANGE		= 8
 CONFUSE_NUM_TURNS	= 10
-FIREBALL_RADIUS     = 3
+FIREBALL_RADIUS		= 3
+FIREBALL_DAMAGE		= 12
 
 CLASSIC_TILES		= False		# Classic Tiles is not fully implemented yet
+BATCH_RENDER		= True		# Build the map frame with array operations
+BATCH_AI			= True		# Move all basic monsters in one vectorised step
+SHOW_REDRAW_COUNT	= False		# Show how many map cells the last frame redrew
+LIMIT_FPS			= 30		# Most frames drawn a second, 0 for no limit
+
+# Time the main phases of each frame, shown in the GUI panel and written out
+# when the game exits. With it off none of the timing code runs.
+PROFILE				= False
+PROFILE_CSV			= 'profile.csv'		# Per section times
+PROFILE_STACKS		= 'profile.folded'	# Collapsed stacks, for flame graphs
+
+# Let people on this machine watch - each frame is streamed to TCP viewers
+# on SPECTATE_PORT and WebSocket ones on SPECTATE_WS_PORT (see spectate.py)
+SPECTATE			= False
+SPECTATE_PORT		= 7777
+SPECTATE_WS_PORT	= 7778
+
+# Record each new game's seed and input here, for replay.py to play it back
+# exactly - None to record nothing
+JOURNAL_FILE		= None
 
 col_dark_wall		= (0, 0, 100)
 col_ligt_wall		= (130, 110, 50)
 col_dark_grnd		= (50, 50, 150)
 col_ligt_grnd		= (200, 180, 50)
+col_white			= (255, 255, 255)
+col_grey			= (128, 128, 128)
+col_black			= (0, 0, 0)
+
+def make_engines():
+	# The FOV, lighting and pathfinding engines, built from the settings -
+	# again by whatever changes those settings after import
+	global fov_engine, light_map, flow_field
+	fov_engine = FovEngine(FOV_ALGO, FOV_LIGHT_WALLS, FOV_CACHE_SIZE)
+	light_map = LightMap(FovEngine(FOV_ALGO, FOV_LIGHT_WALLS, 1), AMBIENT_LIGHT)
+	flow_field = FlowField(FLOW_RADIUS)
 
-class Tile():
-	# Map Tile & its properties
+make_engines()
+
+# (char, fg, bg) for each map cell state: unexplored, dark ground, dark wall,
+# lit ground, lit wall
+map_renderer = MapRenderer({
+	True: Palette([(' ', col_white, col_black),
+		('.', col_white, col_black), ('#', col_white, col_black),
+		('.', col_white, col_grey), ('#', col_white, col_grey)]),
+	False: Palette([(' ', col_white, col_black),
+		(' ', col_white, col_dark_grnd), (' ', col_white, col_dark_wall),
+		(' ', col_white, col_ligt_grnd), (' ', col_white, col_ligt_wall)])})
+
+class Tile(Slotted):
+	# Map Tile & its properties - the map itself is stored in a GameMap now,
+	# this is only kept so that older saves can still be unpickled
+	__slots__ = ('blocked', 'block_sight', 'explored')
+	
 	def __init__(self, blocked, block_sight=None):
 		self.blocked = blocked
 		
@@ -59,27 +208,19 @@ class Tile():
 		
 		self.explored = False
 
-class Rect():
-	# Map Rectangle - used to represent rooms
-	def __init__(self, x, y, w, h):
-		self.x1 = x
-		self.y1 = y
-		self.x2 = x + w
-		self.y2 = y + h
-		
-	def centre(self):
-		centre_x = (self.x1 + self.x2) // 2
-		centre_y = (self.y1 + self.y2) // 2
-		return (centre_x, centre_y)
-		
-	def intersect(self, other):
-		return (self.x1 <= other.x2 and self.x2 >= other.x1 and
-			self.y1 <= other.y2 and self.y2 >= other.y1)
-
-class GameObject:
+class GameObject(Slotted):
 	# This represents a generic object - it's always represented by a
-	# character on screen
+	# character on screen. While it is on a level and has a fighter, its
+	# position lives in the level's ActorStore.
+	__slots__ = ('store', 'slot', '_x', '_y', 'char', 'name', 'colour', 'blocks', 'fighter',
+		'_ai', 'item')
+	
+	x = StoreField('x')
+	y = StoreField('y')
+	
 	def __init__(self, x, y, char, name, colour, blocks=False, fighter=None, ai=None, item=None):
+		self.store = None
+		self.slot = None
 		self.x = x
 		self.y = y
 		self.char = char
@@ -95,23 +236,41 @@ class GameObject:
 		
 		self.item = item
 		if self.item: self.item.owner = self
+	
+	@property
+	def ai(self):
+		return self._ai
+	
+	@ai.setter
+	def ai(self, ai):
+		self._ai = ai
+		if self.store is not None: self.store.set_ai(self.slot, ai)
+	
+	def __getstate__(self):
+		return detached_state(self, ('x', 'y'))
+	
+	def __setstate__(self, state):
+		if 'ai' in state: state['_ai'] = state.pop('ai')
+		restore_state(self, state, ('x', 'y'))
 		
 	def move(self, dx, dy):
 		# Move by the amount given
 		if not is_blocked(self.x + dx, self.y + dy):
 			self.x += dx
 			self.y += dy
+			object_index.update(self)
 	
 	def draw(self):
-		global visible_tiles
 		# draws the character at its position, if visible
-		if (self.x, self.y) in visible_tiles:
-			if CLASSIC_TILES:con.draw_char(self.x, self.y, self.char, self.colour)
-			else: con.draw_char(self.x, self.y, self.char, self.colour, bg=col_ligt_grnd)
+		(x, y) = to_screen(self.x, self.y)
+		if in_fov(self.x, self.y) and in_camera(x, y):
+			if CLASSIC_TILES:con.draw_char(x, y, self.char, self.colour)
+			else: con.draw_char(x, y, self.char, self.colour, bg=col_ligt_grnd)
 	
 	def clear(self):
 		# erases the character
-		con.draw_char(self.x, self.y, ' ', self.colour, bg=None)
+		(x, y) = to_screen(self.x, self.y)
+		if in_camera(x, y): con.draw_char(x, y, ' ', self.colour, bg=None)
 		
 	def move_towards(self, target_x, target_y):
 		# Vector from this object to the target, and distance
@@ -125,6 +284,16 @@ class GameObject:
 		dy = int(round(dy/distance))
 		self.move(dx,dy)
 	
+	def move_downhill(self, flow, target):
+		# Take the best free step along a flow field towards target, or head
+		# straight for it if there's no path from here
+		steps = flow.steps(self.x, self.y)
+		for (x, y) in steps:
+			if not is_blocked(x, y):
+				self.move(x - self.x, y - self.y)
+				return
+		if not steps: self.move_towards(target.x, target.y)
+	
 	def distance_to(self, other):
 		dx = other.x - self.x
 		dy = other.y - self.y
@@ -134,19 +303,40 @@ class GameObject:
 		return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 		
 	def send_to_back(self):
-		global objects
-		objects.remove(self)
-		objects.insert(0, self)
+		# Draw it under everything else, with the corpses
+		objects.move(self, CORPSES)
 
-class Fighter:
-	def __init__(self, hp, defense, power, death_function=None):
+class Fighter(Slotted):
+	# Combat stats - kept in the owner's ActorStore while it is in one
+	__slots__ = ('store', 'slot', 'owner', '_hp', '_max_hp', '_defense', '_power', '_speed',
+		'death_function')
+	
+	hp = StoreField('hp')
+	max_hp = StoreField('max_hp')
+	defense = StoreField('defense')
+	power = StoreField('power')
+	speed = StoreField('speed')		# Energy gained per tick - see scheduler.py
+	
+	def __init__(self, hp, defense, power, death_function=None, speed=NORMAL_SPEED):
+		self.store = None
+		self.slot = None
 		self.max_hp = hp
 		self.hp = hp
 		self.defense = defense
 		self.power = power
+		self.speed = speed
 		self.death_function = death_function
+	
+	def __getstate__(self):
+		return detached_state(self, ('hp', 'max_hp', 'defense', 'power', 'speed'))
+	
+	def __setstate__(self, state):
+		state.setdefault('_speed', NORMAL_SPEED)	# From before speeds
+		restore_state(self, state, ('hp', 'max_hp', 'defense', 'power', 'speed'))
 		
 	def take_damage(self, damage):
+		# Being hurt wakes a dormant monster
+		if self.owner.ai: scheduler.wake(self.owner)
 		if damage > 0:
 			self.hp -= damage
 		if self.hp <= 0:
@@ -167,7 +357,9 @@ class Fighter:
 		self.hp += amount
 		if self.hp > self.max_hp: self.hp = self.max_hp
 	
-class Item:
+class Item(Slotted):
+	__slots__ = ('owner', 'use_function')
+	
 	def __init__(self, use_function=None):
 		self.use_function = use_function
 	
@@ -176,14 +368,14 @@ class Item:
 			message('Your inventory is full, cannot pick up ' + self.owner.name + '.', colours.red)
 		else:
 			inventory.append(self.owner)
-			objects.remove(self.owner)
+			remove_object(self.owner)
 			message('You picked up a ' + self.owner.name + '!', colours.green)
 		
 	def drop(self):
-		objects.append(self.owner)
 		inventory.remove(self.owner)
 		self.owner.x = player.x
 		self.owner.y = player.y
+		add_object(self.owner)
 		message('You dropped a ' + self.owner.name + '.', colours.yellow)
 			
 	def use(self):
@@ -193,21 +385,28 @@ class Item:
 			if self.use_function() != 'cancelled':
 				inventory.remove(self.owner)	# Destroy after use, unless cancelled
 		
-class BasicMonster:
+class BasicMonster(Slotted):
+	__slots__ = ('owner',)
+	batched = True		# Moved by ActorStore.step_basic_monsters when BATCH_AI is on
+	
 	def take_turn(self):
 		monster = self.owner
-		if(monster.x, monster.y) in visible_tiles:
+		if in_fov(monster.x, monster.y):
 			# Move towards player if far away
 			if monster.distance_to(player) >= 2:
-				monster.move_towards(player.x, player.y)
+				if PATHFINDING: monster.move_downhill(flow_field, player)
+				else: monster.move_towards(player.x, player.y)
 			
 			# Attack!
 			elif player.fighter.hp > 0: monster.fighter.attack(player)
 
-class ConfusedMonster:
-	def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
+class ConfusedMonster(Slotted):
+	__slots__ = ('owner', 'old_ai', 'num_turns')
+	
+	def __init__(self, old_ai, num_turns=None):
+		# CONFUSE_NUM_TURNS as it is now - a replay may have changed it
 		self.old_ai = old_ai
-		self.num_turns = num_turns
+		self.num_turns = CONFUSE_NUM_TURNS if num_turns is None else num_turns
 	
 	def take_turn(self):
 		if self.num_turns > 0:
@@ -215,197 +414,281 @@ class ConfusedMonster:
 			self.owner.move(randint(-1, 1), randint(-1, 1))
 			self.num_turns -= 1
 		else: # Restore old AI
-			self.owner.ai = self.oldai
+			self.owner.ai = self.old_ai
 			message('The ' + self.owner.name + ' is no longer confused!', colours.red)
 
+class TdlInput:
+	# Input from the tdl window. Anything with the same four methods can be
+	# plugged in as input_source instead - see headless.py
+	def get(self):
+		return tdl.event.get()
+	
+	def wait(self, timeout=None):
+		# The events waiting, blocking up to timeout seconds (None for as
+		# long as it takes) for the first
+		event = tdl.event.wait(timeout, flush=False)
+		if event is None: return []
+		return [event] + list(tdl.event.get())
+	
+	def wait_key(self):
+		return tdl.event.key_wait()
+	
+	def is_window_closed(self):
+		return tdl.event.is_window_closed()
+
+def actor_speed(obj):
+	return obj.fighter.speed if obj.fighter else NORMAL_SPEED
+
+scheduler = Scheduler(actor_speed)
+frame_limiter = FrameLimiter(LIMIT_FPS)
+profiler = Profiler()
+
+input_source = TdlInput()
+headless = False	# No window - nothing is ever flushed to the screen
+spectators = None	# The SpectatorServer, while people can watch
+my_map = None		# The current level's map, or ChunkedWorld
+tdl = None			# Imported when the window is opened - see init_display
+
+def make_console(width, height):
+	return tdl.Console(width, height)
+
+def flush():
+	if not headless:
+		tdl.flush()
+		if spectators is not None: spectators.frame(root)
+		if startup_times is not None: first_frame()
+
+def draw_frame():
+	# Draw the screen if it has changed and the frame rate allows; returns
+	# whether it did
+	if not frame_limiter.due(): return False
+	render_all()
+	flush()
+	frame_limiter.drawn()
+	return True
+
+def move_mouse(cell):
+	# The names under the mouse only need redrawing if it changed cell
+	global mouse_coord
+	if cell != mouse_coord:
+		mouse_coord = cell
+		frame_limiter.invalidate()
+
+def index_objects():
+	# Build the lookups for a new level's objects, all of them dormant
+	global object_index, actors
+	object_index = SpatialIndex(objects)
+	actors = ActorStore(objects)
+	scheduler.clear()
+
+def add_object(obj):
+	# Put an object on the current level
+	objects.add(obj)
+	object_index.add(obj)
+	if obj.fighter: actors.add(obj)
+
+def remove_object(obj):
+	objects.remove(obj)
+	object_index.remove(obj)
+	if obj.store is not None: obj.store.remove(obj)
+
 def is_blocked(x, y):
 	# Test the map tile
-	if my_map[x][y].blocked: return True
+	if my_map.is_blocked(x, y): return True
 	
 	# Check for blocking objects
-	for obj in objects:
-		if obj.blocks and obj.x == x and obj.y == y:
-			return True
-	return False
-
-def create_room(room):
-	global my_map
-	for x in range(room.x1 + 1, room.x2):
-		for y in range(room.y1 + 1, room.y2):
-			my_map[x][y].blocked = False
-			my_map[x][y].block_sight = False
-
-def create_h_tunnel(x1, x2, y):
-	global my_map
-	for x in range(min(x1, x2), max(x1, x2) + 1):
-		my_map[x][y].blocked = False
-		my_map[x][y].block_sight = False
-
-def create_v_tunnel(y1, y2, x):
-	global my_map
-	for y in range(min(y1, y2), max(y1, y2) + 1):
-		my_map[x][y].blocked = False
-		my_map[x][y].block_sight = False
+	return object_index.blocking_at(x, y) is not None
 
 def is_visible_tile(x, y):
-	global my_map
- 
-	if x >= MAP_WIDTH or x < 0:
-		return False
-	elif y >= MAP_HEIGHT or y < 0:
-		return False
-	elif my_map[x][y].blocked == True:
-		return False
-	elif my_map[x][y].block_sight == True:
-		return False
-	else:
-		return True
+	return my_map.is_transparent(x, y)
+
+def in_fov(x, y):
+	# Is this tile in the player's current field of view
+	return visible.at(x, y)
 
-def make_map():
+def move_camera():
+	# Keep the player in the middle of the view, without scrolling past the
+	# edges of the map
+	global camera_x, camera_y
+	camera_x = min(max(0, player.x - CAMERA_WIDTH // 2), max(0, my_map.width - CAMERA_WIDTH))
+	camera_y = min(max(0, player.y - CAMERA_HEIGHT // 2), max(0, my_map.height - CAMERA_HEIGHT))
+
+def to_screen(x, y):
+	return (x - camera_x, y - camera_y)
+
+def to_map(x, y):
+	return (x + camera_x, y + camera_y)
+
+def in_camera(x, y):
+	# Is this screen position inside the map view
+	return (0 <= x < min(CAMERA_WIDTH, my_map.width) and
+		0 <= y < min(CAMERA_HEIGHT, my_map.height))
+
+def world_radius():
+	# How far around the player a chunked world keeps its chunks loaded -
+	# enough for the camera and the monsters' flow field
+	return max(CAMERA_WIDTH // 2, CAMERA_HEIGHT // 2, FLOW_RADIUS, TORCH_RADIUS) + 1
+
+def make_world(rng):
 	global my_map, objects
 	
-	objects = [player]
-	
-	# fill map with 'blocked' tiles
-	my_map = [[ Tile(True)	for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH)]
+	objects = ObjectStore([player])
+	index_objects()
 	
-	rooms = []
-	num_rooms = 0
+	my_map = ChunkedWorld(WORLD_WIDTH, WORLD_HEIGHT, CHUNK_SIZE, rng.randint(0, 2 ** 31),
+		WORLD_CACHE_DIR, MAX_CHUNKS, on_generate=populate_rooms,
+		on_evict=stash_objects, on_load=restore_objects)
+	(player.x, player.y) = my_map.start()
+	object_index.update(player)
+	my_map.ensure_around(player.x, player.y, world_radius())
+
+def populate_rooms(rooms):
+	# A world chunk was generated - put monsters and items in its rooms, the
+	# same ones every time for the same world
+	for room in rooms:
+		place_objects(room, random.Random('%s:%d:%d' % (my_map.seed, room.x1, room.y1)))
+
+def stash_objects(x1, y1, x2, y2):
+	# A world chunk is going to disk - take its objects off the level and
+	# hand them over to be stored with it. Corpses and items go first, so
+	# they come back underneath the monsters.
+	stashed = [obj for obj in object_index.in_rect(x1, y1, x2, y2) if obj is not player]
+	stashed.sort(key=lambda obj: obj.fighter is not None)
+	for obj in stashed: remove_object(obj)
+	return stashed
+
+def restore_objects(stashed):
+	# A world chunk is back from disk with the objects stash_objects took
+	for obj in stashed:
+		if obj in objects: raise ValueError('%s at (%d, %d) is on the level already' % (obj.name,
+			obj.x, obj.y))
+		add_object(obj)
+
+def make_map(rng, depth=1):
+	global my_map, objects
 	
-	for r in range(MAX_ROOMS):
-		# Randomise width and height
-		w = randint(ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = randint(ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		# Randomise position
-		x = randint(0, MAP_WIDTH - w - 1)
-		y = randint(0, MAP_HEIGHT - h - 1)
-		
-		# Rect class
-		new_room = Rect(x, y, w, h)
-		
-		# Check that there are no intersections
-		failed = False
-		for other_room in rooms:
-			if new_room.intersect(other_room):
-				failed = True
-				break
-		if not failed:
-			# Room is valid
-			
-			create_room(new_room)
-			
-			(new_x, new_y) = new_room.centre()
-			
-			if num_rooms == 0:
-				player.x = new_x
-				player.y = new_y
-			else:
-				# Connect to previous room
-				
-				# Centre Co-ordinates of previous room
-				(prev_x, prev_y) = rooms[num_rooms-1].centre()
-				
-				if randint(0, 1):
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
-				else:
-					create_v_tunnel(prev_y, new_y, prev_x)
-					create_h_tunnel(prev_x, new_x, new_y)
-			
-			# Add monsters to room
-			place_objects(new_room)
-			
-			# Append room to the list
-			rooms.append(new_room)
-			num_rooms += 1
+	objects = ObjectStore([player])
+	index_objects()
+	
+	layout = generation.pipeline(MAP_GENERATOR, MAX_ROOMS, ROOM_MIN_SIZE,
+		ROOM_MAX_SIZE).generate(MAP_WIDTH, MAP_HEIGHT, rng)
+	my_map = layout.game_map()
+	(player.x, player.y) = layout.start
+	object_index.update(player)
+	
+	# Stairs up where the player arrives, and down on the floor nearest the
+	# centre of the last room - or with no rooms, on the floor furthest from
+	# the start
+	if depth > 1: add_object(GameObject(player.x, player.y, UP_STAIRS, 'stairs up', colours.white))
+	if layout.rooms:
+		room = layout.rooms[-1]
+		(x, y) = layout.nearest_floor(room, *generation.centre(room))
+	else:
+		(xs, ys) = np.nonzero(layout.floor)
+		far = np.argmax(np.abs(xs - player.x) + np.abs(ys - player.y))
+		(x, y) = (int(xs[far]), int(ys[far]))
+	add_object(GameObject(x, y, DOWN_STAIRS, 'stairs down', colours.white))
+	
+	# Add monsters and items to the rooms
+	for room in layout.rooms: place_objects(room, rng)
+	
+	# Braziers in the corners of some of them (or as near as a cave has
+	# floor) - last, so the rest of the level is the same as before there
+	# were any
+	for room in layout.rooms:
+		if rng.randint(0, 99) >= BRAZIER_CHANCE: continue
+		(x, y) = layout.nearest_floor(room, room.x1 + 1, room.y1 + 1)
+		if not is_blocked(x, y): add_object(GameObject(x, y, '*', 'brazier', colours.orange))
 
-def place_objects(room):
+def place_objects(room, rng):
 	# Choose random number of monsters
-	num_monsters = randint(0, MAX_ROOM_MONSTERS)
+	num_monsters = rng.randint(0, MAX_ROOM_MONSTERS)
 	
 	for i in range(num_monsters):
-		x = randint(room.x1+1, room.x2-1)
-		y = randint(room.y1+1, room.y2-1)
-		
-		if not is_blocked(x, y):
-			if randint(0, 100) < 80:
-				fighter_component = Fighter(hp=10, defense=0, power=3,
-					death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = GameObject(x, y, 'o', 'orc', colours.desaturated_green,
-					blocks=True, fighter=fighter_component, ai=ai_component)		
-			else:
-				fighter_component = Fighter(hp=16, defense=1, power=4,
-					death_function=monster_death)
-				ai_component = BasicMonster()
-				monster = GameObject(x, y, 'T', 'troll', colours.darker_green,
-					blocks=True, fighter=fighter_component, ai=ai_component)		
-			
-			objects.append(monster)
+		x = rng.randint(room.x1+1, room.x2-1)
+		y = rng.randint(room.y1+1, room.y2-1)
+		
+		if not is_blocked(x, y): add_object(make_monster(x, y, rng))
 		
-	num_items = randint(0, MAX_ROOM_ITEMS)
+	num_items = rng.randint(0, MAX_ROOM_ITEMS)
 	
 	for i in range(num_items):
-		x = randint(room.x1+1, room.x2-1)
-		y = randint(room.y1+1, room.y2-1)
-		
-		if not is_blocked(x, y):
-			dice = randint(0, 100)
-			if dice < 70: # Healing Potion
-				item_component = Item(use_function=cast_heal)
-				item = GameObject(x, y, '!', 'healing potion', colours.violet,
-					item=item_component)
-			elif dice < 70+10: # Lightning Rune
-				item_component = Item(use_function=cast_lightning)
-				item = GameObject(x, y, '#', 'lightning rune', colours.light_yellow,
-					item=item_component)
-			elif dice < 70+10+10: # Fireball Rune
-				item_component = Item(use_function=cast_fireball)
-				item = GameObject(x, y, '#', 'fireball rune', colours.light_yellow,
-					item=item_component)
-			else: # Confuse Rune
-				item_component = Item(use_function=cast_confuse)
-				item = GameObject(x, y, '#', 'confusion rune', colours.light_yellow,
-					item=item_component)
-				
-			objects.append(item)
-			item.send_to_back()
+		x = rng.randint(room.x1+1, room.x2-1)
+		y = rng.randint(room.y1+1, room.y2-1)
+		
+		if not is_blocked(x, y): add_object(make_item(x, y, rng))
 
-def render_all():
+def make_monster(x, y, rng):
+	# A monster picked at random, as rooms get them
+	if rng.randint(0, 100) < 100 - TROLL_CHANCE:
+		fighter_component = Fighter(*ORC_STATS, death_function=monster_death)
+		ai_component = BasicMonster()
+		return GameObject(x, y, 'o', 'orc', colours.desaturated_green,
+			blocks=True, fighter=fighter_component, ai=ai_component)
+	else:
+		fighter_component = Fighter(*TROLL_STATS, death_function=monster_death)
+		ai_component = BasicMonster()
+		return GameObject(x, y, 'T', 'troll', colours.darker_green,
+			blocks=True, fighter=fighter_component, ai=ai_component)
+
+def make_item(x, y, rng):
+	# An item picked at random, as rooms get them
+	dice = rng.randint(0, 100)
+	if dice < 70: # Healing Potion
+		item_component = Item(use_function=cast_heal)
+		return GameObject(x, y, '!', 'healing potion', colours.violet,
+			item=item_component)
+	elif dice < 70+10: # Lightning Rune
+		item_component = Item(use_function=cast_lightning)
+		return GameObject(x, y, '#', 'lightning rune', colours.light_yellow,
+			item=item_component)
+	elif dice < 70+10+10: # Fireball Rune
+		item_component = Item(use_function=cast_fireball)
+		return GameObject(x, y, '#', 'fireball rune', colours.light_yellow,
+			item=item_component)
+	else: # Confuse Rune
+		item_component = Item(use_function=cast_confuse)
+		return GameObject(x, y, '#', 'confusion rune', colours.light_yellow,
+			item=item_component)
+
+def update_fov():
 	global fov_recompute
-	global visible_tiles
+	global visible
 	
 	if fov_recompute:
 		fov_recompute = False
-		visible_tiles = tdl.map.quickFOV(player.x, player.y, 
-			is_visible_tile, fov=FOV_ALGO, radius=TORCH_RADIUS, 
-			lightWalls=FOV_LIGHT_WALLS)
-	
-	# Set tile background colours
-	for y in range(MAP_HEIGHT):
-		for x in range(MAP_WIDTH):
-			visible = (x, y) in visible_tiles
-			wall = my_map[x][y].block_sight
-			if not visible:
-				if my_map[x][y].explored:
-					if CLASSIC_TILES:
-						if wall: con.draw_char(x, y, '#', fg=col_white, bg=colours.black)
-						else: con.draw_char(x, y, '.', fg=col_white, bg=colours.black)
-					else:
-						if wall: con.draw_char(x, y, ' ', fg=None, bg=col_dark_wall)
-						else: con.draw_char(x, y, ' ', fg=None, bg=col_dark_grnd)
-			else:
-				if CLASSIC_TILES:
-					if wall: con.draw_char(x, y, '#', fg=col_white, bg=col_grey)
-					else: con.draw_char(x, y, '.', fg=col_white, bg=col_grey)
-				else:
-					if wall: con.draw_char(x, y, ' ', fg=None, bg=col_ligt_wall)
-					else: con.draw_char(x, y, ' ', fg=None, bg=col_ligt_grnd)
-				my_map[x][y].explored = True
+		if isinstance(my_map, ChunkedWorld):
+			my_map.ensure_around(player.x, player.y, world_radius())
+		visible = fov_engine.compute(my_map, player.x, player.y, TORCH_RADIUS)
+		move_camera()
+
+def render_all():
+	update_fov()
+	
+	if BATCH_RENDER:
+		# Mark what's in view as explored
+		(x1, y1, x2, y2) = visible.bounds()
+		my_map.explored[x1:x2, y1:y2] |= visible.mask
+		
+		# Only the part of the map under the camera is drawn, and only the
+		# cells that changed since the last frame
+		width = min(CAMERA_WIDTH, my_map.width)
+		height = min(CAMERA_HEIGHT, my_map.height)
+		view_x = slice(camera_x, camera_x + width)
+		view_y = slice(camera_y, camera_y + height)
+		light = None
+		if lit():
+			update_lights()
+			light = light_map.region(camera_x, camera_y, width, height)
+		map_renderer.render(con, my_map.block_sight[view_x, view_y],
+			visible.region(camera_x, camera_y, width, height),
+			my_map.explored[view_x, view_y], object_draws(), CLASSIC_TILES, light)
+	else:
+		render_map_cells()
 				
-	# Draw objects in list
-	for obj in objects: obj.draw()
-	player.draw()
+		# Draw objects in list
+		for obj in objects: obj.draw()
+		player.draw()
 	
 	root.blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0)
 	
@@ -414,19 +697,98 @@ def render_all():
 	
 	# Print Messages
 	y = 1
-	for (line, colour) in game_msgs:
+	for (line, colour) in game_msgs.lines(MSG_WIDTH, MSG_HEIGHT):
 		panel.draw_str(MSG_X, y, line, bg=None, fg=colour)
 		y += 1
 	
 	# Show the player's stats
 	render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp,
 		colours.light_red, colours.darker_red)
+	if not LARGE_WORLD:
+		panel.draw_str(1, 2, 'Dungeon level ' + str(dungeon_level), bg=None, fg=colours.white)
 	
 	#display names of objects under the mouse
 	panel.draw_str(1, 0, get_names_under_mouse(), bg=None, fg=colours.light_gray)
 	
+	if SHOW_REDRAW_COUNT and BATCH_RENDER:
+		panel.draw_str(1, 3, 'Redrawn: ' + str(map_renderer.cells_redrawn), bg=None,
+			fg=colours.light_gray)
+	
+	if profiler.enabled:
+		for (i, line) in enumerate(profiler.overlay()):
+			panel.draw_str(1, 4 + i, line[:BAR_WIDTH], bg=None, fg=colours.light_gray)
+	
 	root.blit(panel, 0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0)
 
+def lit():
+	# Whether the map is drawn with lighting - only where there's a torch
+	# radius for the light to fade over, and not in large worlds
+	return LIGHTING and TORCH_RADIUS and not isinstance(my_map, ChunkedWorld)
+
+def glow(obj):
+	(colour, radius, intensity) = GLOWS[obj.name]
+	return Light(obj.x, obj.y, radius, colour, intensity)
+
+def update_lights():
+	# The things that never move are baked into the light map the first
+	# time a map is drawn; the torch and glowing items near enough to light
+	# anything in view are handed over each frame, and only re-lit if they
+	# moved
+	if not light_map.baked(my_map):
+		light_map.bake(my_map, [glow(obj) for obj in objects if obj.name in GLOWS and
+			obj.fighter is None and obj.item is None])
+	lights = [Light(player.x, player.y, TORCH_RADIUS, TORCH_COLOUR)]
+	for obj in object_index.in_radius(player.x, player.y, TORCH_RADIUS + GLOW_RADIUS):
+		if obj.name in GLOWS and (obj.fighter or obj.item): lights.append(glow(obj))
+	light_map.move(lights)
+
+def object_draws():
+	# (x, y, char, colour, bg) for every visible object, in draw order, in
+	# screen co-ordinates. Lit, objects keep the shaded tile under them.
+	if CLASSIC_TILES or lit(): bg = None
+	else: bg = col_ligt_grnd
+	
+	# Nothing outside the torch radius can be visible
+	if TORCH_RADIUS: nearby = object_index.in_radius(player.x, player.y, TORCH_RADIUS + 1)
+	else: nearby = objects
+	
+	draws = []
+	for (x, y) in set((obj.x, obj.y) for obj in nearby):
+		(screen_x, screen_y) = to_screen(x, y)
+		if in_fov(x, y) and in_camera(screen_x, screen_y):
+			# Lower layers first, so a monster stands over what's on the floor
+			for obj in sorted(object_index.at(x, y), key=objects.layer.get):
+				draws.append((screen_x, screen_y, obj.char, obj.colour, bg))
+	
+	# The player is always drawn on top
+	(screen_x, screen_y) = to_screen(player.x, player.y)
+	draws.append((screen_x, screen_y, player.char, player.colour, bg))
+	return draws
+
+def render_map_cells():
+	# Set tile background colours, one cell at a time
+	for y in range(min(CAMERA_HEIGHT, my_map.height)):
+		for x in range(min(CAMERA_WIDTH, my_map.width)):
+			(map_x, map_y) = to_map(x, y)
+			visible = in_fov(map_x, map_y)
+			wall = my_map.block_sight[map_x, map_y]
+			if not visible:
+				if my_map.explored[map_x, map_y]:
+					if CLASSIC_TILES:
+						if wall: con.draw_char(x, y, '#', fg=col_white, bg=colours.black)
+						else: con.draw_char(x, y, '.', fg=col_white, bg=colours.black)
+					else:
+						if wall: con.draw_char(x, y, ' ', fg=None, bg=col_dark_wall)
+						else: con.draw_char(x, y, ' ', fg=None, bg=col_dark_grnd)
+			else:
+				if CLASSIC_TILES:
+					if wall: con.draw_char(x, y, '#', fg=col_white, bg=col_grey)
+					else: con.draw_char(x, y, '.', fg=col_white, bg=col_grey)
+				else:
+					if wall: con.draw_char(x, y, ' ', fg=None, bg=col_ligt_wall)
+					else: con.draw_char(x, y, ' ', fg=None, bg=col_ligt_grnd)
+				my_map.explored[map_x, map_y] = True
+
 def player_move_or_attack(dx, dy):
 	global fov_recompute
 
@@ -436,8 +798,8 @@ def player_move_or_attack(dx, dy):
  
 	#try to find an attackable object there
 	target = None
-	for obj in objects:
-		if obj.fighter and obj.x == x and obj.y == y:
+	for obj in object_index.at(x, y):
+		if obj.fighter:
 			target = obj
 			break
  
@@ -461,7 +823,7 @@ def menu(header, options, width):
 	height = len(options) + header_height
 	
 	# Create an off-screen console that represents the menu's window
-	window = tdl.Console(width, height)
+	window = make_console(width, height)
 	
 	# Print the header, with wrapped text
 	window.draw_rect(0, 0, width, height, None, fg=colours.white, bg=None)
@@ -483,8 +845,8 @@ def menu(header, options, width):
 	root.blit(window, x, y, width, height, 0, 0)
 	
 	#present the root console to the player and wait for a key-press
-	tdl.flush()
-	key = tdl.event.key_wait()
+	flush()
+	key = input_source.wait_key()
 	key_char = key.char
 	if key_char == '': key_char = ' ' # placeholder
  
@@ -495,6 +857,28 @@ def menu(header, options, width):
 
 def msgbox(text, width=50):
 	menu(text, [], width) 
+
+def message_history():
+	# Scroll back through the message log: UP/DOWN a line at a time,
+	# PAGEUP/PAGEDOWN a screen, any other key closes it
+	width = SCREEN_WIDTH - 2
+	height = SCREEN_HEIGHT - 1
+	window = make_console(SCREEN_WIDTH, SCREEN_HEIGHT)
+	top = max(0, game_msgs.line_count(width) - height)
+	steps = {'UP': 1, 'DOWN': -1, 'PAGEUP': height, 'PAGEDOWN': -height}
+	offset = 0
+	while True:
+		window.clear(fg=colours.white, bg=colours.black)
+		window.draw_str(1, 0, 'Message history - arrows/page up/down scroll, any other key closes',
+			bg=None, fg=colours.light_gray)
+		for (i, (line, colour)) in enumerate(game_msgs.lines(width, height, offset)):
+			window.draw_str(1, 1 + i, line, bg=None, fg=colour)
+		root.blit(window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0)
+		flush()
+		
+		step = steps.get(input_source.wait_key().key)
+		if step is None: break
+		offset = min(top, max(0, offset + step))
 	
 def inventory_menu(header):
 	if len(inventory) == 0:
@@ -508,9 +892,9 @@ def inventory_menu(header):
 	return inventory[index].item
 	
 def main_menu():
-	img = image_load('menu_background.png')
+	img = assets.image(MENU_BACKGROUND, ASSET_CACHE_DIR)
 	
-	while not tdl.event.is_window_closed():
+	while not input_source.is_window_closed():
 		img.blit_2x(root, 0, 0)	# Blit the image, at twice the regular console resolution
 		
 		# Game Title and Credits
@@ -522,12 +906,17 @@ def main_menu():
 		centre = (SCREEN_WIDTH - len(title)) // 2
 		root.draw_str(centre, SCREEN_HEIGHT-2, title, bg=None, fg=colours.light_yellow)
 		
+		# Start on the first level of a new game while the player decides
+		next_game_seed()
+		
 		# Show options
 		choice = menu('', ['Play a new game', 'Continue last game', 'Quit'], 24)
 		
 		if choice == 0:
 			new_game()
-			play_game()
+			if JOURNAL_FILE: start_journal(JOURNAL_FILE)
+			try: play_game()
+			finally: stop_journal()
 		if choice == 1:  #load last game
 			try: load_game()
 			except:
@@ -536,25 +925,30 @@ def main_menu():
 			play_game()
 		elif choice == 2: break
 	
-def handle_keys():
+def handle_keys(events=None):
 	global playerx, playery
 	global fov_recompute
-	global mouse_coord
+	
+	# events defaults to whatever is waiting, without blocking
+	if events is None: events = input_source.get()
 	
 	keypress = False
-	for event in tdl.event.get():
+	for event in events:
 		if event.type == 'KEYDOWN':
 			user_input = event
 			keypress = True
 		if event.type == 'MOUSEMOTION':
-			mouse_coord = event.cell
+			move_mouse(event.cell)
 	
 	if not keypress:
 		return 'didnt-take-turn'
 	
+	# Anything a key does - moving, a menu closing - shows on screen
+	frame_limiter.invalidate()
+	
 	if user_input.key == 'ENTER' and user_input.alt:
 		# Alt & Enter: toggle fullscreen
-		tdl.set_fullscreen(not tdl.get_fullscreen())
+		if not headless: tdl.set_fullscreen(not tdl.get_fullscreen())
 	elif user_input.key == 'ESCAPE':
 		return 'exit'	# exit game
 	
@@ -566,8 +960,8 @@ def handle_keys():
 		elif user_input.key == 'RIGHT':	player_move_or_attack(1, 0)
 		else: # test for other keys
 			if user_input.text == 'g': # Pick up an item
-				for obj in objects:
-					if obj.x == player.x and obj.y == player.y and obj.item:
+				for obj in object_index.at(player.x, player.y):
+					if obj.item:
 						obj.item.pick_up()
 						break 
 			if user_input.text == 'i': # Show the Inventory
@@ -579,6 +973,9 @@ def handle_keys():
 				'drop it, or any other to cancel.\n')
 				if chosen_item is not None:
 					chosen_item.drop()
+			if user_input.text == 'm': message_history()	# Scroll back through messages
+			if user_input.text in (DOWN_STAIRS, UP_STAIRS) and not LARGE_WORLD:
+				take_stairs(user_input.text)
 			return 'didnt-take-turn'
 
 def player_death(player):
@@ -591,6 +988,7 @@ def player_death(player):
 	
 def monster_death(monster):
 	print(monster.name.capitalize() + ' is dead!')
+	if monster.store is not None: monster.store.remove(monster)
 	monster.char = '%'
 	monster.colour = colours.dark_red
 	monster.blocks = False
@@ -610,57 +1008,41 @@ def render_bar(x, y, total_width, name, value, maximum, bar_colour, back_colour)
 	panel.draw_str(x_centred, y, text, fg=colours.white, bg=None)
 
 def message(new_msg, colour=colours.white):
-	new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)	# Split the text if necessary
-	
-	for line in new_msg_lines:
-		if len(game_msgs) == MSG_HEIGHT: del game_msgs[0]
-		
-		game_msgs.append((line, colour))
+	# Wrapped to fit when it's drawn
+	game_msgs.add(new_msg, colour)
 
 def get_names_under_mouse():
-	global visible_tiles
-
 	#return a string with the names of all objects under the mouse
-	(x, y) = mouse_coord
+	(x, y) = to_map(*mouse_coord)
  
 	#create a list with the names of all objects at the mouse's coordinates and in FOV
-	names = [obj.name for obj in objects
-		if obj.x == x and obj.y == y and (obj.x, obj.y) in visible_tiles]
+	if not in_fov(x, y): return ''
+	names = [obj.name for obj in object_index.at(x, y)]
  
 	names = ', '.join(names)  #join the names, separated by commas
 	return names.capitalize()
 
 def closest_monster(max_range):
-	closest_enemy = None
-	closest_dist = max_range + 1
-	
-	for obj in objects:
-		if obj.fighter and not obj == player and (obj.x, obj.y) in visible_tiles:
-			dist = player.distance_to(obj)
-			if dist < closest_dist:
-				closest_enemy = obj
-				closest_dist = dist
-	return closest_enemy
+	# Anything strictly closer than max_range + 1, as before
+	return object_index.nearest(player.x, player.y, max_range + 1,
+		lambda obj: obj.fighter and obj != player and in_fov(obj.x, obj.y))
 
 def target_tile(max_range=None):
-	global mouse_coord
-	
+	frame_limiter.invalidate()
 	while True:
-		tdl.flush()
+		draw_frame()
 		clicked = False
-		for event in tdl.event.get():
-			if event.type == 'MOUSEMOTION': mouse_coord = event.cell
+		for event in input_source.wait(frame_limiter.timeout()):
+			if event.type == 'MOUSEMOTION': move_mouse(event.cell)
 			if event.type == 'MOUSEDOWN': clicked = True
 			elif ((event.type == 'MOUSEDOWN' and event.button == 'RIGHT') or 
 					(event.type == 'KEYDOWN' and event.key == 'ESCAPE')):
 				return (None, None)
-		render_all()
 		
-		x = mouse_coord[0]
-		y = mouse_coord[1]
-		if (clicked and mouse_coord in visible_tiles and
+		(x, y) = to_map(*mouse_coord)
+		if (clicked and in_fov(x, y) and
 			(max_range is None or player.distance(x, y) <= max_range)):
-			return mouse_coord
+			return (x, y)
 
 def target_monster(max_range=None):
 	while True:
@@ -669,8 +1051,8 @@ def target_monster(max_range=None):
 			return None
  
 		#return the first clicked monster, otherwise continue looping
-		for obj in objects:
-			if obj.x == x and obj.y == y and obj.fighter and obj != player:
+		for obj in object_index.at(x, y):
+			if obj.fighter and obj != player:
 				return obj
 
 def cast_heal(): #heal the player
@@ -714,50 +1096,404 @@ def cast_fireball():
 		return 'cancelled'
 	message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', colours.orange)
  
-	for obj in objects:  #damage every fighter in range, including the player
-		if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
+	for obj in object_index.in_radius(x, y, FIREBALL_RADIUS):  #damage every fighter in range, including the player
+		if obj.fighter:
 			message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', colours.orange)
 			obj.fighter.take_damage(FIREBALL_DAMAGE)
 
-def save_game():
-	with shelve.open('savegame', 'n') as savefile:
-		savefile['my_map'] = my_map
-		savefile['objects'] = objects
-		savefile['player_index'] = objects.index(player)  #index of player in objects list
-		savefile['inventory'] = inventory
-		savefile['game_msgs'] = game_msgs
-		savefile['game_state'] = game_state
-		savefile.close()
-
-def load_game():
+# Codes for what the save file can't hold directly - the position in each
+# list is what's saved, so only ever add to the end
+DEATH_FUNCTIONS		= [None, player_death, monster_death]
+USE_FUNCTIONS		= [None, cast_heal, cast_lightning, cast_confuse, cast_fireball]
+AI_CLASSES			= [None, BasicMonster, ConfusedMonster]
+
+STORE_FIELDS		= ('x', 'y', 'hp', 'max_hp', 'defense', 'power', 'speed')
+
+def object_rows(objs):
+	# What a save needs to know about each object, as plain values that the
+	# game won't change afterwards. The numbers of objects in the level's
+	# ActorStore are copied out of its arrays in one go at the end.
+	rows = []
+	stored_rows = []
+	stored_slots = []
+	for obj in objs:
+		fighter = obj.fighter
+		item = obj.item
+		ai = obj.ai
+		(old_ai, turns) = (None, 0)
+		if isinstance(ai, ConfusedMonster):
+			# Confusion on top of confusion comes back as one longer spell
+			(old_ai, turns) = (ai.old_ai, ai.num_turns)
+			while isinstance(old_ai, ConfusedMonster):
+				(old_ai, turns) = (old_ai.old_ai, turns + old_ai.num_turns)
+		
+		if obj.store is actors:
+			stored_rows.append(len(rows))
+			stored_slots.append(obj.slot)
+			numbers = None
+		elif fighter:
+			numbers = (obj.x, obj.y, fighter.hp, fighter.max_hp, fighter.defense, fighter.power,
+				fighter.speed)
+		else: numbers = (obj.x, obj.y, 0, 0, 0, 0, 0)
+		
+		rows.append((obj.char, obj.name, obj.colour, obj.blocks, fighter is not None,
+			fighter and fighter.death_function, type(ai) if ai else None,
+			type(old_ai) if old_ai else None, turns, item is not None,
+			item and item.use_function, numbers))
+	
+	stored = None
+	if stored_rows:
+		stored = (stored_rows, [getattr(actors, name)[stored_slots] for name in STORE_FIELDS])
+	return (rows, stored)
+
+def object_records(object_rows, strings):
+	# object_rows as the save file's fixed-layout records
+	(rows, stored) = object_rows
+	death_codes = dict((function, i) for (i, function) in enumerate(DEATH_FUNCTIONS))
+	use_codes = dict((function, i) for (i, function) in enumerate(USE_FUNCTIONS))
+	ai_codes = dict((cls, i) for (i, cls) in enumerate(AI_CLASSES))
+	colour_cache = {}
+	records = []
+	for (char, name, colour, blocks, fighter, death, ai, old_ai, turns, item, use,
+			numbers) in rows:
+		flags = savefile.BLOCKS if blocks else 0
+		if fighter: flags |= savefile.FIGHTER
+		if item: flags |= savefile.ITEM
+		if numbers is None: numbers = (0, 0, 0, 0, 0, 0, 0)
+		
+		colour_tuple = colour_cache.get(id(colour))
+		if colour_tuple is None: colour_tuple = colour_cache[id(colour)] = tuple(colour)
+		
+		records.append(numbers[:2] + (ord(char), strings.add(name), colour_tuple, flags) +
+			numbers[2:] + (death_codes[death], ai_codes[ai], ai_codes[old_ai],
+			use_codes[use], turns))
+	
+	records = np.array(records, dtype=savefile.OBJECT)
+	if stored:
+		(indices, columns) = stored
+		for (name, column) in zip(STORE_FIELDS, columns): records[name][indices] = column
+	return records.tobytes()
+
+def records_objects(data, strings):
+	records = savefile.records(data, savefile.OBJECT)
+	columns = [records[name].tolist() for name in savefile.OBJECT.names]
+	palette = {}	# Objects of the same colour share one Color, as they do in play
+	objs = []
+	for (x, y, char, name, colour, flags, hp, max_hp, defense, power, speed, death, ai,
+			old_ai, use, turns) in zip(*columns):
+		fighter = None
+		if flags & savefile.FIGHTER:
+			fighter = Fighter(max_hp, defense, power, DEATH_FUNCTIONS[death], speed)
+			fighter.hp = hp
+		
+		ai_component = None
+		if AI_CLASSES[ai] is ConfusedMonster:
+			ai_component = ConfusedMonster(AI_CLASSES[old_ai]() if old_ai else None, turns)
+		elif ai: ai_component = AI_CLASSES[ai]()
+		
+		item = Item(USE_FUNCTIONS[use]) if flags & savefile.ITEM else None
+		colour = tuple(colour)
+		if colour not in palette: palette[colour] = colours.Color(*colour)
+		obj = GameObject(x, y, chr(char), strings[name], palette[colour],
+			blocks=bool(flags & savefile.BLOCKS), fighter=fighter, ai=ai_component, item=item)
+		if old_ai: ai_component.old_ai.owner = obj
+		objs.append(obj)
+	return objs
+
+def snapshot_game():
+	# Everything a save needs from the game as it is now, copied so that
+	# nothing in it is shared with the game - the slow part, encoding and
+	# writing it, can then happen on another thread while play goes on
+	strings = savefile.StringTable()
+	sections = {}
+	world = None
+	if isinstance(my_map, ChunkedWorld):
+		kind = savefile.CHUNKED_WORLD
+		sections[b'WRLD'] = savefile.pack_world(my_map)
+		world = my_map.snapshot()		# Chunks that play goes on to evict included
+	else:
+		kind = savefile.GAME_MAP
+		sections[b'MAP '] = savefile.pack_map(my_map)
+	saved = list(objects)
+	sections[b'META'] = savefile.META.pack(kind, saved.index(player), strings.add(game_state))
+	sections[b'GAME'] = savefile.GAME.pack(game_seed, dungeon_level)
+	
+	# The other levels - those in memory copied like this one, the rest
+	# already packed
+	levels = [(depth, savefile.pack_map(game_map), object_rows(objs)) for (depth, (game_map,
+		objs)) in dungeon_levels.live_levels()]
+	
+	return {'strings': strings, 'sections': sections, 'world': world,
+		'objects': object_rows(saved), 'inventory': object_rows(inventory),
+		'messages': [(msg.text, msg.colour, msg.count) for msg in game_msgs],
+		'levels': levels, 'evicted': dungeon_levels.evicted_levels()}
+
+def write_game(snapshot, path=SAVE_FILE):
+	strings = snapshot['strings']
+	sections = snapshot['sections']
+	sections[b'OBJS'] = object_records(snapshot['objects'], strings)
+	sections[b'INVN'] = object_records(snapshot['inventory'], strings)
+	sections[b'MSGS'] = np.array([(strings.add(text), tuple(colour), count) for
+		(text, colour, count) in snapshot['messages']], dtype=savefile.MESSAGE).tobytes()
+	levels = [(depth, encode_level(map_data, rows)) for (depth, map_data, rows) in
+		snapshot['levels']] + snapshot['evicted']
+	if levels: sections[b'LVLS'] = savefile.pack_levels(levels)
+	if snapshot['world'] is not None:
+		(explored, chunks, stashed) = pack_world_state(snapshot['world'])
+		sections[b'EXPL'] = explored
+		sections[b'CHNK'] = chunks
+		sections[b'COBJ'] = object_records(stashed, strings)
+	sections[b'STRS'] = strings.pack()
+	savefile.write(path, sections)
+
+def save_game(path=SAVE_FILE):
+	# Let an autosave in progress finish first, so it can't land on top
+	autosaver.wait()
+	write_game(snapshot_game(), path)
+
+autosaver = Autosaver(snapshot_game, write_game, AUTOSAVE_TURNS)
+
+def pack_world_state(snapshot):
+	# (EXPL, CHNK, object rows for COBJ) from a world's snapshot - the objects
+	# stored with each chunk off the level go in COBJ, in chunk order. They're
+	# unpickled from the snapshot's own bytes, so this can run on the writer's
+	# thread.
+	(explored, resident, stored) = snapshot
+	chunks = ChunkedWorld.chunk_states(resident, stored)
+	stashed = [obj for (key, blocked, block_sight, payload) in chunks for obj in payload or ()]
+	return (savefile.pack_bits(explored), savefile.pack_chunks([(key, blocked, block_sight,
+		len(payload or ())) for (key, blocked, block_sight, payload) in chunks]),
+		object_rows(stashed))
+
+def unpack_world_state(world, sections, strings):
+	# Put a saved world's explored tiles, chunks and the objects stored with
+	# them back into world. The objects on the level came back from OBJS, so
+	# no chunk has any of those in its payload.
+	stashed = records_objects(sections.get(b'COBJ', b''), strings)
+	chunks = []
+	for (key, blocked, block_sight, count) in savefile.unpack_chunks(sections[b'CHNK'],
+			world.chunk_size):
+		chunks.append((key, blocked, block_sight, stashed[:count] or None))
+		del stashed[:count]
+	world.restore(savefile.unpack_bits(sections[b'EXPL'], (world.width, world.height)), chunks)
+
+def retire_world():
+	# The game is leaving the current world, for another game or on exit
+	if isinstance(my_map, ChunkedWorld): my_map.close()
+
+def load_game(path=SAVE_FILE):
 	global my_map, objects, player, inventory, game_msgs, game_state
- 
-	with shelve.open('savegame', 'r') as savefile:
-		my_map = savefile['my_map']
-		objects = savefile['objects']
-		player = objects[savefile['player_index']]  #get index of player in objects list and access it
-		inventory = savefile['inventory']
-		game_msgs = savefile['game_msgs']
-		game_state = savefile['game_state']
+	global game_seed, dungeon_level
+	
+	if not os.path.exists(path):
+		# Bring a save from before the binary format over, so this only
+		# happens once
+		load_legacy_game()
+		save_game(path)
+		return
+	
+	sections = savefile.read(path)
+	strings = savefile.StringTable(sections[b'STRS'])
+	(kind, player_index, state) = savefile.META.unpack(sections[b'META'])
+	retire_world()
+	if kind == savefile.CHUNKED_WORLD:
+		my_map = savefile.unpack_world(sections[b'WRLD'], WORLD_CACHE_DIR,
+			on_generate=populate_rooms, on_evict=stash_objects, on_load=restore_objects)
+		unpack_world_state(my_map, sections, strings)
+	else: my_map = savefile.unpack_map(sections[b'MAP '])
+	
+	saved = records_objects(sections[b'OBJS'], strings)
+	player = saved[player_index]
+	objects = ObjectStore(saved)
+	inventory = records_objects(sections[b'INVN'], strings)
+	game_msgs = MessageLog(MESSAGE_LOG_SIZE)
+	for (text, colour, count) in savefile.records(sections[b'MSGS'], savefile.MESSAGE).tolist():
+		game_msgs.add(strings[text], colours.Color(*colour), count)
+	game_state = strings[state]
+	if b'GAME' in sections: (game_seed, dungeon_level) = savefile.GAME.unpack(sections[b'GAME'])
+	else: (game_seed, dungeon_level) = (randint(0, 2 ** 31), 1)
+	
+	dungeon_levels.clear()
+	for (depth, data) in savefile.unpack_levels(sections.get(b'LVLS', b'')):
+		dungeon_levels.restore(depth, data)
+	index_objects()
+
+def load_legacy_game(path=LEGACY_SAVE_FILE):
+	global my_map, objects, player, inventory, game_msgs, game_state
+	global game_seed, dungeon_level
+	
+	import shelve
+	with shelve.open(path, 'r') as legacy_file:
+		retire_world()
+		my_map = legacy_file['my_map']
+		if isinstance(my_map, list): my_map = GameMap.from_tiles(my_map)	# Old Tile-grid save
+		objects = legacy_file['objects']
+		player = objects[legacy_file['player_index']]  #get index of player in objects list and access it
+		objects = ObjectStore(objects)
+		inventory = legacy_file['inventory']
+		game_msgs = legacy_file['game_msgs']
+		if isinstance(game_msgs, list):	# Wrapped lines, from before the message log
+			lines = game_msgs
+			game_msgs = MessageLog(MESSAGE_LOG_SIZE)
+			for (line, colour) in lines: game_msgs.add(line, colour)
+		game_state = legacy_file['game_state']
+	(game_seed, dungeon_level) = (randint(0, 2 ** 31), 1)
+	
+	dungeon_levels.clear()
+	index_objects()
 
 # ----------------------------------------------------------------------
 # Initialisation
 # ----------------------------------------------------------------------
 
-def new_game():
-	global player, inventory, game_msgs, game_state
+def next_game_seed():
+	# The seed the next new game will use, picked now so that its first level
+	# can be generated while the player is still in the menu
+	global upcoming_seed
+	if upcoming_seed is None:
+		upcoming_seed = randint(0, 2 ** 31)
+		if PREGENERATE_LEVELS and not LARGE_WORLD:
+			level_cache.prefetch(level_seed(upcoming_seed, 1), 1, generation_settings())
+	return upcoming_seed
+
+def level_seed(seed, depth):
+	return '%d:%d' % (seed, depth)
+
+def make_level(depth):
+	# This game's level at depth - from the level cache if it was built ahead,
+	# otherwise generated now, which gives exactly the same level. The levels
+	# after it are queued up.
+	seed = level_seed(game_seed, depth)
+	level = level_cache.get(seed, depth, generation_settings()) if PREGENERATE_LEVELS else None
+	if level is None: make_map(random.Random(seed), depth)
+	else: unpack_level(level)
+	
+	for ahead in range(1, PREGENERATE_LEVELS + 1):
+		level_cache.prefetch(level_seed(game_seed, depth + ahead), depth + ahead,
+			generation_settings())
+
+# Everything generation depends on besides the seed - worker processes are
+# told them along with it, and they're part of the level cache's key
+GENERATION_SETTINGS	= ('MAP_GENERATOR', 'MAP_WIDTH', 'MAP_HEIGHT', 'MAX_ROOMS', 'ROOM_MIN_SIZE',
+	'ROOM_MAX_SIZE', 'MAX_ROOM_MONSTERS', 'MAX_ROOM_ITEMS', 'ORC_STATS', 'TROLL_STATS',
+	'TROLL_CHANCE', 'BRAZIER_CHANCE')
+
+def generation_settings():
+	return tuple(globals()[name] for name in GENERATION_SETTINGS)
+
+def encode_level(map_data, rows, player_index=savefile.NO_PLAYER):
+	# A level packed on its own, from pack_map and object_rows
+	strings = savefile.StringTable()
+	return savefile.pack({
+		b'MAP ': map_data,
+		b'META': savefile.META.pack(savefile.GAME_MAP, player_index, strings.add('')),
+		b'OBJS': object_records(rows, strings),
+		b'STRS': strings.pack()})
+
+def decode_level(data):
+	# (game map, objects, index of the player in them) from encode_level
+	sections = savefile.unpack(data, 'level')
+	strings = savefile.StringTable(sections[b'STRS'])
+	(kind, player_index, state) = savefile.META.unpack(sections[b'META'])
+	return (savefile.unpack_map(sections[b'MAP ']),
+		records_objects(sections[b'OBJS'], strings), player_index)
+
+def pack_level(level):
+	(game_map, objs) = level
+	return encode_level(savefile.pack_map(game_map), object_rows(objs))
+
+def unpack_stored_level(data):
+	(game_map, objs, player_index) = decode_level(data)
+	return (game_map, objs)
+
+def generate_level(seed, depth, settings):
+	# What the level cache's worker processes run: make the level for seed on
+	# a stand-in player, and send it back packed. Not for the game's own
+	# process - it replaces the player and the level.
+	global player
+	globals().update(zip(GENERATION_SETTINGS, settings))
+	player = GameObject(0, 0, '@', 'player', colours.white, blocks=True)
+	make_map(random.Random(seed), depth)
+	
+	saved = list(objects)
+	return encode_level(savefile.pack_map(my_map), object_rows(saved), saved.index(player))
+
+def unpack_level(level):
+	# Make a level from generate_level the current one, with the player
+	# where the stand-in was
+	global my_map, objects
+	
+	(my_map, saved, player_index) = decode_level(level)
+	stand_in = saved[player_index]
+	(player.x, player.y) = (stand_in.x, stand_in.y)
+	saved[player_index] = player
+	objects = ObjectStore(saved)
+	index_objects()
+
+def change_level(depth):
+	# Take the stairs to depth. The level being left goes to the level
+	# manager, and the one at depth comes back from it, with the player on
+	# the stairs they'd have come down or up - or it's made for the first time.
+	global my_map, objects, dungeon_level, fov_recompute
+	
+	# Taken before the current level is put away, so that it can't be the
+	# one evicted to make room
+	going_down = depth > dungeon_level
+	level = dungeon_levels.take(depth)
+	remove_object(player)
+	dungeon_levels.put(dungeon_level, (my_map, list(objects)))
+	
+	if level is None: make_level(depth)
+	else:
+		(my_map, saved) = level
+		arrival = UP_STAIRS if going_down else DOWN_STAIRS
+		for obj in saved:
+			if obj.char == arrival and not (obj.fighter or obj.item):
+				(player.x, player.y) = (obj.x, obj.y)
+				break
+		objects = ObjectStore(saved + [player])
+		index_objects()
+	dungeon_level = depth
+	
+	fov_recompute = True
+	map_renderer.invalidate()
+	frame_limiter.invalidate()
+	if going_down: message('You descend deeper into THE ABYSS... (level %d)' % depth, colours.red)
+	else: message('You climb back up to level %d.' % depth, colours.light_violet)
+
+def take_stairs(char):
+	# Go down or up the stairs the player is standing on, if they are
+	for obj in object_index.at(player.x, player.y):
+		if obj.char == char and not (obj.fighter or obj.item):
+			change_level(dungeon_level + (1 if char == DOWN_STAIRS else -1))
+			return
+
+level_cache = LevelCache(generate_level, LEVEL_WORKERS, LEVEL_CACHE_SIZE)
+dungeon_levels = LevelManager(pack_level, unpack_stored_level, LIVE_LEVELS - 1, LEVEL_DIR)
+upcoming_seed = None
+
+def new_game(seed=None):
+	global player, inventory, game_msgs, game_state, game_seed, dungeon_level, upcoming_seed
 	
 	# Create the player object
-	fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
+	fighter_component = Fighter(*PLAYER_STATS, death_function=player_death)
 	player = GameObject(0, 0, '@', 'player', colours.white, blocks=True, fighter=fighter_component)
 	
+	game_seed = next_game_seed() if seed is None else seed
+	upcoming_seed = None
+	random.seed(game_seed)		# Combat and the like too, so a game can be replayed
+	dungeon_level = 1
+	dungeon_levels.clear()
+	
 	# Generate map
-	make_map()
+	retire_world()
+	if LARGE_WORLD: make_world(random.Random(level_seed(game_seed, dungeon_level)))
+	else: make_level(dungeon_level)
 	
 	game_state = 'playing'
 	inventory = []
 	
-	game_msgs = []
+	game_msgs = MessageLog(MESSAGE_LOG_SIZE)
 	
 	message('Welcome stranger! Prepare to perish in... THE ABYSS!', colours.red)
 	
@@ -768,30 +1504,192 @@ def play_game():
 	mouse_coord = (0, 0)
 	fov_recompute = True
 	con.clear()
+	map_renderer.invalidate()
+	frame_limiter.invalidate()
 	
-	while not tdl.event.is_window_closed():
-		# draw all objects in objects
-		render_all()	
-		tdl.flush()
+	while not input_source.is_window_closed():
+		# draw all objects in objects, if anything changed
+		if draw_frame():
+			if profiler.enabled: profiler.end_frame()
+			
+			# Clear Previously occupied space - the batch renderer redraws
+			# whatever changed by itself
+			if not BATCH_RENDER:
+				for obj in objects: obj.clear()
 		
-		# Clear Previously occupied space
-		for obj in objects: obj.clear()
+		# Handle Keys - waiting for them, unless a frame is due first
+		if profiler.enabled: profiler.pause()
+		events = input_source.wait(frame_limiter.timeout())
+		if profiler.enabled: profiler.resume()
 		
-		# Handle Keys
-		player_action = handle_keys()
-		if player_action == 'exit': break
+		# The turn sees what the player can, whether or not it's been drawn
+		update_fov()
+		player_action = handle_keys(events)
+		if player_action == 'exit':
+			save_game()
+			break
 		
 		if game_state == 'playing' and player_action != 'didnt-take-turn':
-			for obj in objects:
-				if obj.ai:
-					obj.ai.take_turn()
+			monster_turns()
+			autosaver.turn()
+		record_turn(events)
+
+def wake_monsters():
+	# Wake the dormant monsters that have come near the player, and put the
+	# ones left far behind back to sleep. Only the awake monsters and those
+	# near the player are looked at. They're woken in slot order, so turns
+	# come round in the same order every time.
+	near = [obj for obj in object_index.in_radius(player.x, player.y, ACTIVATION_RADIUS)
+		if obj.ai and obj.store is actors]
+	for obj in sorted(near, key=lambda obj: obj.slot): scheduler.wake(obj)
+	for obj in list(scheduler.awake):
+		if (not obj.ai or obj not in object_index or
+				obj.distance_to(player) > DORMANT_RADIUS):
+			scheduler.sleep(obj)
+
+def monster_turns():
+	# Only rebuilt if the player moved or the walls changed
+	if PATHFINDING: flow_field.update(my_map, player.x, player.y)
+	wake_monsters()
+	
+	# Everyone whose turn comes before the player's next one, tick by tick
+	for due in scheduler.pass_turn(player.fighter.speed):
+		# Killed or taken off the level since they were queued
+		due = [obj for obj in due if obj.ai and obj in object_index]
+		
+		# All the basic monsters acting this tick move at once...
+		batched = [obj.slot for obj in due if BATCH_AI and obj.store is actors and
+			actors.ai_kind[obj.slot] == BATCHED_AI]
+		if batched:
+			(moved, attackers) = actors.step_basic_monsters(player, visible, my_map,
+				flow_field if PATHFINDING else None, batched)
+			for obj in moved: object_index.update(obj)
+			for obj in attackers:
+				if player.fighter.hp > 0: obj.fighter.attack(player)
+		
+		# ...then the rest take their turns
+		for obj in due:
+			if obj.ai and not (BATCH_AI and obj.slot in batched): obj.ai.take_turn()
+
+def start_profiling():
+	# Wrap the phases of a frame in the profiler's timers
+	profiler.instrument(sys.modules[__name__], 'update_fov', 'render_all', 'render_map_cells',
+		'object_draws', 'update_lights', 'get_names_under_mouse', 'is_blocked', 'monster_turns',
+		'wake_monsters')
+	profiler.instrument(fov_engine, 'compute', label='fov')
+	profiler.instrument(map_renderer, 'render', label='map_renderer')
+	profiler.instrument(flow_field, 'update', label='flow_field')
+	profiler.instrument(ActorStore, 'step_basic_monsters', label='actors')
+
+def stop_profiling(csv_path=PROFILE_CSV, stacks_path=PROFILE_STACKS):
+	profiler.uninstrument()
+	if csv_path: profiler.write_csv(csv_path)
+	if stacks_path: profiler.write_collapsed(stacks_path)
+
+# Everything besides the seed that a recorded game depends on
+REPLAY_SETTINGS		= GENERATION_SETTINGS + ('LARGE_WORLD', 'WORLD_WIDTH', 'WORLD_HEIGHT',
+	'CHUNK_SIZE', 'CAMERA_WIDTH', 'CAMERA_HEIGHT', 'TORCH_RADIUS', 'PATHFINDING', 'BATCH_AI',
+	'ACTIVATION_RADIUS', 'DORMANT_RADIUS', 'PLAYER_STATS', 'HEAL_AMOUNT', 'LIGHTNING_RANGE',
+	'LIGHTNING_DAMAGE', 'CONFUSE_RANGE', 'CONFUSE_NUM_TURNS', 'FIREBALL_RADIUS', 'FIREBALL_DAMAGE',
+	'FLOW_RADIUS', 'FOV_ALGO', 'FOV_LIGHT_WALLS')
+journal = None
+
+def start_journal(path, **header):
+	# Record the game just started, from here on, to the journal at path
+	global journal, input_source
+	settings = dict((name, globals()[name]) for name in REPLAY_SETTINGS)
+	journal = Journal(path, game_seed, settings, **header)
+	input_source = RecordingInput(input_source, journal)
+
+def stop_journal():
+	global journal, input_source
+	if journal is not None:
+		journal.close()
+		input_source = input_source.source
+		journal = None
+
+def state_checksum():
+	# A short hash of the game as it stands - where everything on the level
+	# is and how hurt, what the player carries, and how far the random
+	# numbers have got - which replays check against the recorded game's
+	state = (dungeon_level, game_state, [(obj.name, obj.x, obj.y, obj.fighter and obj.fighter.hp)
+		for obj in objects], [obj.name for obj in inventory], random.getstate())
+	return hashlib.blake2b(repr(state).encode(), digest_size=8).hexdigest()
+
+def record_turn(events):
+	# After the game has handled events, if it's being recorded
+	if journal is not None and events: journal.check(state_checksum())
+
+def start_spectating(port=SPECTATE_PORT, ws_port=SPECTATE_WS_PORT):
+	global spectators
+	from spectate import SpectatorServer
+	spectators = SpectatorServer(port, ws_port)
+	spectators.start()
+
+def stop_spectating():
+	# Reports how much each viewer still watching was sent
+	global spectators
+	if spectators is not None:
+		spectators.stop()
+		spectators = None
+
+def init_display():
+	global tdl, root, con, panel
+	import tdl
+	
+	tdl.set_font(FONT_FILE, greyscale=True, altLayout=True)
+	root = tdl.init(SCREEN_WIDTH, SCREEN_HEIGHT, title="Roguelike", fullscreen=False)
+	con = make_console(SCREEN_WIDTH, SCREEN_HEIGHT)
+	panel = make_console(SCREEN_WIDTH, PANEL_HEIGHT)
+	startup_times.append(('display', time.perf_counter()))
+	
+	# Decode the menu background now, with everything else startup does
+	assets.image(MENU_BACKGROUND, ASSET_CACHE_DIR)
+	startup_times.append(('assets', time.perf_counter()))
+
+show_startup_report = False
+
+def first_frame():
+	# The first frame is on screen - that's the end of startup
+	global startup_times
+	startup_times.append(('first frame', time.perf_counter()))
+	if show_startup_report: print(startup_report(startup_times), file=sys.stderr)
+	startup_times = None
+
+def startup_report(times):
+	steps = ['%s %.1fms' % (name, (end - start) * 1000) for ((ignored, start), (name, end)) in
+		zip(times, times[1:])]
+	return 'Startup: %s - %.1fms to the first frame' % (', '.join(steps),
+		(times[-1][1] - times[0][1]) * 1000)
 
-tdl.set_font('arial10x10.png', greyscale=True, altLayout=True)
-root = tdl.init(SCREEN_WIDTH, SCREEN_HEIGHT, title="Roguelike", fullscreen=False)
-con = tdl.Console(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = tdl.Console(SCREEN_WIDTH, PANEL_HEIGHT)
+def main(argv=None):
+	global show_startup_report, JOURNAL_FILE
+	
+	parser = argparse.ArgumentParser(description='THE ABYSS, a roguelike.')
+	parser.add_argument('--startup-report', action='store_true',
+		help='print how long each step of startup took, up to the first frame')
+	parser.add_argument('--record', metavar='JOURNAL', default=JOURNAL_FILE,
+		help='record new games to JOURNAL, for replay.py')
+	parser.add_argument('--spectate', action='store_true', default=SPECTATE,
+		help='let viewers on this machine watch, on ports %d (TCP) and %d (WebSocket)' % (
+		SPECTATE_PORT, SPECTATE_WS_PORT))
+	args = parser.parse_args(argv)
+	show_startup_report = args.startup_report
+	JOURNAL_FILE = args.record
+	
+	if PROFILE: start_profiling()
+	init_display()
+	if args.spectate: start_spectating()
+	try: main_menu()
+	finally:
+		stop_spectating()
+		level_cache.shutdown()
+		dungeon_levels.close()
+		retire_world()
+		if PROFILE: stop_profiling()
 
-main_menu()
+if __name__ == '__main__':
+	main()
 
 	
 	
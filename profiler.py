@@ -0,0 +1,156 @@
+# Opt-in instrumentation. Nothing is timed until instrument() wraps
+# functions in place, so with profiling off the game runs exactly the code
+# it always did.
+#
+#	profiler = Profiler()
+#	profiler.instrument(module, 'update_fov', 'render_all')
+#	profiler.instrument(fov_engine, 'compute', label='fov')
+#
+# Sections nest: a section's self time leaves out the sections called from
+# it, and the time spent under each chain of sections is kept for a
+# collapsed-stack export that flame graph tools read.
+import csv
+import functools
+import time
+from collections import deque
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+class Section:
+	__slots__ = ('calls', 'total', 'self_time', 'recent')
+
+	def __init__(self, window):
+		self.calls = 0
+		self.total = 0.0
+		self.self_time = 0.0
+		self.recent = deque(maxlen=window)		# The last window call times
+
+def percentiles(values, points=PERCENTILES):
+	if not values: return [0.0] * len(points)
+	return [float(value) for value in np.percentile(np.fromiter(values, float), points)]
+
+class Profiler:
+	# Timers and call counts for instrumented functions, grouped into frames.
+	# Frame and call times are kept over a rolling window of the last window
+	# frames or calls for percentiles; totals cover the whole run.
+	def __init__(self, window=300, clock=time.perf_counter):
+		self.window = window
+		self.clock = clock
+		self.enabled = False
+		self.wrapped = []		# (target, name, original) for uninstrument()
+		self.clear()
+
+	def clear(self):
+		self.sections = {}		# name -> Section
+		self.stacks = {}		# (outermost, ..., innermost) -> self time there
+		self.stack = []			# [name, start, time in sections below] for each open section
+		self.frames = deque(maxlen=self.window)
+		self.frame_time = 0.0		# Busy time in the frame under way
+		self.busy_since = None
+		self.frame_sections = {}	# name -> time in the frame under way
+		self.last_frame = {}		# ...and in the last one finished
+
+	def enter(self, name):
+		self.stack.append([name, self.clock(), 0.0])
+
+	def leave(self):
+		(name, start, below) = self.stack[-1]
+		elapsed = self.clock() - start
+		path = tuple(entry[0] for entry in self.stack)
+		self.stack.pop()
+		if self.stack: self.stack[-1][2] += elapsed
+
+		section = self.sections.get(name)
+		if section is None: section = self.sections[name] = Section(self.window)
+		section.calls += 1
+		section.total += elapsed
+		section.self_time += elapsed - below
+		section.recent.append(elapsed)
+		self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - below
+		self.frame_sections[name] = self.frame_sections.get(name, 0.0) + elapsed
+
+	def wrap(self, name, function):
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			self.enter(name)
+			try: return function(*args, **kwargs)
+			finally: self.leave()
+		return timed
+
+	def instrument(self, target, *names, label=None):
+		# Time target.name (target is a module, class or object) for each
+		# name, recorded as 'label.name', or plain 'name' without a label
+		self.enabled = True
+		for name in names:
+			original = getattr(target, name)
+			setattr(target, name, self.wrap(name if label is None else label + '.' + name,
+				original))
+			self.wrapped.append((target, name, original))
+
+	def uninstrument(self):
+		for (target, name, original) in reversed(self.wrapped): setattr(target, name, original)
+		self.wrapped = []
+		self.enabled = False
+
+	# A frame's time is the time the game was busy between one frame being
+	# drawn and the next, leaving out waits for input - the game loop calls
+	# pause() before waiting and resume() after
+	def resume(self):
+		if self.busy_since is None: self.busy_since = self.clock()
+
+	def pause(self):
+		if self.busy_since is not None:
+			self.frame_time += self.clock() - self.busy_since
+			self.busy_since = None
+
+	def end_frame(self):
+		self.pause()
+		self.frames.append(self.frame_time)
+		self.frame_time = 0.0
+		self.last_frame = self.frame_sections
+		self.frame_sections = {}
+		self.resume()
+
+	def frame_percentiles(self):
+		return percentiles(self.frames)
+
+	def summary(self):
+		# (name, calls, total, self time, p50, p95, p99) for each section,
+		# most self time first
+		rows = [(name, section.calls, section.total, section.self_time) +
+			tuple(percentiles(section.recent)) for (name, section) in self.sections.items()]
+		rows.sort(key=lambda row: -row[3])
+		return rows
+
+	def overlay(self):
+		# A few short lines for the GUI panel: frame time percentiles and
+		# whatever took longest in the last frame, in milliseconds
+		(p50, p95, p99) = self.frame_percentiles()
+		lines = ['frame p50 %.1fms' % (p50 * 1000), 'p95 %.1f p99 %.1f' % (p95 * 1000, p99 * 1000)]
+		if self.last_frame:
+			(name, spent) = max(self.last_frame.items(), key=lambda item: item[1])
+			lines.append('%s %.1fms' % (name.split('.')[-1], spent * 1000))
+		return lines
+
+	def write_csv(self, path):
+		with open(path, 'w', newline='') as csv_file:
+			writer = csv.writer(csv_file)
+			writer.writerow(['section', 'calls', 'total_ms', 'self_ms', 'mean_ms',
+				'p50_ms', 'p95_ms', 'p99_ms'])
+			(p50, p95, p99) = self.frame_percentiles()
+			total = sum(self.frames)
+			writer.writerow(['frame', len(self.frames), '%.3f' % (total * 1000), '',
+				'%.3f' % (total / max(1, len(self.frames)) * 1000),
+				'%.3f' % (p50 * 1000), '%.3f' % (p95 * 1000), '%.3f' % (p99 * 1000)])
+			for (name, calls, total, self_time, p50, p95, p99) in self.summary():
+				writer.writerow([name, calls] + ['%.3f' % (value * 1000) for value in
+					(total, self_time, total / calls, p50, p95, p99)])
+
+	def write_collapsed(self, path):
+		# One 'outer;inner;innermost microseconds' line per chain of sections,
+		# as flamegraph.pl and speedscope take them
+		with open(path, 'w') as stacks_file:
+			for (path_names, spent) in sorted(self.stacks.items()):
+				stacks_file.write('%s %d\n' % (';'.join(path_names), round(spent * 1e6)))
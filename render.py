@@ -0,0 +1,107 @@
+import numpy as np
+
+# Map cell states, used to index the palettes
+UNEXPLORED		= 0
+DARK_GROUND		= 1
+DARK_WALL		= 2
+LIGHT_GROUND	= 3
+LIGHT_WALL		= 4
+
+def console_arrays(console):
+	# tdl consoles wrap a libtcod console - view it through tcod so its
+	# character and colour buffers can be written as [x, y] arrays.
+	# Returns None if this console can't be viewed that way.
+	try:
+		import tcod.console
+		return tcod.console.Console._from_cdata(console.console_c, order='F')
+	except (ImportError, AttributeError):
+		return None
+
+class Palette:
+	# Precomputed (char, fg, bg) for each cell state, stored as lookup tables
+	def __init__(self, entries):
+		# entries: one (char, fg, bg) tuple per state, in state order
+		self.ch = np.array([ord(ch) for (ch, fg, bg) in entries], dtype=np.intc)
+		self.fg = np.array([tuple(fg) for (ch, fg, bg) in entries], dtype=np.uint8)
+		self.bg = np.array([tuple(bg) for (ch, fg, bg) in entries], dtype=np.uint8)
+
+class MapRenderer:
+	# Draws the whole map in one batch - the frame is built with array
+	# operations from the wall/visible/explored masks, then pushed to the
+	# console at once instead of one draw_char per cell.
+	# The last frame pushed is kept, so only the cells that differ from it
+	# (FOV changes, newly explored tiles, objects that moved, died or were
+	# reordered) are written each time.
+	def __init__(self, palettes):
+		# palettes: {classic_tiles: Palette}
+		self.palettes = palettes
+		self.last = None			# (ch, fg, bg) of the last frame pushed
+		self.cells_redrawn = 0		# Cells written by the last frame
+		self.total_redrawn = 0
+		self.frames = 0
+
+	def invalidate(self):
+		# Forget the last frame, e.g. after the console was cleared, so the
+		# next one is drawn in full
+		self.last = None
+
+	def build(self, wall, visible, explored, classic=False, light=None):
+		palette = self.palettes[classic]
+
+		state = np.where(visible, LIGHT_GROUND + wall,
+			np.where(explored, DARK_GROUND + wall, UNEXPLORED))
+		(ch, fg, bg) = (palette.ch[state], palette.fg[state], palette.bg[state])
+		if light is not None: self.shade(palette, wall, visible, bg, light)
+		return (ch, fg, bg)
+
+	def shade(self, palette, wall, visible, bg, light):
+		# Light the visible cells' backgrounds: the lit colour scaled by the
+		# light's RGB, over the dark colour showing through where the light
+		# is weak. light is an [x, y, rgb] array of levels from 0 to 1.
+		dark = palette.bg[DARK_GROUND + wall].astype(np.float32)
+		lit = palette.bg[LIGHT_GROUND + wall].astype(np.float32)
+		level = light.max(axis=2, keepdims=True)
+		shaded = lit * light + dark * (1 - level)
+		bg[visible] = np.clip(shaded[visible], 0, 255).astype(np.uint8)
+
+	def overlay(self, ch, fg, bg, draws):
+		# Draw objects over a built frame. draws: (x, y, char, colour, bg)
+		# in draw order, with bg None to keep the tile's background
+		for (x, y, char, colour, obj_bg) in draws:
+			ch[x, y] = ord(char) if isinstance(char, str) else char
+			fg[x, y] = tuple(colour)
+			if obj_bg is not None: bg[x, y] = tuple(obj_bg)
+
+	def changed(self, ch, fg, bg):
+		# Mask of the cells that differ from the last frame pushed
+		if self.last is None or self.last[0].shape != ch.shape:
+			return np.ones(ch.shape, dtype=bool)
+		(last_ch, last_fg, last_bg) = self.last
+		return ((ch != last_ch) | (fg != last_fg).any(axis=2) |
+			(bg != last_bg).any(axis=2))
+
+	def push(self, console, ch, fg, bg, dirty):
+		(width, height) = ch.shape
+		view = console_arrays(console)
+		if view is not None:
+			view.ch[:width, :height][dirty] = ch[dirty]
+			view.fg[:width, :height][dirty] = fg[dirty]
+			view.bg[:width, :height][dirty] = bg[dirty]
+			return
+
+		# Fallback: no direct buffer access, so draw cell by cell
+		for (x, y) in np.argwhere(dirty):
+			console.draw_char(int(x), int(y), int(ch[x, y]), tuple(fg[x, y].tolist()),
+				bg=tuple(bg[x, y].tolist()))
+
+	def render(self, console, wall, visible, explored, draws=(), classic=False, light=None):
+		(ch, fg, bg) = self.build(wall, visible, explored, classic, light)
+		self.overlay(ch, fg, bg, draws)
+
+		dirty = self.changed(ch, fg, bg)
+		self.push(console, ch, fg, bg, dirty)
+		self.last = (ch, fg, bg)
+
+		self.cells_redrawn = int(np.count_nonzero(dirty))
+		self.total_redrawn += self.cells_redrawn
+		self.frames += 1
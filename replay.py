@@ -0,0 +1,95 @@
+# Replay a journal - a game recorded by prl.py --record or headless.py
+# --record - with no window, as fast as the game logic runs. After each
+# batch of input the game's state is checked against the checksum recorded
+# for it, so the replay is known to be the game that was played; a long
+# session recorded once is then a repeatable workload for profiling, and
+# a regression test for anything that changes how the game plays.
+#
+#	python replay.py game.journal --profile
+import argparse
+import sys
+import time
+
+import headless
+import journal
+import prl
+
+class Divergence(Exception):
+	# The replayed game isn't in the state the recorded one was
+	def __init__(self, turn, expected, actual):
+		Exception.__init__(self, 'turn %d: the state should be %s but is %s' % (turn, expected,
+			actual))
+		self.turn = turn
+
+def replay(path, render=False, verify=True, profile=False):
+	# Play the journal at path to its end and return some statistics about
+	# it. Raises Divergence as soon as a checksum doesn't match, unless
+	# verify is off. profile times the phases of each turn, as
+	# prl.start_profiling() does.
+	(header, entries) = journal.read(path)
+	source = journal.ReplayInput(entries)
+	headless.setup(source)
+	for (name, value) in header['settings'].items():
+		setattr(prl, name, tuple(value) if isinstance(value, list) else value)
+	prl.make_engines()		# Made before the settings were known
+	if profile: prl.start_profiling()
+
+	prl.new_game(header['seed'])
+	if header.get('god'): prl.player.fighter.hp = prl.player.fighter.max_hp = 10 ** 9
+	prl.mouse_coord = (0, 0)
+	prl.fov_recompute = True
+
+	(turns, checked) = (0, 0)
+	start = time.perf_counter()
+	while not source.is_window_closed():
+		if prl.profiler.enabled: prl.profiler.end_frame()
+		if render: prl.render_all()
+		else: prl.update_fov()
+
+		events = source.get()
+		player_action = prl.handle_keys(events)
+		if player_action == 'exit': break
+
+		if prl.game_state == 'playing' and player_action != 'didnt-take-turn':
+			prl.monster_turns()
+		expected = source.check()
+		if verify:
+			actual = prl.state_checksum()
+			if actual != expected: raise Divergence(turns, expected, actual)
+			checked += 1
+		turns += 1
+	elapsed = time.perf_counter() - start
+
+	return {
+		'turns': turns,
+		'checked': checked,
+		'seconds': elapsed,
+		'turns_per_second': turns / elapsed if elapsed else 0.0,
+		'game_state': prl.game_state,
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='Replay a recorded game without a window.')
+	parser.add_argument('journal')
+	parser.add_argument('--render', action='store_true', help='also run render_all each turn')
+	parser.add_argument('--no-verify', action='store_true',
+		help="don't check the game's state after each turn")
+	parser.add_argument('--profile', action='store_true',
+		help='time the phases of each turn and write %s and %s' % (prl.PROFILE_CSV,
+		prl.PROFILE_STACKS))
+	args = parser.parse_args()
+
+	try: stats = replay(args.journal, args.render, not args.no_verify, args.profile)
+	except (Divergence, journal.JournalError) as error:
+		print('%s: %s' % (args.journal, error), file=sys.stderr)
+		sys.exit(1)
+	print('%d turns in %.3fs - %.1f turns/second, %d checksums matched (%s)' % (stats['turns'],
+		stats['seconds'], stats['turns_per_second'], stats['checked'], stats['game_state']))
+
+	if args.profile:
+		prl.stop_profiling()
+		print('turn time p50 %.3fms, p95 %.3fms, p99 %.3fms' %
+			tuple(value * 1000 for value in prl.profiler.frame_percentiles()))
+
+if __name__ == '__main__':
+	main()
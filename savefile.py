@@ -0,0 +1,279 @@
+# Binary save files.
+#
+# A save is a short header (magic, format version) followed by a zlib
+# compressed body made of tagged sections:
+#	tag (4 bytes), length (uint32), data
+# Map layers are bit-packed, objects are fixed-layout records that load with
+# a single np.frombuffer, and all the text lives in one string table.
+# Readers skip sections they don't know, and saves written by an older
+# format version are brought up to date on load by MIGRATIONS.
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+from gamemap import GameMap
+from scheduler import NORMAL_SPEED
+from world import ChunkedWorld, chunk_files
+
+MAGIC	= b'PRLSAVE\x00'
+VERSION	= 4
+
+HEADER	= struct.Struct('<8sH')		# magic, format version
+SECTION	= struct.Struct('<4sI')		# tag, length of the data that follows
+
+# META: map kind, index of the player in the objects, game state (string)
+META	= struct.Struct('<BII')
+# GAME: the game's seed, and the dungeon level the player is on
+GAME	= struct.Struct('<qI')
+# MAP: width, height, then the blocked/block_sight/explored bits
+MAP		= struct.Struct('<II')
+# WRLD: width, height, chunk size, max chunks, seed (-1 for none), then the
+# world's version/generated/loaded/evicted counts. The world itself follows
+# in EXPL, its explored bits, and CHNK, each chunk generated so far: its key,
+# whether its tiles follow (if not, they're generated again), and how many
+# of the objects in COBJ were stored with it, then its blocked and
+# block_sight bits.
+WORLD	= struct.Struct('<IIIIqIIII')
+CHUNK	= struct.Struct('<IIBI')
+# Format 3 WRLD, with the cache directory (string) the world was left in
+# after the seed
+WORLD_3	= struct.Struct('<IIIIqIIIII')
+# LVLS: the other levels of the dungeon, each a depth and the length of the
+# packed level that follows - a save of its own, made by the game
+LEVEL	= struct.Struct('<II')
+
+NO_PLAYER	= 0xFFFFFFFF	# META's player index for a level the player isn't on
+
+GAME_MAP		= 0
+CHUNKED_WORLD	= 1
+
+# Object record flags
+BLOCKS	= 1
+FIGHTER	= 2
+ITEM	= 4
+
+# Functions and AI classes are saved as codes - their position in the
+# tables the game passes in - and names and text as string table indices
+OBJECT = np.dtype([
+	('x', '<i4'), ('y', '<i4'),
+	('char', '<u4'), ('name', '<u4'), ('colour', 'u1', 3), ('flags', 'u1'),
+	('hp', '<i4'), ('max_hp', '<i4'), ('defense', '<i4'), ('power', '<i4'), ('speed', '<i4'),
+	('death', 'u1'), ('ai', 'u1'), ('old_ai', 'u1'), ('use', 'u1'),
+	('ai_turns', '<i4')])
+
+# Format 1 objects, before speeds
+OBJECT_1 = np.dtype([(name, OBJECT.fields[name][0]) for name in OBJECT.names if name != 'speed'])
+
+# Messages as said, unwrapped, with how many times in a row
+MESSAGE = np.dtype([('text', '<u4'), ('colour', 'u1', 3), ('count', '<u4')])
+
+# Format 2 messages, one per wrapped line
+MESSAGE_2 = np.dtype([('text', '<u4'), ('colour', 'u1', 3)])
+
+def add_speeds(sections):
+	# Format 2 gave fighters a speed - everything from before moves at the
+	# normal one
+	for tag in (b'OBJS', b'INVN'):
+		if tag not in sections: continue
+		old = np.frombuffer(sections[tag], dtype=OBJECT_1)
+		new = np.zeros(len(old), dtype=OBJECT)
+		for name in OBJECT_1.names: new[name] = old[name]
+		new['speed'][new['flags'] & FIGHTER != 0] = NORMAL_SPEED
+		sections[tag] = new.tobytes()
+	return sections
+
+def add_message_counts(sections):
+	# Format 3 stopped wrapping messages before saving them and coalesced
+	# repeats - the old lines are kept as they were, each said once
+	if b'MSGS' in sections:
+		old = np.frombuffer(sections[b'MSGS'], dtype=MESSAGE_2)
+		new = np.zeros(len(old), dtype=MESSAGE)
+		for name in MESSAGE_2.names: new[name] = old[name]
+		new['count'] = 1
+		sections[b'MSGS'] = new.tobytes()
+	return sections
+
+def add_world_chunks(sections):
+	# Format 4 saves a chunked world's chunks and explored tiles, where format
+	# 3 only pointed at the cache directory they were in - which play went on
+	# changing after the save. What's still there is brought over: explored
+	# tiles, and which chunks were generated (their tiles are generated
+	# again). Objects stored away with chunks off the level are lost - they
+	# can't be read without the game.
+	if b'WRLD' not in sections: return sections
+	(width, height, chunk_size, max_chunks, seed, cache_dir, version, generated, loaded,
+		evicted) = WORLD_3.unpack(sections[b'WRLD'])
+	directory = StringTable(sections[b'STRS'])[cache_dir]
+	sections[b'WRLD'] = WORLD.pack(width, height, chunk_size, max_chunks, seed, version,
+		generated, loaded, evicted)
+	try:
+		explored = np.fromfile(os.path.join(directory, 'explored.dat'), dtype=bool)
+		explored = explored.reshape((width, height), order='F')
+	except (OSError, ValueError): explored = np.zeros((width, height), dtype=bool)
+	sections[b'EXPL'] = pack_bits(explored)
+	keys = sorted(chunk_files(directory)) if os.path.isdir(directory) else []
+	sections[b'CHNK'] = pack_chunks([(key, None, None, 0) for key in keys])
+	return sections
+
+# version -> function(sections) returning the sections for version + 1
+MIGRATIONS = {1: add_speeds, 2: add_message_counts, 3: add_world_chunks}
+
+class SaveError(Exception):
+	pass
+
+def is_save(path):
+	with open(path, 'rb') as save_file:
+		return save_file.read(len(MAGIC)) == MAGIC
+
+def pack(sections, level=6):
+	# sections is a dict of tag -> bytes
+	body = b''.join(SECTION.pack(tag, len(data)) + data for (tag, data) in sections.items())
+	return HEADER.pack(MAGIC, VERSION) + zlib.compress(body, level)
+
+def write(path, sections, level=6):
+	# The save is written to a temporary file next to path and renamed over
+	# it, so path always holds either the old save or the whole of the new one
+	data = pack(sections, level)
+	(handle, temp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+		suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+	try:
+		with os.fdopen(handle, 'wb') as save_file:
+			save_file.write(data)
+			save_file.flush()
+			os.fsync(save_file.fileno())
+		os.replace(temp_path, path)
+	except BaseException:
+		if os.path.exists(temp_path): os.remove(temp_path)
+		raise
+
+def read(path):
+	with open(path, 'rb') as save_file: return unpack(save_file.read(), path)
+
+def unpack(data, name='save'):
+	# The sections of a save, migrated to the current format version
+	if len(data) < HEADER.size: raise SaveError('%s is not a save file' % name)
+	(magic, version) = HEADER.unpack_from(data)
+	if magic != MAGIC: raise SaveError('%s is not a save file' % name)
+	if version > VERSION:
+		raise SaveError('%s is from a newer version of the game (format %d)' % (name, version))
+
+	try: body = zlib.decompress(data[HEADER.size:])
+	except zlib.error as error: raise SaveError('%s is damaged: %s' % (name, error))
+
+	sections = {}
+	offset = 0
+	while offset < len(body):
+		(tag, length) = SECTION.unpack_from(body, offset)
+		offset += SECTION.size
+		sections[tag] = body[offset:offset + length]
+		offset += length
+
+	while version < VERSION:
+		if version not in MIGRATIONS:
+			raise SaveError('%s is in format %d, which can no longer be read' % (name, version))
+		sections = MIGRATIONS[version](sections)
+		version += 1
+	return sections
+
+class StringTable:
+	# Every distinct string in a save, stored once and referred to by index
+	def __init__(self, data=b''):
+		self.strings = data.decode('utf-8').split('\0') if data else []
+		self.index = dict((text, i) for (i, text) in enumerate(self.strings))
+
+	def add(self, text):
+		i = self.index.get(text)
+		if i is None:
+			i = self.index[text] = len(self.strings)
+			self.strings.append(text)
+		return i
+
+	def __getitem__(self, i):
+		return self.strings[i]
+
+	def pack(self):
+		return '\0'.join(self.strings).encode('utf-8')
+
+def pack_bits(array):
+	return np.packbits(np.asarray(array, dtype=bool).ravel(order='F')).tobytes()
+
+def unpack_bits(data, shape):
+	bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=shape[0] * shape[1])
+	return bits.astype(bool).reshape(shape, order='F')
+
+def records(data, dtype):
+	# Records straight out of a section, without copying
+	return np.frombuffer(data, dtype=dtype)
+
+def pack_map(game_map):
+	layers = [pack_bits(layer) for layer in
+		(game_map.blocked, game_map.block_sight, game_map.explored)]
+	return MAP.pack(game_map.width, game_map.height) + b''.join(layers)
+
+def unpack_map(data):
+	(width, height) = MAP.unpack_from(data)
+	size = (width * height + 7) // 8
+	game_map = GameMap(width, height)
+	for (i, name) in enumerate(('blocked', 'block_sight', 'explored')):
+		start = MAP.size + i * size
+		getattr(game_map, name)[...] = unpack_bits(data[start:start + size], (width, height))
+	return game_map
+
+def pack_levels(levels):
+	# levels is a list of (depth, packed level)
+	return b''.join(LEVEL.pack(depth, len(data)) + data for (depth, data) in levels)
+
+def unpack_levels(data):
+	levels = []
+	offset = 0
+	while offset < len(data):
+		(depth, length) = LEVEL.unpack_from(data, offset)
+		offset += LEVEL.size
+		levels.append((depth, data[offset:offset + length]))
+		offset += length
+	return levels
+
+def pack_world(world):
+	# Only the settings - the world's state goes in EXPL and CHNK
+	seed = -1 if world.seed is None else world.seed
+	return WORLD.pack(world.width, world.height, world.chunk_size, world.max_chunks,
+		seed, world.version, world.generated, world.loaded, world.evicted)
+
+def unpack_world(data, cache_dir=None, **hooks):
+	# A new world with the saved settings, for ChunkedWorld.restore() to put
+	# its state back into
+	(width, height, chunk_size, max_chunks, seed, version, generated, loaded,
+		evicted) = WORLD.unpack(data)
+	world = ChunkedWorld(width, height, chunk_size, None if seed == -1 else seed,
+		cache_dir, max_chunks, **hooks)
+	(world.version, world.generated, world.loaded, world.evicted) = (version,
+		generated, loaded, evicted)
+	return world
+
+def pack_chunks(chunks):
+	# chunks is (key, blocked, block_sight, number of objects) for each - the
+	# tiles None to have them generated again
+	data = []
+	for ((cx, cy), blocked, block_sight, count) in chunks:
+		data.append(CHUNK.pack(cx, cy, blocked is not None, count))
+		if blocked is not None: data.extend((pack_bits(blocked), pack_bits(block_sight)))
+	return b''.join(data)
+
+def unpack_chunks(data, chunk_size):
+	shape = (chunk_size, chunk_size)
+	size = (chunk_size * chunk_size + 7) // 8
+	chunks = []
+	offset = 0
+	while offset < len(data):
+		(cx, cy, tiles, count) = CHUNK.unpack_from(data, offset)
+		offset += CHUNK.size
+		(blocked, block_sight) = (None, None)
+		if tiles:
+			blocked = unpack_bits(data[offset:offset + size], shape)
+			block_sight = unpack_bits(data[offset + size:offset + 2 * size], shape)
+			offset += 2 * size
+		chunks.append(((cx, cy), blocked, block_sight, count))
+	return chunks
@@ -0,0 +1,70 @@
+import heapq
+
+ACTION_COST		= 1000		# Energy an action takes
+NORMAL_SPEED	= 100		# Energy gained per tick at normal speed
+
+def wait_for(speed, energy):
+	# Ticks until something with energy, gaining speed a tick, can act
+	return max(0, -(-(ACTION_COST - energy) // max(1, speed)))
+
+class Scheduler:
+	# Energy based turn order for awake actors. Every tick an actor gains its
+	# speed in energy and it acts on reaching ACTION_COST, so one twice as
+	# fast acts twice as often. Rather than ticking everyone, each awake actor
+	# sits in a priority queue under the time of its next action, carrying
+	# over any spare energy.
+	# Anything not awake is dormant: not in the queue and costing nothing per
+	# turn - the game wakes actors as the player gets near or hurts them.
+	# speed(obj) gives an actor's current speed.
+	def __init__(self, speed):
+		self.speed = speed
+		self.clear()
+
+	def clear(self):
+		self.time = 0
+		self.queue = []			# [time, order, obj, energy left after acting]
+		self.awake = {}			# obj -> its entry in the queue
+		self.order = 0			# Ties go to whoever was queued first
+		self.spare = 0			# The player's energy carried between turns
+
+	def __len__(self):
+		return len(self.awake)
+
+	def __contains__(self, obj):
+		return obj in self.awake
+
+	def push(self, obj, time, energy):
+		speed = self.speed(obj)
+		wait = wait_for(speed, energy)
+		entry = [time + wait, self.order, obj, energy + wait * speed - ACTION_COST]
+		self.order += 1
+		self.awake[obj] = entry
+		heapq.heappush(self.queue, entry)
+
+	def wake(self, obj):
+		# Start obj taking turns, from empty
+		if obj not in self.awake: self.push(obj, self.time, 0)
+
+	def sleep(self, obj):
+		# Its queue entry is dropped when it comes up
+		self.awake.pop(obj, None)
+
+	def pass_turn(self, speed=NORMAL_SPEED):
+		# The player takes an action at speed: yields the actors whose turns
+		# come before the player's next one, a list per tick, in order
+		wait = wait_for(speed, self.spare)
+		self.spare += wait * speed - ACTION_COST
+		until = self.time + wait
+
+		queue = self.queue
+		while queue and queue[0][0] <= until:
+			self.time = queue[0][0]
+			due = []
+			while queue and queue[0][0] == self.time:
+				entry = heapq.heappop(queue)
+				obj = entry[2]
+				if self.awake.get(obj) is not entry: continue
+				due.append(obj)
+				self.push(obj, self.time, entry[3])
+			if due: yield due
+		self.time = until
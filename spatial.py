@@ -0,0 +1,103 @@
+import math
+
+class SpatialIndex:
+	# Spatial hash of GameObjects. Every object is filed under its exact cell,
+	# for O(1) lookups at a point, and under a coarse bucket of cells, for
+	# radius and nearest-neighbour queries. Buckets are dicts used as ordered
+	# sets, so queries find objects in the same order every run - which of two
+	# equally near monsters is nearest can't depend on where they were
+	# allocated.
+	def __init__(self, objects=(), bucket_size=8):
+		self.bucket_size = bucket_size
+		self.cells = {}		# (x, y) -> objects at that cell
+		self.buckets = {}	# (bx, by) -> objects in that bucket, in filing order
+		self.positions = {}	# object -> (x, y) it is currently filed under
+
+		for obj in objects: self.add(obj)
+
+	def __len__(self):
+		return len(self.positions)
+
+	def __contains__(self, obj):
+		return obj in self.positions
+
+	def bucket(self, x, y):
+		return (x // self.bucket_size, y // self.bucket_size)
+
+	def add(self, obj):
+		pos = (obj.x, obj.y)
+		self.positions[obj] = pos
+		self.cells.setdefault(pos, []).append(obj)
+		self.buckets.setdefault(self.bucket(*pos), {})[obj] = None
+
+	def remove(self, obj):
+		pos = self.positions.pop(obj)
+		cell = self.cells[pos]
+		cell.remove(obj)
+		if not cell: del self.cells[pos]
+
+		bucket = self.bucket(*pos)
+		del self.buckets[bucket][obj]
+		if not self.buckets[bucket]: del self.buckets[bucket]
+
+	def update(self, obj):
+		# Re-file an object after its x/y have changed
+		if self.positions[obj] != (obj.x, obj.y):
+			self.remove(obj)
+			self.add(obj)
+
+	def at(self, x, y):
+		return self.cells.get((x, y), ())
+
+	def blocking_at(self, x, y):
+		for obj in self.cells.get((x, y), ()):
+			if obj.blocks: return obj
+		return None
+
+	def in_radius(self, x, y, radius):
+		# Every object within radius (inclusive) of (x, y)
+		bx1, by1 = self.bucket(int(x - radius), int(y - radius))
+		bx2, by2 = self.bucket(int(x + radius), int(y + radius))
+
+		found = []
+		for bx in range(bx1, bx2 + 1):
+			for by in range(by1, by2 + 1):
+				for obj in self.buckets.get((bx, by), ()):
+					if math.sqrt((obj.x - x) ** 2 + (obj.y - y) ** 2) <= radius:
+						found.append(obj)
+		return found
+
+	def in_rect(self, x1, y1, x2, y2):
+		# Every object with x1 <= x < x2 and y1 <= y < y2
+		(bx1, by1) = self.bucket(x1, y1)
+		(bx2, by2) = self.bucket(x2 - 1, y2 - 1)
+
+		found = []
+		for bx in range(bx1, bx2 + 1):
+			for by in range(by1, by2 + 1):
+				for obj in self.buckets.get((bx, by), ()):
+					if x1 <= obj.x < x2 and y1 <= obj.y < y2: found.append(obj)
+		return found
+
+	def nearest(self, x, y, max_dist, predicate=None):
+		# The closest object strictly nearer than max_dist that satisfies
+		# predicate. Buckets are searched in rings outwards from (x, y), and
+		# the search stops once no further ring can hold anything closer.
+		size = self.bucket_size
+		(cx, cy) = self.bucket(x, y)
+
+		best = None
+		best_dist = max_dist
+		for ring in range(int(max_dist // size) + 2):
+			for bx in range(cx - ring, cx + ring + 1):
+				for by in range(cy - ring, cy + ring + 1):
+					if max(abs(bx - cx), abs(by - cy)) != ring: continue
+					for obj in self.buckets.get((bx, by), ()):
+						dist = math.sqrt((obj.x - x) ** 2 + (obj.y - y) ** 2)
+						if dist < best_dist and (predicate is None or predicate(obj)):
+							best = obj
+							best_dist = dist
+
+			# Anything in the next ring is at least this far away
+			if ring * size >= best_dist: break
+		return best
@@ -0,0 +1,362 @@
+# Spectating - the game's screen streamed live to viewers on this machine,
+# over plain TCP and WebSocket. The game hands each flushed frame to
+# SpectatorServer.frame(), which copies the root console and returns; an
+# asyncio loop on its own thread diffs it against the last frame sent and
+# broadcasts just the cells that changed. A viewer that can't keep up has
+# its backlog dropped and is sent a keyframe when it's ready again, so it
+# never holds up the game or the other viewers.
+#
+# Every message is a frame:
+#	kind		1 byte, b'K' a keyframe or b'D' the cells changed since the last
+#	number		uint32, frame number
+#	width		uint16
+#	height		uint16
+#	cells		zlib compressed - a keyframe is every cell's CELL in row order,
+#				a delta a uint32 count and then that many INDEXED_CELLs
+# all little-endian. Over TCP each message is preceded by its length, as a
+# uint32; over WebSocket each is one binary message.
+#
+#	python spectate.py --port 7777		a text-only viewer, for trying it out
+import argparse
+import asyncio
+import base64
+import hashlib
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+from render import console_arrays
+
+HOST				= '127.0.0.1'		# Only ever listens here - viewers on this machine
+HEADER				= struct.Struct('<cIHH')
+LENGTH				= struct.Struct('<I')
+CELL				= np.dtype([('ch', '<u4'), ('fg', 'u1', 3), ('bg', 'u1', 3)])
+INDEXED_CELL		= np.dtype([('index', '<u4'), ('ch', '<u4'), ('fg', 'u1', 3), ('bg', 'u1', 3)])
+WEBSOCKET_GUID		= b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_REQUEST			= 8192		# Bytes of WebSocket handshake accepted
+
+def encode_keyframe(number, frame):
+	(ch, fg, bg) = frame
+	(width, height) = ch.shape
+	cells = np.empty((height, width), dtype=CELL)
+	cells['ch'] = ch.T
+	cells['fg'] = fg.transpose(1, 0, 2)
+	cells['bg'] = bg.transpose(1, 0, 2)
+	return HEADER.pack(b'K', number, width, height) + zlib.compress(cells.tobytes(), 1)
+
+def encode_delta(number, frame, last):
+	# The cells of frame that differ from last, or None if none do
+	(ch, fg, bg) = frame
+	(width, height) = ch.shape
+	changed = ((ch != last[0]) | (fg != last[1]).any(axis=2) | (bg != last[2]).any(axis=2)).T
+	(ys, xs) = np.nonzero(changed)
+	if not len(xs): return None
+	cells = np.empty(len(xs), dtype=INDEXED_CELL)
+	cells['index'] = ys * width + xs
+	cells['ch'] = ch[xs, ys]
+	cells['fg'] = fg[xs, ys]
+	cells['bg'] = bg[xs, ys]
+	payload = LENGTH.pack(len(cells)) + cells.tobytes()
+	return HEADER.pack(b'D', number, width, height) + zlib.compress(payload, 1)
+
+def decode(message, screen=None):
+	# Apply a message to screen - a [height, width] CELL array, or None
+	# before the first keyframe - and return the updated screen
+	(kind, number, width, height) = HEADER.unpack_from(message)
+	payload = zlib.decompress(message[HEADER.size:])
+	if kind == b'K': return np.frombuffer(payload, dtype=CELL).reshape(height, width).copy()
+	if screen is None or screen.shape != (height, width): return screen	# Wait for a keyframe
+	(count,) = LENGTH.unpack_from(payload)
+	cells = np.frombuffer(payload, dtype=INDEXED_CELL, count=count, offset=LENGTH.size)
+	flat = screen.reshape(-1)
+	flat['ch'][cells['index']] = cells['ch']
+	flat['fg'][cells['index']] = cells['fg']
+	flat['bg'][cells['index']] = cells['bg']
+	return screen
+
+def websocket_frame(payload, opcode=0x2):
+	# An unmasked, unfragmented server frame - binary by default
+	length = len(payload)
+	if length < 126: header = struct.pack('!BB', 0x80 | opcode, length)
+	elif length < 65536: header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+	else: header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+	return header + payload
+
+class Viewer:
+	# One connection, with the messages waiting to go to it
+	def __init__(self, writer, kind):
+		self.writer = writer
+		self.kind = kind					# 'tcp' or 'websocket'
+		self.address = writer.get_extra_info('peername')
+		self.queue = deque()
+		self.ready = asyncio.Event()
+		self.needs_keyframe = True
+		self.connected = time.perf_counter()
+
+		self.bytes_sent = 0
+		self.frames = 0
+		self.keyframes = 0
+		self.resyncs = 0		# Times it fell behind and was sent a keyframe instead
+
+	def frame(self, message):
+		return websocket_frame(message) if self.kind == 'websocket' else (
+			LENGTH.pack(len(message)) + message)
+
+	def stats(self):
+		seconds = time.perf_counter() - self.connected
+		return {
+			'address': '%s:%d' % self.address[:2],
+			'kind': self.kind,
+			'seconds': seconds,
+			'bytes': self.bytes_sent,
+			'bytes_per_second': self.bytes_sent / seconds if seconds else 0.0,
+			'frames': self.frames,
+			'keyframes': self.keyframes,
+			'resyncs': self.resyncs,
+		}
+
+def describe(stats):
+	return '%s viewer %s: %.1fkB in %.0fs, %.2fkB/s - %d frames, %d keyframes, %d resyncs' % (
+		stats['kind'], stats['address'], stats['bytes'] / 1000, stats['seconds'],
+		stats['bytes_per_second'] / 1000, stats['frames'], stats['keyframes'], stats['resyncs'])
+
+class SpectatorServer:
+	# Streams frames to viewers from a thread of its own. port and ws_port
+	# are for TCP and WebSocket viewers, either None for none or 0 for any
+	# free port (see ports once started). A viewer more than backlog frames
+	# behind skips to a keyframe. log(text) reports viewers coming and going,
+	# with the bandwidth each one used.
+	def __init__(self, port=7777, ws_port=7778, backlog=8, log=None):
+		self.requested = {'tcp': port, 'websocket': ws_port}
+		self.backlog = backlog
+		self.log = log or (lambda text: print(text, file=sys.stderr))
+		self.ports = {}
+		self.viewers = []
+		self.watching = set()		# The tasks streaming to viewers
+
+		self.lock = threading.Lock()
+		self.pending = None			# The newest frame from the game, not yet sent
+		self.last = None			# The last frame sent
+		self.number = 0
+		self.keyframe = None		# The last frame as a keyframe, made when first wanted
+
+		self.loop = None
+		self.wake = None
+		self.thread = None
+		self.started = threading.Event()
+		self.stopping = False
+		self.error = None
+		self.frames_published = 0
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='spectate', daemon=True)
+		self.thread.start()
+		self.started.wait()
+		if self.error is not None: raise self.error
+
+	def run(self):
+		try: asyncio.run(self.serve())
+		except Exception as error:
+			(self.error, self.loop) = (error, None)
+			self.started.set()
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		self.wake = asyncio.Event()
+		servers = []
+		for (kind, port) in self.requested.items():
+			if port is None: continue
+			handler = self.tcp_viewer if kind == 'tcp' else self.websocket_viewer
+			server = await asyncio.start_server(handler, HOST, port)
+			self.ports[kind] = server.sockets[0].getsockname()[1]
+			servers.append(server)
+		self.started.set()
+
+		while not self.stopping:
+			await self.wake.wait()
+			self.wake.clear()
+			self.publish()
+
+		# Closing a viewer ends its reader, and so its task
+		for server in servers: server.close()
+		for viewer in list(self.viewers): viewer.writer.close()
+		await asyncio.gather(*self.watching, return_exceptions=True)
+		for server in servers: await server.wait_closed()
+
+	def stop(self):
+		if self.loop is None or self.thread is None: return
+		for viewer in list(self.viewers): self.log(describe(viewer.stats()))
+
+		def stopping():
+			self.stopping = True
+			self.wake.set()
+		(loop, self.loop) = (self.loop, None)		# No more frames
+		loop.call_soon_threadsafe(stopping)
+		self.thread.join(5)
+		self.thread = None
+
+	# On the game's thread
+	def frame(self, console):
+		# The game has flushed console to the screen. Copying it is all this
+		# costs the game - anything else happens on the server's thread.
+		loop = self.loop
+		view = console_arrays(console)
+		if view is None or loop is None: return
+		frame = (view.ch.copy(), view.fg.copy(), view.bg.copy())
+		with self.lock: self.pending = frame
+		loop.call_soon_threadsafe(self.wake.set)
+
+	# On the server's thread
+	def publish(self):
+		# Send viewers what changed in the newest frame. Frames the game
+		# drew while the last was being sent are only ever diffed as one.
+		with self.lock: (frame, self.pending) = (self.pending, None)
+		if frame is None: return
+		if self.last is not None and self.last[0].shape == frame[0].shape:
+			message = encode_delta(self.number + 1, frame, self.last)
+			if message is None: return
+		else: message = None		# The size changed - everyone needs a keyframe
+		self.number += 1
+		self.last = frame
+		self.keyframe = None
+		self.frames_published += 1
+
+		for viewer in self.viewers:
+			if message is None: viewer.needs_keyframe = True
+			elif not viewer.needs_keyframe:
+				if len(viewer.queue) >= self.backlog:
+					viewer.queue.clear()
+					viewer.needs_keyframe = True
+					viewer.resyncs += 1
+				else: viewer.queue.append(message)
+			viewer.ready.set()
+
+	def current_keyframe(self):
+		if self.keyframe is None: self.keyframe = encode_keyframe(self.number, self.last)
+		return self.keyframe
+
+	async def stream(self, viewer):
+		# Send a viewer its messages as fast as it takes them, until it goes
+		try: await self.send(viewer)
+		except ConnectionError: pass
+
+	async def send(self, viewer):
+		while True:
+			await viewer.ready.wait()
+			viewer.ready.clear()
+			if viewer.needs_keyframe:
+				if self.last is None: continue
+				viewer.needs_keyframe = False
+				viewer.queue.clear()
+				messages = [self.current_keyframe()]
+				viewer.keyframes += 1
+			else:
+				messages = list(viewer.queue)
+				viewer.queue.clear()
+
+			for message in messages:
+				data = viewer.frame(message)
+				viewer.writer.write(data)
+				viewer.bytes_sent += len(data)
+				viewer.frames += 1
+			await viewer.writer.drain()
+
+	async def watch(self, viewer, read):
+		# Stream to viewer until read() - reading whatever it sends - returns
+		self.viewers.append(viewer)
+		self.watching.add(asyncio.current_task())
+		self.log('%s viewer %s:%d connected' % ((viewer.kind,) + viewer.address[:2]))
+		viewer.ready.set()
+		sender = asyncio.ensure_future(self.stream(viewer))
+		reader = asyncio.ensure_future(read())
+		try: await asyncio.wait([sender, reader], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			sender.cancel()
+			reader.cancel()
+			self.viewers.remove(viewer)
+			self.watching.discard(asyncio.current_task())
+			viewer.writer.close()
+			if not self.stopping: self.log(describe(viewer.stats()))
+
+	async def tcp_viewer(self, reader, writer):
+		async def read():
+			# TCP viewers have nothing to say - this just notices them leaving
+			try:
+				while await reader.read(4096): pass
+			except ConnectionError: pass
+		await self.watch(Viewer(writer, 'tcp'), read)
+
+	async def websocket_viewer(self, reader, writer):
+		try:
+			request = await reader.readuntil(b'\r\n\r\n')
+			if len(request) > MAX_REQUEST: raise ValueError('request too long')
+			headers = dict((name.strip().lower(), value.strip()) for (name, sep, value) in
+				(line.partition(b':') for line in request.split(b'\r\n')[1:]) if sep)
+			key = headers[b'sec-websocket-key']
+			if headers.get(b'upgrade', b'').lower() != b'websocket': raise ValueError('not a websocket')
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, KeyError, ValueError):
+			writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+			writer.close()
+			return
+
+		accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+		writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+			b'Connection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+		async def read():
+			# Answer pings, and stop at a close or the connection dropping
+			try:
+				while True:
+					(first, second) = await reader.readexactly(2)
+					length = second & 0x7f
+					if length == 126: (length,) = struct.unpack('!H', await reader.readexactly(2))
+					elif length == 127: (length,) = struct.unpack('!Q', await reader.readexactly(8))
+					mask = await reader.readexactly(4) if second & 0x80 else b'\0' * 4
+					payload = bytes(byte ^ mask[i % 4] for (i, byte) in
+						enumerate(await reader.readexactly(length)))
+					opcode = first & 0x0f
+					if opcode == 0x8:
+						writer.write(websocket_frame(payload[:2], 0x8))
+						return
+					if opcode == 0x9: writer.write(websocket_frame(payload, 0xa))
+			except (asyncio.IncompleteReadError, ConnectionError): return
+		await self.watch(Viewer(writer, 'websocket'), read)
+
+	def stats(self):
+		# Bandwidth and frame counts for each viewer watching now
+		return [viewer.stats() for viewer in list(self.viewers)]
+
+def main():
+	# A viewer that shows the characters of the screen in the terminal
+	parser = argparse.ArgumentParser(description='Watch a game being played on this machine.')
+	parser.add_argument('--port', type=int, default=7777)
+	args = parser.parse_args()
+
+	async def watch():
+		(reader, writer) = await asyncio.open_connection(HOST, args.port)
+		(screen, received, start) = (None, 0, time.perf_counter())
+		while True:
+			try: (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+			except asyncio.IncompleteReadError: break
+			message = await reader.readexactly(length)
+			received += LENGTH.size + length
+			screen = decode(message, screen)
+			if screen is None: continue
+			rows = [''.join(chr(ch) if 32 <= ch < 0x110000 else ' ' for ch in row) for row in
+				screen['ch']]
+			seconds = time.perf_counter() - start
+			sys.stdout.write('\x1b[H' + '\n'.join(rows) + '\n%.2fkB/s  ' % (received / 1000 /
+				seconds if seconds else 0.0))
+			sys.stdout.flush()
+
+	sys.stdout.write('\x1b[2J')
+	try: asyncio.run(watch())
+	except KeyboardInterrupt: pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,15 @@
+# Map generation - python -m pytest
+import pytest
+
+import generation
+import headless
+import prl
+
+@pytest.mark.parametrize('name', generation.PIPELINES)
+def test_stairs_down_on_floor(monkeypatch, name):
+	monkeypatch.setattr(prl, 'MAP_GENERATOR', name)
+	headless.setup(headless.ScriptedInput([]))
+	for seed in range(40):
+		prl.new_game(seed)
+		(stairs,) = [obj for obj in prl.objects if obj.name == 'stairs down']
+		assert not prl.my_map.blocked[stairs.x, stairs.y], (seed, stairs.x, stairs.y)
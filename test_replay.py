@@ -0,0 +1,138 @@
+# Recording games and replaying them - python -m pytest
+import pytest
+
+import headless
+import journal
+import prl
+import replay
+from spatial import SpatialIndex
+
+class Thing:
+	# Anything with a position, hashed by id() like a GameObject
+	def __init__(self, x, y):
+		self.x = x
+		self.y = y
+
+class MouseEvent:
+	def __init__(self, kind, cell, button=None):
+		self.type = kind
+		self.cell = cell
+		self.button = button
+
+class EventInput:
+	# Hands out entries in turn - a list of events from get() or wait(), a
+	# single event from wait_key() - and raises IndexError when asked for
+	# more once the game has started waiting. An entry can be a function of
+	# nothing, called for the events when they're wanted.
+	def __init__(self, entries):
+		self.entries = list(entries)
+		self.position = 0
+
+	def next(self):
+		entry = self.entries[self.position]
+		self.position += 1
+		return entry() if callable(entry) else entry
+
+	def get(self):
+		if self.is_window_closed(): return []
+		return self.next()
+
+	def wait(self, timeout=None):
+		return self.next()
+
+	def wait_key(self):
+		return self.next()
+
+	def is_window_closed(self):
+		return self.position >= len(self.entries)
+
+def click_on_player():
+	cell = prl.to_screen(prl.player.x, prl.player.y)
+	return [MouseEvent('MOUSEMOTION', cell), MouseEvent('MOUSEDOWN', cell, 'LEFT')]
+
+class FixedDice:
+	def __init__(self, value):
+		self.value = value
+
+	def randint(self, low, high):
+		return self.value
+
+def rune(name, use_function):
+	return prl.GameObject(0, 0, '#', name, prl.colours.light_yellow,
+		item=prl.Item(use_function=use_function))
+
+def arena(monkeypatch):
+	# New games start with an orc either side of the player - as near as each
+	# other, so which one lightning strikes is down to the order the game
+	# keeps them in - and runes of lightning and fireball to use on them
+	new_game = prl.new_game
+
+	def arena_game(seed=None):
+		new_game(seed)
+		(x, y) = (prl.player.x, prl.player.y)
+		for (dx, dy) in ((1, 0), (0, 1)):
+			if not (prl.is_blocked(x - dx, y - dy) or prl.is_blocked(x + dx, y + dy)): break
+		else: raise AssertionError('no room for the orcs around (%d, %d)' % (x, y))
+		for side in (-1, 1):
+			prl.add_object(prl.make_monster(x + side * dx, y + side * dy, FixedDice(0)))
+		prl.inventory.extend([rune('lightning rune', prl.cast_lightning),
+			rune('fireball rune', prl.cast_fireball)])
+
+	monkeypatch.setattr(prl, 'new_game', arena_game)
+
+def test_nearest_ties_go_to_the_first_filed():
+	(a, b) = (Thing(3, 5), Thing(7, 5))
+	for order in ((a, b), (b, a)):
+		index = SpatialIndex(order)
+		assert index.nearest(5, 5, 10) is order[0]
+		assert index.in_radius(5, 5, 2) == list(order)
+
+def test_replay_with_spells(monkeypatch, tmp_path):
+	arena(monkeypatch)
+	path = str(tmp_path / 'spells.journal')
+	key = headless.key_event
+	source = EventInput([
+		[key('i')], key('a'),						# Lightning, at one of the orcs
+		[key('i')], key('a'), click_on_player,		# Fireball, on the other
+		[key('RIGHT')], [key('LEFT')]])
+	headless.run(source, seed=1, god=True, journal_path=path)
+
+	assert prl.inventory == []
+	dead = [obj for obj in prl.objects if obj.name == 'remains of orc']
+	assert len(dead) >= 2
+
+	stats = replay.replay(path)
+	assert stats['turns'] == stats['checked'] == 4
+	assert len([obj for obj in prl.objects if obj.name == 'remains of orc']) == len(dead)
+
+def test_journal_ending_while_targeting(monkeypatch, tmp_path):
+	# Fireball waits for a click that the journal never got to
+	arena(monkeypatch)
+	path = str(tmp_path / 'cut.journal')
+	source = EventInput([[headless.key_event('i')], headless.key_event('b'), []])
+	with pytest.raises(IndexError):
+		headless.run(source, seed=1, god=True, journal_path=path)
+	prl.stop_journal()
+
+	with pytest.raises(journal.JournalError):
+		replay.replay(path)
+
+def test_replay_rebuilds_engines_from_the_journal(monkeypatch, tmp_path):
+	# The FOV, lighting and pathfinding engines are made at import, so a
+	# replay has to make them again from the journal's settings
+	for name in ('fov_engine', 'light_map', 'flow_field'):
+		monkeypatch.setattr(prl, name, getattr(prl, name))
+	recorded = {'FOV_ALGO': 'SHADOW', 'FOV_LIGHT_WALLS': False, 'FLOW_RADIUS': 5}
+	for (name, value) in recorded.items(): monkeypatch.setattr(prl, name, value)
+	prl.make_engines()
+	path = str(tmp_path / 'engines.journal')
+	headless.run(headless.ScriptedInput(['RIGHT', 'LEFT']), seed=1, god=True, journal_path=path)
+
+	monkeypatch.setattr(prl, 'FOV_ALGO', 'BASIC')
+	monkeypatch.setattr(prl, 'FOV_LIGHT_WALLS', True)
+	monkeypatch.setattr(prl, 'FLOW_RADIUS', 20)
+	prl.make_engines()
+	replay.replay(path)
+	for engine in (prl.fov_engine, prl.light_map.fov_engine):
+		assert (engine.algorithm, engine.light_walls) == ('SHADOW', False)
+	assert prl.flow_field.max_distance == 5
@@ -0,0 +1,62 @@
+# Saving and loading games - python -m pytest
+import collections
+
+import headless
+import prl
+
+def large_world(monkeypatch, tmp_path):
+	# A small large world, keeping few chunks in memory so they're soon evicted
+	monkeypatch.chdir(tmp_path)
+	for (name, value) in (('LARGE_WORLD', True), ('WORLD_WIDTH', 512), ('WORLD_HEIGHT', 512),
+			('CHUNK_SIZE', 16), ('MAX_CHUNKS', 12), ('WORLD_CACHE_DIR', None),
+			('AUTOSAVE_TURNS', 0)):
+		monkeypatch.setattr(prl, name, value)
+	headless.setup(headless.ScriptedInput([]))
+
+def go(x, y):
+	# Put the player at (x, y), bringing in the chunks around and exploring a little
+	(prl.player.x, prl.player.y) = (x, y)
+	prl.object_index.update(prl.player)
+	prl.my_map.ensure_around(x, y, 20)
+	prl.my_map.explored[x - 3:x + 3, y - 3:y + 3] = True
+
+def everything():
+	# Every object in the world, once all its chunks are back in memory
+	prl.my_map.max_chunks = 10 ** 6
+	for key in sorted(prl.my_map.known()): prl.my_map.chunk(*key)
+	return collections.Counter((obj.name, obj.x, obj.y, obj.fighter.hp if obj.fighter else 0)
+		for obj in prl.objects)
+
+def test_autosave_snapshot_of_a_large_world(monkeypatch, tmp_path):
+	# The snapshot is taken, play goes on evicting and changing chunks, and
+	# only then is it written - as the autosaver does - yet it loads as the
+	# world was when it was taken
+	large_world(monkeypatch, tmp_path)
+	prl.new_game(3)
+	(x, y) = (prl.player.x, prl.player.y)
+	go(x + 60, y)
+	go(x, y)
+	assert prl.my_map.evicted > 0
+
+	prl.save_game('now.sav')
+	snapshot = prl.snapshot_game()
+	(explored, known) = (prl.my_map.explored.copy(), prl.my_map.known())
+
+	evicted = prl.my_map.evicted
+	go(x - 70, y + 40)
+	go(x + 60, y)
+	for obj in prl.objects:
+		if obj.fighter and obj is not prl.player: obj.fighter.hp -= 1
+	go(x, y + 80)
+	go(x, y)
+	assert prl.my_map.evicted > evicted
+	prl.write_game(snapshot, 'later.sav')
+
+	try:
+		prl.load_game('later.sav')
+		assert (prl.my_map.explored == explored).all()
+		assert prl.my_map.known() == known
+		later = everything()
+		prl.load_game('now.sav')
+		assert later == everything()
+	finally: prl.retire_world()
@@ -0,0 +1,329 @@
+import os
+import pickle
+import random
+import re
+import shutil
+import tempfile
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# Same shape as Rect - the outer edge is wall, the inside is floor
+Room = namedtuple('Room', 'x1 y1 x2 y2')
+
+CHUNK_FILE = re.compile(r'chunk_(\d+)_(\d+)\.pkl$')
+
+def chunk_files(directory):
+	# key -> path of every chunk file in directory
+	files = {}
+	for name in os.listdir(directory):
+		match = CHUNK_FILE.match(name)
+		if match: files[(int(match.group(1)), int(match.group(2)))] = os.path.join(directory, name)
+	return files
+
+class Chunk:
+	def __init__(self, blocked, block_sight, saved=False):
+		self.blocked = blocked
+		self.block_sight = block_sight
+		self.saved = saved		# The cache file matches, with no objects in it
+
+class WorldLayer:
+	# Read-only [x, y] view of one tile property across all the chunks, for
+	# code written against GameMap's arrays. Supports single tiles and
+	# rectangular slices - the slice is assembled from the chunks it covers.
+	def __init__(self, world, name):
+		self.world = world
+		self.name = name
+
+	@property
+	def shape(self):
+		return (self.world.width, self.world.height)
+
+	def __getitem__(self, key):
+		(x, y) = key
+		if isinstance(x, slice) or isinstance(y, slice):
+			return self.world.region(self.name, x, y)
+		return self.world.tile(self.name, x, y)
+
+def bounds(index, size):
+	# A slice (or single index) along one axis as a (start, stop) pair
+	if not isinstance(index, slice): return (index, index + 1)
+	(start, stop, step) = index.indices(size)
+	return (start, max(start, stop))
+
+class ChunkedWorld:
+	# A map much bigger than the screen, split into chunk_size square chunks.
+	# Chunks are generated from the world seed the first time the player comes
+	# near them, and at most max_chunks are kept in memory - the least recently
+	# used are written to cache_dir (with whatever objects stood on them) and
+	# read back when the player returns. Explored tiles live in a memory-mapped
+	# file, so they don't count against memory either.
+	# It answers the same queries as GameMap, and its blocked/block_sight/
+	# explored can be indexed the same way for single tiles and slices.
+	# A world always starts afresh in cache_dir - a saved one is put back with
+	# restore(). Without a cache_dir, a temporary directory is made, which
+	# close() removes.
+	def __init__(self, width, height, chunk_size=32, seed=None, cache_dir=None,
+			max_chunks=64, on_generate=None, on_evict=None, on_load=None):
+		self.width = width
+		self.height = height
+		self.chunk_size = chunk_size
+		self.seed = seed
+		self.max_chunks = max_chunks
+
+		# Hooks for the objects living on the chunks:
+		#	on_generate(rooms)				a chunk was generated for the first time
+		#	on_evict(x1, y1, x2, y2)	->	payload to keep with the chunk on disk
+		#	on_load(payload)				the chunk was read back
+		self.on_generate = on_generate
+		self.on_evict = on_evict
+		self.on_load = on_load
+
+		self.temporary = cache_dir is None
+		self.cache_dir = cache_dir or tempfile.mkdtemp(prefix='prl-world-')
+		os.makedirs(self.cache_dir, exist_ok=True)
+		for path in chunk_files(self.cache_dir).values(): os.remove(path)	# Another world's
+		self.open_explored('w+')
+
+		self.chunks = OrderedDict()
+		self.stored = set()		# Keys of the chunks with a file
+		self.version = 0
+		self.generated = 0
+		self.loaded = 0
+		self.evicted = 0
+
+		self.blocked = WorldLayer(self, 'blocked')
+		self.block_sight = WorldLayer(self, 'block_sight')
+
+	def open_explored(self, mode):
+		self.explored = np.memmap(os.path.join(self.cache_dir, 'explored.dat'),
+			dtype=bool, mode=mode, shape=(self.width, self.height), order='F')
+
+	def __getstate__(self):
+		# Saved as settings only - the chunks go to the cache directory. The
+		# objects on chunks in memory are on the level, so they're saved with
+		# it rather than with the chunk.
+		self.flush()
+		state = self.__dict__.copy()
+		for name in ('explored', 'chunks', 'blocked', 'block_sight'): del state[name]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if 'stored' not in state:
+			# Pickled before worlds knew their files - and which were temporary
+			self.temporary = False
+			self.stored = set(chunk_files(self.cache_dir))
+		self.open_explored('r+')
+		self.chunks = OrderedDict()
+		self.blocked = WorldLayer(self, 'blocked')
+		self.block_sight = WorldLayer(self, 'block_sight')
+
+	def close(self):
+		# Done with the world - a temporary cache directory goes with it
+		self.chunks.clear()
+		self.explored = None
+		if self.temporary: shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+	def known(self):
+		# Keys of every chunk generated so far, in memory or on disk
+		return set(self.chunks) | self.stored
+
+	def snapshot(self):
+		# The world's state as it is now, copied so that nothing in it changes
+		# with play: (explored, resident, stored). resident is (key, blocked,
+		# block_sight) for each chunk in memory, whose objects are on the
+		# level; stored is (key, the file's bytes) for each chunk only on disk,
+		# for chunk_states() to read later.
+		resident = [(key, chunk.blocked.copy(), chunk.block_sight.copy()) for (key, chunk) in
+			self.chunks.items()]
+		stored = []
+		for key in sorted(self.stored - set(self.chunks)):
+			with open(self.chunk_path(key), 'rb') as chunk_file: stored.append((key, chunk_file.read()))
+		return (np.array(self.explored), resident, stored)
+
+	@staticmethod
+	def chunk_states(resident, stored):
+		# (key, blocked, block_sight, payload) for each chunk of a snapshot
+		chunks = [(key, blocked, block_sight, None) for (key, blocked, block_sight) in resident]
+		for (key, data) in stored: chunks.append((key,) + pickle.loads(data))
+		return chunks
+
+	def restore(self, explored, chunks):
+		# Put a saved world's state - explored, and chunks as chunk_states()
+		# gives them - back into this new one. Every chunk goes to disk, to be read when the player comes near,
+		# so its payload is handed to on_load then. Chunks whose tiles are
+		# None are generated again, without their rooms being populated.
+		self.explored[...] = explored
+		for (key, blocked, block_sight, payload) in chunks:
+			chunk = self.generate(*key)[0] if blocked is None else Chunk(blocked, block_sight)
+			self.write_chunk(key, chunk, payload)
+
+	def start(self):
+		# Where the player begins - the centre of the middle chunk
+		size = self.chunk_size
+		return ((self.width // size // 2) * size + size // 2,
+			(self.height // size // 2) * size + size // 2)
+
+	# ------------------------------------------------------------------
+	# Chunks
+
+	def chunk_path(self, key):
+		return os.path.join(self.cache_dir, 'chunk_%d_%d.pkl' % key)
+
+	def chunk(self, cx, cy):
+		key = (cx, cy)
+		chunk = self.chunks.get(key)
+		if chunk is not None:
+			self.chunks.move_to_end(key)
+			return chunk
+
+		path = self.chunk_path(key)
+		if os.path.exists(path):
+			with open(path, 'rb') as chunk_file:
+				(blocked, block_sight, payload) = pickle.load(chunk_file)
+			chunk = self.chunks[key] = Chunk(blocked, block_sight, payload is None)
+			self.loaded += 1
+			if self.on_load and payload is not None:
+				# The objects are the level's now - the file mustn't hand them
+				# out a second time
+				self.on_load(payload)
+				self.write_chunk(key, chunk, None)
+		else:
+			(chunk, rooms) = self.generate(cx, cy)
+			self.chunks[key] = chunk
+			self.generated += 1
+			if self.on_generate: self.on_generate(rooms)
+
+		while len(self.chunks) > self.max_chunks:
+			self.evict(next(iter(self.chunks)))
+		return chunk
+
+	def evict(self, key):
+		chunk = self.chunks.pop(key)
+		payload = None
+		if self.on_evict:
+			size = self.chunk_size
+			payload = self.on_evict(key[0] * size, key[1] * size,
+				(key[0] + 1) * size, (key[1] + 1) * size)
+		self.write_chunk(key, chunk, payload)
+		self.evicted += 1
+
+	def flush(self):
+		# Write everything in memory to the cache directory, leaving it loaded.
+		# The chunks go without their objects - those are still on the level.
+		# Chunks whose file is already up to date are skipped.
+		for (key, chunk) in self.chunks.items():
+			if not chunk.saved: self.write_chunk(key, chunk, None)
+		self.explored.flush()
+
+	def write_chunk(self, key, chunk, payload):
+		with open(self.chunk_path(key), 'wb') as chunk_file:
+			pickle.dump((chunk.blocked, chunk.block_sight, payload), chunk_file,
+				pickle.HIGHEST_PROTOCOL)
+		chunk.saved = payload is None
+		self.stored.add(key)
+
+	def ensure_around(self, x, y, radius):
+		# Make sure every chunk within radius tiles of (x, y) is in memory,
+		# generating it if need be
+		size = self.chunk_size
+		for cx in range(max(0, (x - radius) // size),
+				min(self.width - 1, x + radius) // size + 1):
+			for cy in range(max(0, (y - radius) // size),
+					min(self.height - 1, y + radius) // size + 1):
+				self.chunk(cx, cy)
+
+	def generate(self, cx, cy):
+		# A hub room in the middle of the chunk, with corridors out to the
+		# middle of every edge (so it joins up with its neighbours) and a few
+		# side rooms hanging off it. Always the same for the same seed.
+		rng = random.Random('%s:%d:%d' % (self.seed, cx, cy))
+		size = self.chunk_size
+		(ox, oy) = (cx * size, cy * size)
+		blocked = np.ones((size, size), dtype=bool, order='F')
+
+		def carve(x1, y1, x2, y2):
+			blocked[min(x1, x2):max(x1, x2) + 1, min(y1, y2):max(y1, y2) + 1] = False
+
+		mid = size // 2
+		rooms = []
+		half = rng.randint(2, max(2, size // 6))
+		hub = Room(mid - half - 1, mid - half - 1, mid + half + 1, mid + half + 1)
+		carve(hub.x1 + 1, hub.y1 + 1, hub.x2 - 1, hub.y2 - 1)
+		rooms.append(hub)
+
+		# Exits, except where the world ends
+		if cy > 0: carve(mid, 0, mid, mid)
+		if (cy + 1) * size < self.height: carve(mid, mid, mid, size - 1)
+		if cx > 0: carve(0, mid, mid, mid)
+		if (cx + 1) * size < self.width: carve(mid, mid, size - 1, mid)
+
+		for i in range(rng.randint(1, 4)):
+			w = rng.randint(4, max(4, size // 4))
+			h = rng.randint(4, max(4, size // 4))
+			x = rng.randint(1, size - w - 2)
+			y = rng.randint(1, size - h - 2)
+			room = Room(x, y, x + w, y + h)
+			carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
+
+			# Dog-leg corridor back to the hub
+			(rx, ry) = ((room.x1 + room.x2) // 2, (room.y1 + room.y2) // 2)
+			carve(rx, ry, mid, ry)
+			carve(mid, ry, mid, mid)
+			rooms.append(room)
+
+		world_rooms = [Room(room.x1 + ox, room.y1 + oy, room.x2 + ox, room.y2 + oy)
+			for room in rooms]
+		return (Chunk(blocked, blocked.copy()), world_rooms)
+
+	# ------------------------------------------------------------------
+	# GameMap interface
+
+	def in_bounds(self, x, y):
+		return 0 <= x < self.width and 0 <= y < self.height
+
+	def tile(self, name, x, y):
+		size = self.chunk_size
+		chunk = self.chunk(x // size, y // size)
+		if name == 'transparent':
+			return not (chunk.blocked[x % size, y % size] or chunk.block_sight[x % size, y % size])
+		return bool(getattr(chunk, name)[x % size, y % size])
+
+	def region(self, name, xs, ys):
+		# A slice of one tile property, assembled from the chunks it covers
+		(x1, x2) = bounds(xs, self.width)
+		(y1, y2) = bounds(ys, self.height)
+		size = self.chunk_size
+		result = np.zeros((x2 - x1, y2 - y1), dtype=bool, order='F')
+		for cx in range(x1 // size, (x2 - 1) // size + 1 if x2 > x1 else 0):
+			for cy in range(y1 // size, (y2 - 1) // size + 1 if y2 > y1 else 0):
+				chunk = self.chunk(cx, cy)
+				if name == 'transparent': data = ~(chunk.blocked | chunk.block_sight)
+				else: data = getattr(chunk, name)
+				(ax, ay) = (max(x1, cx * size), max(y1, cy * size))
+				(bx, by) = (min(x2, (cx + 1) * size), min(y2, (cy + 1) * size))
+				result[ax - x1:bx - x1, ay - y1:by - y1] = data[ax - cx * size:bx - cx * size,
+					ay - cy * size:by - cy * size]
+		if not isinstance(xs, slice): result = result[0]
+		elif not isinstance(ys, slice): result = result[:, 0]
+		return result
+
+	def is_blocked(self, x, y):
+		return self.tile('blocked', x, y)
+
+	def is_transparent(self, x, y):
+		if not self.in_bounds(x, y): return False
+		return self.tile('transparent', x, y)
+
+	def transparency(self):
+		return WorldLayer(self, 'transparent')
+
+	def set_tile(self, x, y, blocked, block_sight=None):
+		if block_sight is None: block_sight = blocked
+		size = self.chunk_size
+		chunk = self.chunk(x // size, y // size)
+		chunk.blocked[x % size, y % size] = blocked
+		chunk.block_sight[x % size, y % size] = block_sight
+		chunk.saved = False
+		self.version += 1